@@ -1,4 +1,9 @@
+from rest_framework.exceptions import AuthenticationFailed
 from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from rest_framework_simplejwt.settings import api_settings
+
+from .token_cache import get_token_cache
 
 class CustomJWTAuthentication(JWTAuthentication):
     def authenticate(self, request):
@@ -13,5 +18,18 @@ class CustomJWTAuthentication(JWTAuthentication):
         
         if raw_token is None:
             return None
-        validated_token = self.get_validated_token(raw_token)
-        return self.get_user(validated_token), validated_token
\ No newline at end of file
+
+        # Verified tokens and their users are cached per process (see token_cache.py)
+        # so a repeated token costs neither a signature check nor a user query
+        cache = get_token_cache()
+        try:
+            validated_token = cache.validate(raw_token)
+        except TokenError as e:
+            raise InvalidToken(e.args[0])
+
+        user = cache.get_user(validated_token[api_settings.USER_ID_CLAIM])
+        if user is None:
+            raise AuthenticationFailed("User not found", code="user_not_found")
+        if not user.is_active:
+            raise AuthenticationFailed("User is inactive", code="user_inactive")
+        return user, validated_token
\ No newline at end of file
@@ -4,29 +4,43 @@ This is separate from authentication.py because WebSocket connections
 need different middleware than HTTP requests.
 """
 
-from channels.db import database_sync_to_async
 from channels.middleware import BaseMiddleware
 from django.contrib.auth.models import AnonymousUser
-from rest_framework_simplejwt.tokens import AccessToken
+from rest_framework_simplejwt.settings import api_settings
 from django.contrib.auth import get_user_model
 
+from chat_app_boilerplate.database import database_read_async
+from chat_app_boilerplate.logs import get_event_logger
+
+from .token_cache import get_token_cache
+
 User = get_user_model()
+log = get_event_logger(__name__)
 
 
-@database_sync_to_async
-def get_user_from_token(token):
+async def get_user_from_token(token):
     """
     Validate JWT token and return the user.
     This is the WebSocket equivalent of CustomJWTAuthentication.
+
+    A token and user already in the token cache are resolved without
+    leaving the event loop; only a cache miss goes to the database thread.
     """
+    cache = get_token_cache()
     try:
-        access_token = AccessToken(token)
-        user_id = access_token['user_id']
-        user = User.objects.get(id=user_id)
-        print(f"✅ JWT Auth: User {user.email} authenticated")
+        access_token = cache.validate(token)
+        user_id = access_token[api_settings.USER_ID_CLAIM]
+        user = cache.cached_user(user_id)
+        if user is None:
+            user = await database_read_async(cache.get_user)(user_id)
+        if user is None:
+            raise User.DoesNotExist(f"No user with id {user_id}")
+        if not user.is_active:
+            raise ValueError(f"User {user.email} is inactive")
+        log.event("auth.ws.authenticated", user=user.id)
         return user
     except Exception as e:
-        print(f"❌ JWT Auth failed: {e}")
+        log.event("auth.ws.failed", reason=type(e).__name__, detail=e)
         return AnonymousUser()
 
 
@@ -37,8 +51,6 @@ class JWTAuthMiddleware(BaseMiddleware):
     """
     
     async def __call__(self, scope, receive, send):
-        print(f"🔐 JWT Middleware called for path: {scope.get('path')}")
-        
         # Get cookies from headers
         headers = dict(scope['headers'])
         cookie_header = headers.get(b'cookie', b'').decode()
@@ -54,14 +66,11 @@ class JWTAuthMiddleware(BaseMiddleware):
         token = cookies.get('access_token')
         
         if token:
-            print(f"🔑 Found access_token in cookies")
             scope['user'] = await get_user_from_token(token)
         else:
-            print(f"⚠️ No access_token found in cookies")
+            log.event("auth.ws.token_missing", path=scope.get('path'))
             scope['user'] = AnonymousUser()
         
-        print(f"👤 User set to: {scope['user']}")
-        
         return await super().__call__(scope, receive, send)
 
 
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.5 on 2026-10-17 10:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0003_alter_customuser_guild'),
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('chat', '0006_conversationsummary'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='customuser',
+            index=models.Index(fields=['name', 'id'], name='customuser_name_id_idx'),
+        ),
+    ]
@@ -54,5 +54,11 @@ class CustomUser(AbstractBaseUser, PermissionsMixin):
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ['name']
 
+    class Meta:
+        # the chat user directory pages through users by (name, id)
+        indexes = [
+            models.Index(fields=['name', 'id'], name='customuser_name_id_idx'),
+        ]
+
     def __str__(self):
         return self.email
\ No newline at end of file
@@ -0,0 +1,15 @@
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .token_cache import get_token_cache
+
+User = get_user_model()
+
+
+# any change to a user (deactivation, profile edits, guild) must not be
+# served from a stale cached record
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_cached_user(sender, instance, **kwargs):
+    get_token_cache().invalidate_user(instance.id)
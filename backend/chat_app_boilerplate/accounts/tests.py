@@ -1,3 +1,105 @@
-from django.test import TestCase
+import time
+from unittest import mock
 
-# Create your tests here.
+from django.test import RequestFactory, TestCase
+from django.urls import reverse
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from accounts import token_cache
+from accounts.authentication import CustomJWTAuthentication
+from accounts.models import CustomUser
+from accounts.token_cache import TokenCache
+
+
+def create_user(email):
+    return CustomUser.objects.create_user(email, name=email.split("@")[0], is_active=True)
+
+
+class TokenCacheTests(TestCase):
+    def setUp(self):
+        # a fresh process-wide cache, which the signal receivers and views use
+        self.cache = TokenCache(max_tokens=2, max_users=2, user_ttl=300)
+        patcher = mock.patch.object(token_cache, "_cache", self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.alice = create_user("alice@example.com")
+        self.token = str(AccessToken.for_user(self.alice))
+
+    def authenticate(self, raw_token):
+        request = RequestFactory().get("/")
+        request.COOKIES["access_token"] = raw_token
+        return CustomJWTAuthentication().authenticate(request)
+
+    def test_token_hit_and_miss(self):
+        first = self.cache.validate(self.token)
+        with mock.patch.object(token_cache, "AccessToken") as verify:
+            self.assertIs(self.cache.validate(self.token), first)
+        verify.assert_not_called()
+        self.assertEqual((self.cache.counters["token_misses"], self.cache.counters["token_hits"]), (1, 1))
+
+    def test_token_expires_at_exp(self):
+        validated = self.cache.validate(self.token)
+        with mock.patch.object(token_cache.time, "time", return_value=validated["exp"]):
+            self.cache.validate(self.token)
+        # verified again, not served from the cache
+        self.assertEqual(self.cache.counters["token_misses"], 2)
+
+    def test_user_lookup(self):
+        with self.assertNumQueries(1):
+            user, _ = self.authenticate(self.token)
+            self.assertEqual(self.authenticate(self.token)[0].email, "alice@example.com")
+        self.assertEqual(user, self.alice)
+        self.assertIsNot(self.cache.get_user(self.alice.id), self.cache.get_user(self.alice.id))
+
+    def test_user_expires_after_ttl(self):
+        self.cache.get_user(self.alice.id)
+        with mock.patch.object(token_cache.time, "time", return_value=time.time() + 300), self.assertNumQueries(1):
+            self.cache.get_user(self.alice.id)
+
+    def test_inactive_user_rejected_after_caching(self):
+        self.authenticate(self.token)
+        self.alice.is_active = False
+        self.alice.save()
+        with self.assertRaisesMessage(AuthenticationFailed, "User is inactive"):
+            self.authenticate(self.token)
+
+    def test_invalidated_on_save_and_delete(self):
+        self.cache.get_user(self.alice.id)
+        self.alice.name = "Alice"
+        self.alice.save()
+        self.assertEqual(self.cache.stats()["users"], 0)
+        self.assertEqual(self.cache.get_user(self.alice.id).name, "Alice")
+
+        user_id = self.alice.id
+        self.alice.delete()
+        self.assertEqual(self.cache.stats()["users"], 0)
+        self.assertIsNone(self.cache.get_user(user_id))
+        with self.assertRaisesMessage(AuthenticationFailed, "User not found"):
+            self.authenticate(self.token)
+
+    def test_invalidated_on_logout(self):
+        client = APIClient()
+        client.cookies["access_token"] = self.token
+        self.authenticate(self.token)
+        self.assertEqual(client.post(reverse("logout")).status_code, 200)
+        self.assertEqual(self.cache.stats()["tokens"], 0)
+        self.assertEqual(self.cache.stats()["users"], 0)
+
+    def test_lru_bounds(self):
+        bob, carol = create_user("bob@example.com"), create_user("carol@example.com")
+        tokens = [self.token, str(AccessToken.for_user(bob)), str(AccessToken.for_user(carol))]
+        self.cache.validate(tokens[0])
+        self.cache.validate(tokens[1])
+        self.cache.validate(tokens[0])  # now the most recently used
+        self.cache.validate(tokens[2])
+        self.assertEqual(self.cache.stats()["tokens"], 2)
+        self.assertIsNotNone(self.cache._tokens.get(tokens[0]))
+        self.assertIsNone(self.cache._tokens.get(tokens[1]))
+
+        for user in (self.alice, bob, carol):
+            self.cache.get_user(user.id)
+        self.assertEqual(self.cache.stats()["users"], 2)
+        self.assertIsNone(self.cache.cached_user(self.alice.id))
+        self.assertEqual(self.cache.cached_user(carol.id).email, "carol@example.com")
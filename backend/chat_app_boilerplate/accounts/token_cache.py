@@ -0,0 +1,184 @@
+"""
+In-process cache of verified access tokens and the users they belong to.
+
+Access tokens only live for ACCESS_TOKEN_LIFETIME and the frontend sends
+the same one on every REST call and WebSocket connect, so each process
+keeps:
+
+* verified tokens (raw token -> validated AccessToken + user id), dropped
+  once the token's ``exp`` has passed, and
+* minimal user records (user id -> concrete field values), dropped after
+  ``USER_TTL`` seconds or as soon as the user is saved, deleted, changes
+  guild or logs out.
+
+Both maps are bounded LRUs. ``stats()`` exposes hit/miss counters.
+
+Invalidation is per process, so a cached record can be up to ``USER_TTL``
+stale elsewhere. It authenticates; access to messages (guild membership,
+deactivation) is re-checked in the database with
+``chat.models.is_active_member``.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import DEFAULT_DB_ALIAS
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from chat_app_boilerplate.metrics import REGISTRY
+
+DEFAULTS = {
+    "MAX_TOKENS": 4096,
+    "MAX_USERS": 4096,
+    "USER_TTL": 300,  # seconds
+}
+
+# Enough of the user for authentication, consumers and views; anything else
+# is deferred and loaded on access
+USER_FIELDS = ("id", "email", "name", "is_active", "is_staff", "is_superuser", "guild_id")
+
+
+class _LRU:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is not None:
+            self._data.move_to_end(key)
+        return entry
+
+    def set(self, key, entry):
+        self._data[key] = entry
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        return self._data.pop(key, None)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class TokenCache:
+    def __init__(self, max_tokens, max_users, user_ttl):
+        self.user_ttl = user_ttl
+        self._tokens = _LRU(max_tokens)  # raw token -> (expires_at, validated token, user id)
+        self._users = _LRU(max_users)  # user id -> (expires_at, field values)
+        self._lock = threading.Lock()
+        self.counters = {"token_hits": 0, "token_misses": 0, "user_hits": 0, "user_misses": 0}
+
+    def validate(self, raw_token):
+        """
+        Return the validated AccessToken for ``raw_token``, verifying the
+        signature only on a cache miss. Raises TokenError like AccessToken().
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._tokens.get(raw_token)
+            if entry is not None and entry[0] > now:
+                self.counters["token_hits"] += 1
+                return entry[1]
+            self.counters["token_misses"] += 1
+
+        validated = AccessToken(raw_token)
+        user_id = validated[api_settings.USER_ID_CLAIM]
+        with self._lock:
+            self._tokens.set(raw_token, (validated["exp"], validated, user_id))
+        return validated
+
+    def cached_user(self, user_id):
+        """The cached user with ``user_id``, or None on a miss - never touches the database"""
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None or entry[0] <= time.time():
+                return None
+            self.counters["user_hits"] += 1
+            return _build_user(entry[1])
+
+    def get_user(self, user_id):
+        """The user with ``user_id`` (active or not), or None if it doesn't exist"""
+        now = time.time()
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is not None and entry[0] > now:
+                self.counters["user_hits"] += 1
+                return _build_user(entry[1])
+            self.counters["user_misses"] += 1
+
+        User = get_user_model()
+        values = User.objects.filter(id=user_id).values_list(*USER_FIELDS).first()
+        if values is None:
+            return None
+        with self._lock:
+            self._users.set(user_id, (now + self.user_ttl, values))
+        return _build_user(values)
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            self._users.pop(user_id)
+
+    def invalidate_token(self, raw_token):
+        with self._lock:
+            entry = self._tokens.pop(raw_token)
+            if entry is not None:
+                self._users.pop(entry[2])
+
+    def stats(self):
+        with self._lock:
+            return {**self.counters, "tokens": len(self._tokens), "users": len(self._users)}
+
+
+def _build_user(values):
+    # a fresh instance per lookup, so callers never share mutable state
+    User = get_user_model()
+    fields = dict(zip(USER_FIELDS, values))
+    # from_db() expects the loaded fields in model order; the rest are deferred
+    attnames = [field.attname for field in User._meta.concrete_fields if field.attname in fields]
+    return User.from_db(DEFAULT_DB_ALIAS, attnames, [fields[name] for name in attnames])
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_token_cache():
+    """Return the process-wide cache, creating it from settings on first use."""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                options = {**DEFAULTS, **getattr(settings, "TOKEN_CACHE", {})}
+                _cache = TokenCache(
+                    max_tokens=options["MAX_TOKENS"],
+                    max_users=options["MAX_USERS"],
+                    user_ttl=options["USER_TTL"],
+                )
+    return _cache
+
+
+def _cache_samples():
+    if _cache is None:
+        return []
+    stats = _cache.stats()
+    return [
+        ("token_cache_lookups_total", "counter", "Token cache lookups by map and result", [
+            ({"map": "token", "result": "hit"}, stats["token_hits"]),
+            ({"map": "token", "result": "miss"}, stats["token_misses"]),
+            ({"map": "user", "result": "hit"}, stats["user_hits"]),
+            ({"map": "user", "result": "miss"}, stats["user_misses"]),
+        ]),
+        ("token_cache_entries", "gauge", "Entries held by the token cache", [
+            ({"map": "token"}, stats["tokens"]),
+            ({"map": "user"}, stats["users"]),
+        ]),
+    ]
+
+
+REGISTRY.register_collector(_cache_samples)
@@ -5,6 +5,7 @@ from rest_framework.views import APIView
 from django.contrib.auth import authenticate
 from rest_framework.permissions import AllowAny
 from .models import CustomUser
+from .token_cache import get_token_cache
 
 from google.oauth2 import id_token
 from google.auth.transport import requests as google_requests
@@ -53,6 +54,12 @@ class CustomLoginView(APIView):
 
 class CustomLogoutView(APIView):
     def post(self, request):
+        # forget the verified token and its user record in this process; the
+        # JWT itself stays valid until its exp, in other processes or if replayed
+        access_token = request.COOKIES.get('access_token')
+        if access_token:
+            get_token_cache().invalidate_token(access_token)
+
         res = Response({'message': 'Logged out'})
         res.delete_cookie('access_token')
         res.delete_cookie('refresh_token')
@@ -1,8 +1,27 @@
 from django.contrib import admin
-from .models import Chat_Group, PersonalChat, GroupMessage
+from .models import Chat_Group, PersonalChat, GroupMessage, ConversationSummary
+from .recent import get_recent_messages
 
 # Register your models here.
 
 admin.site.register(Chat_Group)
-admin.site.register(PersonalChat)
-admin.site.register(GroupMessage)
\ No newline at end of file
+
+
+class MessageAdmin(admin.ModelAdmin):
+    # Deletes don't change a conversation's sequence, so the recent messages
+    # cache can't notice them; a post_delete receiver would instead cost
+    # every guild deletion its fast cascade, so drop the entries here.
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        get_recent_messages().discard(obj.sequence_key())
+
+    def delete_queryset(self, request, queryset):
+        keys = {message.sequence_key() for message in queryset}
+        super().delete_queryset(request, queryset)
+        for key in keys:
+            get_recent_messages().discard(key)
+
+
+admin.site.register(PersonalChat, MessageAdmin)
+admin.site.register(GroupMessage, MessageAdmin)
+admin.site.register(ConversationSummary)
@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class ChatConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chat'
+
+    def ready(self):
+        # connect the cache invalidation receivers
+        from . import signals  # noqa: F401
+        # SQLite pragmas, before the first connection is opened
+        from chat_app_boilerplate import database  # noqa: F401
@@ -0,0 +1,248 @@
+"""
+Cold storage of old messages in compressed, append-only segment files.
+
+``manage.py archive_messages`` moves the messages older than ``AGE_DAYS``
+out of the PersonalChat / GroupMessage tables, so their indexes and the
+database backups only cover recent history. Each conversation is archived
+oldest first, ``SEGMENT_SIZE`` messages at a time:
+
+1. the oldest live messages are read and written to a new gzip'd JSON file
+   in the archive storage (files are never modified afterwards),
+2. one short transaction records the file as an ArchiveSegment and deletes
+   the messages. If one of them was deleted in between, the transaction is
+   rolled back and the file removed; the next run retries.
+
+The archived messages of a conversation therefore always precede its live
+ones in history order ``(timestamp, id)``. History reads stay transparent:
+a page that runs out of live messages continues into the segments (see
+``extend_page``), with the same cursors. Decoded segments are kept in a
+small LRU, as pages usually walk through them in order. Senders are
+resolved when read, so renamed users show their current name and the
+messages of deleted users disappear, like their live ones do.
+
+Resuming a socket can't replay archived messages; ``archived_through``
+lets the replay ask the client to reload history instead. Archived
+messages are no longer found by search (chat/search.py joins its index back
+to the live tables).
+
+Segment files go to the storage named ``STORAGE`` in ``settings.STORAGES``
+(e.g. object storage, for several workers), or by default to a
+FileSystemStorage under ``ROOT``.
+"""
+
+import gzip
+import json
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage, storages
+from django.db import transaction
+from django.db.models import Max, Q
+
+from .models import ArchiveSegment, GroupMessage, PersonalChat, message_database
+from .pagination import decode_cursor, encode_cursor, with_senders
+
+DEFAULTS = {
+    "AGE_DAYS": 90,  # messages older than this are archived
+    "SEGMENT_SIZE": 1000,  # most messages per segment file
+    "STORAGE": None,  # alias in settings.STORAGES; None: a FileSystemStorage under ROOT
+    "ROOT": "archive",
+}
+
+# decoded segments kept in memory
+CACHED_SEGMENTS = 64
+
+# columns of a stored message, in the order of a segment's row lists
+ROW_FIELDS = ("id", "seq", "timestamp", "sender_id", "message")
+
+
+class ArchiveConflict(Exception):
+    """Messages changed while their segment was being written"""
+
+
+def conversation_messages(key):
+    """The live messages of sequence key ``key`` ("personal:<key>" / "guild:<id>")"""
+    kind, _, ident = key.partition(":")
+    if kind == "personal":
+        return PersonalChat.objects.filter(conversation_key=ident)
+    return GroupMessage.objects.filter(group_id=int(ident))
+
+
+def segment_name(key, first_seq, last_seq):
+    kind, _, ident = key.partition(":")
+    return f"{kind}/{ident}/{first_seq or 0:012d}-{last_seq or 0:012d}.json.gz"
+
+
+class MessageArchive:
+    def __init__(self, storage, segment_size):
+        self.storage = storage
+        self.segment_size = segment_size
+        self._segments = OrderedDict()
+        # views read in worker threads
+        self._lock = threading.Lock()
+
+    # Writing
+
+    def archive_conversation(self, key, cutoff, pause=0):
+        """
+        Move ``key``'s messages older than ``cutoff`` into new segments,
+        sleeping ``pause`` seconds after each; returns how many were moved
+        """
+        messages = conversation_messages(key).filter(timestamp__lt=cutoff)
+        archived = 0
+        while True:
+            rows = list(
+                messages.order_by("timestamp", "id").values_list(*ROW_FIELDS)[:self.segment_size]
+            )
+            if not rows:
+                return archived
+            self.write_segment(key, rows)
+            archived += len(rows)
+            if pause:
+                time.sleep(pause)
+            if len(rows) < self.segment_size:
+                return archived
+
+    def write_segment(self, key, rows):
+        """Store ``rows`` (ROW_FIELDS tuples, oldest first) as one segment and delete their messages"""
+        first, last = rows[0], rows[-1]
+        payload = gzip.compress(json.dumps(
+            [[pk, seq, timestamp.isoformat(), sender_id, message] for pk, seq, timestamp, sender_id, message in rows],
+            separators=(",", ":"),
+        ).encode())
+        name = self.storage.save(segment_name(key, first[1], last[1]), ContentFile(payload))
+        try:
+            with transaction.atomic(using=message_database()):
+                ArchiveSegment.objects.create(
+                    key=key, name=name, count=len(rows), size=len(payload),
+                    first_seq=first[1], last_seq=last[1],
+                    first_timestamp=first[2], first_id=first[0],
+                    last_timestamp=last[2], last_id=last[0],
+                )
+                ids = [row[0] for row in rows]
+                deleted, _ = conversation_messages(key).filter(id__in=ids).delete()
+                if deleted != len(ids):
+                    raise ArchiveConflict(key)
+        except BaseException:
+            self.storage.delete(name)
+            raise
+        return name
+
+    def discard_guild(self, guild_id):
+        """Delete a deleted guild's segments, like its messages were"""
+        self._discard(ArchiveSegment.objects.filter(key=f"guild:{guild_id}"))
+
+    def discard_user(self, user_id):
+        """Delete the segments of a deleted user's personal conversations"""
+        # conversation keys are "<low id>_<high id>"
+        self._discard(ArchiveSegment.objects.filter(
+            Q(key__startswith=f"personal:{user_id}_") | Q(key__startswith="personal:", key__endswith=f"_{user_id}")
+        ))
+
+    def _discard(self, segments):
+        segments = list(segments.values_list("id", "name"))
+        if not segments:
+            return
+        ArchiveSegment.objects.filter(id__in=[pk for pk, _ in segments]).delete()
+        # the files go once the rows are gone for good
+        transaction.on_commit(lambda: [self.storage.delete(name) for _, name in segments], using=message_database())
+
+    # Reading
+
+    def load(self, name):
+        """A segment's rows as ROW_FIELDS tuples, oldest first"""
+        with self._lock:
+            rows = self._segments.get(name)
+            if rows is not None:
+                self._segments.move_to_end(name)
+                return rows
+        with self.storage.open(name, "rb") as file:
+            rows = tuple(
+                (pk, seq, datetime.fromisoformat(timestamp), sender_id, message)
+                for pk, seq, timestamp, sender_id, message in json.loads(gzip.decompress(file.read()))
+            )
+        with self._lock:
+            self._segments[name] = rows
+            while len(self._segments) > CACHED_SEGMENTS:
+                self._segments.popitem(last=False)
+        return rows
+
+    def rows_before(self, key, before, count):
+        """
+        Up to ``count`` archived messages of ``key`` older than ``before`` (a
+        ``(timestamp, id)`` pair, or None for the newest), oldest first
+        """
+        segments = ArchiveSegment.objects.filter(key=key)
+        if before is not None:
+            timestamp, pk = before
+            segments = segments.filter(Q(first_timestamp__lt=timestamp) | Q(first_timestamp=timestamp, first_id__lt=pk))
+        rows = []
+        for name in segments.order_by("-last_timestamp", "-last_id").values_list("name", flat=True).iterator():
+            older = self.load(name)
+            if before is not None:
+                older = [row for row in older if (row[2], row[0]) < before]
+            rows[:0] = older
+            if len(rows) >= count:
+                break
+        return rows[-count:] if count else []
+
+    def history_rows(self, rows):
+        """History rows (pagination.MESSAGE_FIELDS) of archived messages whose sender still exists"""
+        return with_senders([
+            {"id": pk, "seq": seq, "message": message, "timestamp": timestamp, "sender_id": sender_id}
+            for pk, seq, timestamp, sender_id, message in rows
+        ])
+
+    def extend_page(self, key, page, before, limit):
+        """
+        ``page`` (``paginate_messages`` over the live messages of ``key``),
+        topped up from the archive if it ran out of live messages
+        """
+        rows, next_cursor = page
+        if next_cursor is not None:
+            return page
+        if rows:
+            boundary = (rows[0]["timestamp"], rows[0]["id"])
+        else:
+            boundary = decode_cursor(before) if before else None
+        # one extra row tells whether there is a further page
+        wanted = limit - len(rows)
+        older = self.rows_before(key, boundary, wanted + 1)
+        if not older:
+            return page
+        window = older[-wanted:] if wanted else []
+        if len(older) > wanted:
+            # from the stored rows: history_rows may leave some out
+            next_cursor = encode_cursor(*((window[0][2], window[0][0]) if window else boundary))
+        return self.history_rows(window) + rows, next_cursor
+
+    def archived_through(self, key):
+        """Highest seq archived in conversation ``key`` (0 if none)"""
+        return ArchiveSegment.objects.filter(key=key).aggregate(seq=Max("last_seq"))["seq"] or 0
+
+
+def archive_options():
+    return {**DEFAULTS, **getattr(settings, "CHAT_ARCHIVE", {})}
+
+
+_archive = None
+_archive_lock = threading.Lock()
+
+
+def get_archive():
+    """Return the process-wide message archive, creating it from settings on first use."""
+    global _archive
+    if _archive is None:
+        with _archive_lock:
+            if _archive is None:
+                options = archive_options()
+                if options["STORAGE"]:
+                    storage = storages[options["STORAGE"]]
+                else:
+                    storage = FileSystemStorage(location=options["ROOT"])
+                _archive = MessageArchive(storage, options["SEGMENT_SIZE"])
+    return _archive
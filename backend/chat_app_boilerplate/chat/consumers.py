@@ -1,222 +1,872 @@
-import json
+import time
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from .models import Chat_Group, PersonalChat, GroupMessage
+from chat_app_boilerplate.database import database_read_async
+from chat_app_boilerplate.logs import ais_traced, get_event_logger
+from .archive import get_archive
+from .fanout import group_send_all, member_group, shard_groups
+from .metrics import (
+    WS_CONNECTIONS,
+    WS_CONNECTS,
+    WS_DB_WRITE_SECONDS,
+    WS_GROUP_SEND_SECONDS,
+    WS_MESSAGES_BROADCAST,
+    WS_MESSAGES_RECEIVED,
+    WS_REJECTS,
+    WS_THROTTLED,
+)
+from .models import Chat_Group, PersonalChat, GroupMessage, conversation_key, is_active_member
+from .outbox import Frame, Outbox, outbox_options
+from .pagination import messages_after, serialize_message
+from .persistence import get_writer
+from .protocols import JSON, InvalidFrame, chat_message_event, negotiate
+from .throttle import get_flood_control
 
 User = get_user_model()
+log = get_event_logger(__name__)
 
 
-class PersonalChatConsumer(AsyncWebsocketConsumer):
+def guild_group_name(guild_id):
+    """Channel layer group shared by every socket connected to a guild"""
+    return f"group_{guild_id}"
+
+
+def guild_groups(guild):
+    """The groups carrying a guild's messages; large guilds have several (chat/fanout.py)"""
+    return shard_groups(guild_group_name(guild.id), guild.max_members)
+
+
+def guild_member_group(guild, user_id):
+    """The group of ``guild`` that the sockets of ``user_id`` join"""
+    return member_group(guild_group_name(guild.id), guild.max_members, user_id)
+
+
+def peer_group_name(user_id):
+    """Channel layer group of the sockets that have ``user_id`` as their peer"""
+    return f"peer_{user_id}"
+
+
+def user_group_name(user_id):
+    """Channel layer group of every socket ``user_id`` has open (control messages)"""
+    return f"user_{user_id}"
+
+
+def personal_group_name(key):
+    """Channel layer group of a personal conversation, by conversation key"""
+    return f"chat_personal_{key}"
+
+
+@database_read_async
+def missed_messages(queryset, sequence_key, after_seq):
+    """
+    Serialized messages after ``after_seq``, or None if too many were missed
+    or some of them are archived already
+    """
+    if after_seq < get_archive().archived_through(sequence_key):
+        return None
+    limit = getattr(settings, "CHAT_RESUME_MAX_REPLAY", 500)
+    rows = messages_after(queryset, after_seq, limit)
+    if rows is None:
+        return None
+    return [serialize_message(row) for row in rows]
+
+
+class ResumeMixin:
+    """
+    Lets a reconnecting client catch up with ``?resume_from=<seq>``.
+
+    The socket joins its room group before replaying, so nothing sent in
+    between is lost; live messages the replay already delivered are skipped.
+    ``replay`` and ``already_replayed`` keep their position in ``last_seq``
+    of the consumer, or of a StreamConsumer's subscription.
+    """
+
+    last_seq = None
+
+    def requested_resume_from(self):
+        query = parse_qs(self.scope.get("query_string", b"").decode())
+        try:
+            return int(query["resume_from"][0])
+        except (KeyError, ValueError):
+            return None
+
+    async def replay_missed(self, queryset, sequence_key):
+        resume_from = self.requested_resume_from()
+        if resume_from is not None:
+            await self.replay(self, queryset, sequence_key, resume_from)
+
+    async def replay(self, position, queryset, sequence_key, resume_from, channel=None):
+        """Queue the messages after ``resume_from``, advancing ``position.last_seq``"""
+        position.last_seq = resume_from
+        frames = await missed_messages(queryset, sequence_key, resume_from)
+        if frames is None:
+            # Too far behind; the client reloads history instead
+            self.queue_frame(self.resync_frame(channel, resume_from), channel=channel, droppable=False)
+            return
+        for frame in frames:
+            if channel is not None:
+                frame = {"type": "message", "channel": channel, **frame}
+            if not await self.queue_replayed(frame, channel=channel, seq=frame["seq"]):
+                return
+            position.last_seq = frame["seq"]
+
+    def already_replayed(self, event, position=None):
+        last_seq = (position or self).last_seq
+        seq = event.get("seq")
+        return seq is not None and last_seq is not None and seq <= last_seq
+
+
+class MetricsMixin:
+    """Connection and message metrics (chat/metrics.py), labelled with ``consumer_type``"""
+
+    consumer_type = None
+    counted = False
+
+    async def reject(self, reason, **fields):
+        """Refuse the connection, counting and logging why"""
+        WS_REJECTS.labels(self.consumer_type, reason).inc()
+        log.event("ws.connect.rejected", consumer=self.consumer_type, reason=reason, **fields)
+        await self.close()
+
+    def connection_opened(self):
+        self.counted = True
+        WS_CONNECTS.labels(self.consumer_type).inc()
+        WS_CONNECTIONS.labels(self.consumer_type).inc()
+
+    def connection_closed(self):
+        if self.counted:
+            self.counted = False
+            WS_CONNECTIONS.labels(self.consumer_type).dec()
+
+    async def write_message(self, row):
+        started = time.perf_counter()
+        try:
+            await get_writer().write(row)
+        finally:
+            WS_DB_WRITE_SECONDS.labels(self.consumer_type).observe_since(started)
+
+    async def broadcast(self, groups, event):
+        started = time.perf_counter()
+        await group_send_all(self.channel_layer, groups, event)
+        WS_GROUP_SEND_SECONDS.labels(self.consumer_type).observe_since(started)
+        WS_MESSAGES_BROADCAST.labels(self.consumer_type).inc()
+
+
+class ProtocolMixin:
+    """
+    The connection's wire format (chat/protocols.py), negotiated from the
+    WebSocket subprotocols the client offered; JSON by default
+    """
+
+    protocol = JSON
+
+    async def accept_protocol(self):
+        self.protocol, subprotocol = negotiate(self.scope.get("subprotocols", []))
+        await self.accept(subprotocol)
+
+    def decode_frame(self, text_data=None, bytes_data=None):
+        """The frame received from the client; raises InvalidFrame"""
+        return self.protocol.decode(text_data, bytes_data)
+
+
+class OutboxMixin(ProtocolMixin):
+    """
+    Sends frames through a bounded per-connection Outbox (chat/outbox.py),
+    so a slow client never blocks the consumer or grows without limit
+    """
+
+    outbox = None
+    replay_timeout = None
+
+    def start_outbox(self):
+        options = outbox_options()
+        self.replay_timeout = options["REPLAY_TIMEOUT"]
+        self.outbox = Outbox(
+            self.send_data,
+            self.close,
+            self.consumer_type,
+            max_frames=options["MAX_FRAMES"],
+            hard_limit=options["HARD_LIMIT"],
+            policy=options["POLICY"],
+            marker=lambda channel, resume_from: self.protocol.encode(self.resync_frame(channel, resume_from)),
+        )
+        self.outbox.start()
+
+    async def stop_outbox(self):
+        if self.outbox is not None:
+            await self.outbox.stop()
+
+    def queue_frame(self, payload, channel=None, seq=None, droppable=True):
+        """Queue ``payload`` for the client; chat messages are ``droppable``"""
+        self.queue_data(self.protocol.encode(payload), channel, seq, droppable)
+
+    def queue_message(self, event, channel=None, seq=None):
+        """Queue the frame of a ``chat_message`` event"""
+        self.queue_data(self.protocol.encode_message(event, channel), channel, seq)
+
+    def queue_data(self, data, channel=None, seq=None, droppable=True):
+        """Queue an already serialized frame"""
+        if self.outbox is not None:
+            self.outbox.put(Frame(data, channel, seq, droppable))
+
+    async def queue_replayed(self, payload, channel=None, seq=None):
+        """
+        Queue a message of a resume replay once the outbox has room for it;
+        False if the socket was closed as too slow instead
+        """
+        if self.outbox is None or not await self.outbox.wait_for_room(self.replay_timeout):
+            return False
+        self.queue_frame(payload, channel, seq)
+        return True
+
+    async def send_data(self, data):
+        if isinstance(data, bytes):
+            await self.send(bytes_data=data)
+        else:
+            await self.send(text_data=data)
+
+    def resync_frame(self, channel, resume_from):
+        """Sent in place of messages coalesced away by a full outbox"""
+        return {"type": "resync_required", "resume_from": resume_from}
+
+    def error_frame(self, channel, error):
+        return {"type": "error", "error": error}
+
+    async def send_error(self, channel, error):
+        """Queue an error frame; never dropped by the outbox"""
+        self.queue_frame(self.error_frame(channel, error), channel=channel, droppable=False)
+
+
+class FloodControlMixin:
+    """
+    Rate-limits the messages a socket sends (chat/throttle.py). A refused
+    message is answered with a ``throttled`` frame; further messages refused
+    before its ``retry_after`` has passed are dropped without another one.
+    """
+
+    flood_bucket = None
+    throttled_until = 0.0
+
+    def start_flood_control(self):
+        self.flood_bucket = get_flood_control().connection_bucket()
+
+    def throttled(self, guild_id=None, channel=None):
+        """True if this message exceeds a rate limit and must not be sent"""
+        refused = get_flood_control().check(self.flood_bucket, self.user.id, guild_id)
+        if refused is None:
+            return False
+
+        limit, retry_after = refused
+        WS_THROTTLED.labels(self.consumer_type, limit).inc()
+        now = time.monotonic()
+        if now >= self.throttled_until:
+            self.throttled_until = now + retry_after
+            log.event(
+                "ws.message.throttled", trace=self.trace, consumer=self.consumer_type,
+                user=self.user.id, limit=limit, retry_after=round(retry_after, 3),
+            )
+            self.queue_frame(
+                self.throttle_frame(channel, limit, round(retry_after, 3)), channel=channel, droppable=False,
+            )
+        return True
+
+    def throttle_frame(self, channel, limit, retry_after):
+        return {"type": "throttled", "limit": limit, "retry_after": retry_after}
+
+
+class TraceMixin:
+    """
+    Per-connection debug tracing, switchable at runtime.
+
+    Every socket joins its user's control group; a staff request to
+    ``chat/debug/trace/`` sends ``trace.set`` there, which flips ``trace`` on
+    all of that user's open connections. Traced connections log every event
+    at INFO, unsampled.
+    """
+
+    trace = False
+    control_group_name = None
+
+    async def join_control_group(self):
+        self.trace = await ais_traced(self.user.id)
+        self.control_group_name = user_group_name(self.user.id)
+        await self.channel_layer.group_add(self.control_group_name, self.channel_name)
+
+    async def leave_control_group(self):
+        if self.control_group_name:
+            await self.channel_layer.group_discard(self.control_group_name, self.channel_name)
+
+    async def trace_set(self, event):
+        self.trace = bool(event.get("enabled"))
+        log.event("ws.trace", user=self.user.id, channel=self.channel_name, enabled=self.trace)
+
+
+class PersonalChatConsumer(OutboxMixin, MetricsMixin, FloodControlMixin, TraceMixin, ResumeMixin, AsyncWebsocketConsumer):
+    consumer_type = "personal"
+
     async def connect(self):
-        print("=" * 50)
-        print("🔌 WebSocket Connection Attempt")
-        print("=" * 50)
-        
         self.user = self.scope["user"]
-        print(f"👤 User from scope: {self.user}")
-        print(f"🔐 Is authenticated: {self.user.is_authenticated}")
+        log.event("ws.connect", consumer="personal", path=self.scope.get("path"))
         
         # Check if user is authenticated
         if not self.user.is_authenticated:
-            print("❌ User not authenticated - closing connection")
-            await self.close()
+            await self.reject("unauthenticated")
             return
         
         # Get other user's email from URL
         self.other_user_email = self.scope["url_route"]["kwargs"]["user_email"]
-        print(f"👥 Other user email: {self.other_user_email}")
-        
-        # Create room name using emails (sorted for consistency)
-        emails = sorted([self.user.email, self.other_user_email])
-        self.room_name = f"personal_{emails[0]}_{emails[1]}"
-        self.room_group_name = f"chat_{self.room_name}"
-        
-        print(f"🏠 Room name: {self.room_name}")
-        print(f"📢 Room group name: {self.room_group_name}")
+
+        # The user may come from the token cache; deactivation is checked here
+        if not await database_read_async(is_active_member)(self.user.id):
+            await self.reject("inactive", user=self.user.id)
+            return
+
+        # Resolve the peer once; receive() reuses it until it is invalidated
+        self.other_user = await self.resolve_other_user()
+        if self.other_user is None:
+            await self.reject("peer_not_found", user=self.user.id)
+            return
+
+        # Create room name from the conversation key (sorted user ids) - emails
+        # contain "@", which is not allowed in channel layer group names
+        self.conversation_key = conversation_key(self.user.id, self.other_user.id)
+        self.room_name = f"personal_{self.conversation_key}"
+        self.room_group_name = personal_group_name(self.conversation_key)
+        self.peer_group_name = peer_group_name(self.other_user.id)
 
+        await self.channel_layer.group_add(
+            self.peer_group_name, self.channel_name
+        )
         await self.channel_layer.group_add(
             self.room_group_name, self.channel_name
         )
-        
-        print(f"✅ Added to group: {self.room_group_name}")
-        await self.accept()
-        print(f"✅ WebSocket connection accepted for {self.user.email}")
-        print("=" * 50)
+        await self.join_control_group()
+        await self.accept_protocol()
+        self.start_outbox()
+        self.start_flood_control()
+        self.connection_opened()
+        log.event(
+            "ws.connect.accepted", trace=self.trace, consumer="personal",
+            user=self.user.id, room=self.room_group_name,
+        )
+
+        # Catch up a reconnecting client (?resume_from=<seq>) before live delivery
+        await self.replay_missed(
+            PersonalChat.objects.filter(conversation_key=self.conversation_key),
+            f"personal:{self.conversation_key}",
+        )
 
     async def disconnect(self, close_code):
-        print(f"❌ WebSocket disconnecting: {self.user.email if hasattr(self, 'user') else 'Unknown'}")
-        print(f"   Close code: {close_code}")
-        
         if hasattr(self, 'room_group_name'):
             await self.channel_layer.group_discard(
                 self.room_group_name, self.channel_name
             )
-            print(f"🗑️ Removed from group: {self.room_group_name}")
+            log.event(
+                "ws.disconnect", trace=self.trace, consumer="personal",
+                user=self.user.id, room=self.room_group_name, code=close_code,
+            )
 
-    async def receive(self, text_data):
-        print("=" * 50)
-        print("📨 Message Received")
-        print("=" * 50)
-        print(f"📦 Raw data: {text_data}")
-        
+        if hasattr(self, 'peer_group_name'):
+            await self.channel_layer.group_discard(
+                self.peer_group_name, self.channel_name
+            )
+        await self.leave_control_group()
+        await self.stop_outbox()
+        self.connection_closed()
+
+        # Don't leave this connection's messages sitting in the write buffer
+        await get_writer().flush()
+
+    async def receive(self, text_data=None, bytes_data=None):
         try:
-            data = json.loads(text_data)
-            print(f"✅ Parsed data: {data}")
-        except json.JSONDecodeError as e:
-            print(f"❌ JSON decode error: {e}")
+            data = self.decode_frame(text_data, bytes_data)
+        except InvalidFrame:
+            log.event("ws.message.invalid", trace=self.trace, user=self.user.id, reason="invalid_frame")
             return
         
         message = data.get("message")
         if not message:
-            print("❌ No message in data")
+            log.event("ws.message.invalid", trace=self.trace, user=self.user.id, reason="empty_message")
+            return
+        if not isinstance(message, str):
+            log.event("ws.message.invalid", trace=self.trace, user=self.user.id, reason="not_text")
+            return
+
+        if self.throttled():
             return
-        
-        print(f"💬 Message: {message}")
-        print(f"👤 Sender: {self.user.email}")
-        print(f"👥 Receiver: {self.other_user_email}")
+
+        WS_MESSAGES_RECEIVED.labels(self.consumer_type).inc()
+        log.event(
+            "ws.message.received", sampled=True, trace=self.trace,
+            user=self.user.id, room=self.room_group_name, size=len(message),
+        )
 
         sender = self.user
-        
-        try:
-            receiver = await database_sync_to_async(User.objects.get)(email=self.other_user_email)
-            print(f"✅ Receiver found: {receiver.email}")
-        except User.DoesNotExist:
-            print(f"❌ Receiver not found: {self.other_user_email}")
+
+        # Cached at connect; only hits the database again after invalidation
+        if self.other_user is None:
+            self.other_user = await self.resolve_other_user()
+        receiver = self.other_user
+        if receiver is None:
+            log.event("ws.message.invalid", trace=self.trace, user=self.user.id, reason="peer_not_found")
             return
 
-        # Save to database
+        # Save to database (batched by the write-behind writer)
+        row = PersonalChat(
+            sender=sender,
+            receiver=receiver,
+            conversation_key=self.conversation_key,
+            message=message,
+        )
         try:
-            await database_sync_to_async(PersonalChat.objects.create)(
-                sender=sender, receiver=receiver, message=message
+            await self.write_message(row)
+        except Exception:
+            log.event(
+                "ws.message.persist_failed", user=self.user.id,
+                room=self.room_group_name, exc_info=True,
             )
-            print("✅ Message saved to database")
-        except Exception as e:
-            print(f"❌ Error saving to database: {e}")
+            # Only the sender learns about it; nobody gets a message without a seq
+            await self.send_error(None, "Message could not be saved")
+            return
 
         # Broadcast to group
-        broadcast_data = {
-            "type": "chat_message",
-            "message": message,
-            "sender": sender.email,
-            "sender_name": sender.name,
-            "timestamp": data.get("timestamp", "")
-        }
-        
-        print(f"📢 Broadcasting to group: {self.room_group_name}")
-        print(f"📦 Broadcast data: {broadcast_data}")
-        
+        broadcast_data = chat_message_event(
+            self.room_group_name, sender, message, data.get("timestamp", ""), row.seq,
+        )
+
         try:
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                broadcast_data
+            await self.broadcast([self.room_group_name], broadcast_data)
+        except Exception:
+            log.event(
+                "ws.message.broadcast_failed", user=self.user.id,
+                room=self.room_group_name, exc_info=True,
             )
-            print("✅ Message broadcasted successfully")
-        except Exception as e:
-            print(f"❌ Error broadcasting: {e}")
-        
-        print("=" * 50)
+            return
+        log.event(
+            "ws.message.broadcast", sampled=True, trace=self.trace,
+            room=self.room_group_name, seq=row.seq,
+        )
 
     async def chat_message(self, event):
-        print(f"📤 Sending message to client: {event}")
-        
-        await self.send(text_data=json.dumps({
-            "message": event["message"],
-            "sender": event["sender"],
-            "sender_name": event["sender_name"],
-            "timestamp": event["timestamp"]
-        }))
-        
-        print("✅ Message sent to client")
+        if self.already_replayed(event):
+            return
+
+        self.queue_message(event, seq=event.get("seq"))
+        log.event(
+            "ws.message.sent", sampled=True, trace=self.trace,
+            user=self.user.id, room=self.room_group_name, seq=event.get("seq"),
+        )
+
+    async def peer_invalidated(self, event):
+        """The peer was deactivated or deleted - drop the cached instance"""
+        log.event("ws.peer.invalidated", trace=self.trace, user=self.user.id, peer=event.get("user_id"))
+        self.other_user = None
+
+    @database_read_async
+    def resolve_other_user(self):
+        return User.objects.filter(email=self.other_user_email, is_active=True).first()
 
 
-class GroupChatConsumer(AsyncWebsocketConsumer):
+class GroupChatConsumer(OutboxMixin, MetricsMixin, FloodControlMixin, TraceMixin, ResumeMixin, AsyncWebsocketConsumer):
+    consumer_type = "guild"
+
     async def connect(self):
-        print("=" * 50)
-        print("🏰 Guild WebSocket Connection Attempt")
-        print("=" * 50)
-        
         self.user = self.scope["user"]
-        print(f"👤 User from scope: {self.user}")
-        print(f"🔐 Is authenticated: {self.user.is_authenticated}")
+        log.event("ws.connect", consumer="guild", path=self.scope.get("path"))
         
         if not self.user.is_authenticated:
-            print("❌ User not authenticated - closing connection")
-            await self.close()
+            await self.reject("unauthenticated")
             return
         
         # Get group name from URL and decode it (handles URL encoding like %20 for spaces)
         from urllib.parse import unquote
         self.group_name = unquote(self.scope["url_route"]["kwargs"]["group_name"])
-        self.room_group_name = f"group_{self.group_name}"
-        
-        print(f"🏰 Guild name (decoded): {self.group_name}")
-        print(f"📢 Room group name: {self.room_group_name}")
 
-        try:
-            group = await database_sync_to_async(Chat_Group.objects.get)(name=self.group_name)
-            print(f"✅ Guild found: {group.name}")
-        except Chat_Group.DoesNotExist:
-            print(f"❌ Guild not found: {self.group_name}")
-            await self.close()
+        # Loaded once per connection; receive() writes against this instance
+        self.group = await database_read_async(
+            Chat_Group.objects.filter(name=self.group_name).first
+        )()
+        if self.group is None:
+            await self.reject("guild_not_found", user=self.user.id)
             return
 
-        # Check if user is a member
-        is_member = await database_sync_to_async(
-            lambda: group.members.filter(id=self.user.id).exists()
-        )()
-        
-        if not is_member:
-            print(f"❌ User {self.user.email} is not a member of {self.group_name}")
-            await self.close()
+        # Guild names may contain spaces, which channel layer group names can't
+        self.room_group_name = guild_group_name(self.group.id)
+        # the socket joins one shard of large guilds; events still name the room
+        self.shard_group_name = guild_member_group(self.group, self.user.id)
+
+        # The user row may come from the token cache; membership is checked in the database
+        if not await database_read_async(is_active_member)(self.user.id, self.group.id):
+            await self.reject("not_a_member", user=self.user.id, guild=self.group.id)
             return
-        
-        print(f"✅ User is member of guild")
 
         await self.channel_layer.group_add(
-            self.room_group_name, self.channel_name
+            self.shard_group_name, self.channel_name
+        )
+        await self.join_control_group()
+        await self.accept_protocol()
+        self.start_outbox()
+        self.start_flood_control()
+        self.connection_opened()
+        log.event(
+            "ws.connect.accepted", trace=self.trace, consumer="guild",
+            user=self.user.id, room=self.room_group_name,
         )
-        
-        print(f"✅ Added to group: {self.room_group_name}")
-        await self.accept()
-        print(f"✅ WebSocket connection accepted for {self.user.email} in guild {self.group_name}")
-        print("=" * 50)
+
+        # Catch up a reconnecting client (?resume_from=<seq>) before live delivery
+        await self.replay_missed(GroupMessage.objects.filter(group=self.group), f"guild:{self.group.id}")
 
     async def disconnect(self, close_code):
-        await self.channel_layer.group_discard(
-            self.room_group_name, self.channel_name
+        if hasattr(self, 'shard_group_name'):
+            await self.channel_layer.group_discard(
+                self.shard_group_name, self.channel_name
+            )
+            log.event(
+                "ws.disconnect", trace=self.trace, consumer="guild",
+                user=self.user.id, room=self.room_group_name, code=close_code,
+            )
+        await self.leave_control_group()
+        await self.stop_outbox()
+        self.connection_closed()
+        await get_writer().flush()
+
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            data = self.decode_frame(text_data, bytes_data)
+            message = data["message"]
+        except (InvalidFrame, KeyError):
+            log.event("ws.message.invalid", trace=self.trace, user=self.user.id, reason="invalid_frame")
+            return
+        if not isinstance(message, str):
+            log.event("ws.message.invalid", trace=self.trace, user=self.user.id, reason="not_text")
+            return
+
+        if self.group is None:
+            return
+
+        if self.throttled(guild_id=self.group.id):
+            return
+
+        WS_MESSAGES_RECEIVED.labels(self.consumer_type).inc()
+        log.event(
+            "ws.message.received", sampled=True, trace=self.trace,
+            user=self.user.id, room=self.room_group_name, size=len(message),
+        )
+
+        row = GroupMessage(group=self.group, sender=self.user, message=message)
+        try:
+            await self.write_message(row)
+        except Exception:
+            log.event(
+                "ws.message.persist_failed", user=self.user.id,
+                room=self.room_group_name, exc_info=True,
+            )
+            await self.send_error(None, "Message could not be saved")
+            return
+
+        await self.broadcast(
+            guild_groups(self.group),
+            chat_message_event(self.room_group_name, self.user, message, data.get("timestamp", ""), row.seq),
+        )
+        log.event(
+            "ws.message.broadcast", sampled=True, trace=self.trace,
+            room=self.room_group_name, seq=row.seq,
+        )
+
+    async def chat_message(self, event):
+        if self.already_replayed(event):
+            return
+
+        self.queue_message(event, seq=event.get("seq"))
+        log.event(
+            "ws.message.sent", sampled=True, trace=self.trace,
+            user=self.user.id, room=self.room_group_name, seq=event.get("seq"),
         )
 
-    async def receive(self, text_data):
-        data = json.loads(text_data)
-        message = data["message"]
+    async def guild_deleted(self, event):
+        """The guild was deleted while this socket was open"""
+        self.group = None
+        await self.close()
+
+
+class Subscription:
+    """One conversation a StreamConsumer is subscribed to"""
+
+    def __init__(self, channel, kind, room, target, key=None, watch=None, group=None, groups=None):
+        self.channel = channel  # id the client used, echoed on every frame
+        self.kind = kind  # "personal" or "guild"
+        self.room = room  # group of the conversation, the "room" of its events
+        self.group = group or room  # the group this socket joins: a shard of ``room`` for large guilds
+        self.groups = groups or [room]  # every group a message is sent to
+        self.target = target  # peer user or Chat_Group, None once invalidated
+        self.key = key  # conversation key of personal chats
+        self.watch = watch  # peer_<id> group for personal chats
+        self.last_seq = None  # highest seq replayed after a resume
+
+
+class StreamConsumer(OutboxMixin, MetricsMixin, FloodControlMixin, TraceMixin, ResumeMixin, AsyncWebsocketConsumer):
+    """
+    One WebSocket per user, multiplexing any number of conversations.
+
+    The socket authenticates once; the client then manages conversations
+    with frames like these (JSON, or MessagePack on "chat.msgpack" sockets):
+
+        {"action": "subscribe", "channel": "personal:<email>" | "guild:<id>", "resume_from": <seq>}
+        {"action": "unsubscribe", "channel": "..."}
+        {"action": "send", "channel": "...", "message": "...", "timestamp": "..."}
+
+    Every server frame is tagged with the channel id it belongs to:
+
+        {"type": "message", "channel": "...", "message", "sender", "sender_name", "timestamp"}
+        {"type": "subscribed" | "unsubscribed", "channel": "..."}
+        {"type": "error", "channel": "...", "error": "..."}
+        {"type": "resync_required", "channel": "...", "resume_from": <seq>}
+        {"type": "throttled", "channel": "...", "limit": "connection" | "user" | "guild", "retry_after": <seconds>}
+
+    Subscriptions join the same channel layer groups as PersonalChatConsumer
+    and GroupChatConsumer, so stream and per-room sockets talk to each other.
+    An optional ``resume_from`` replays the messages after that seq right
+    after the "subscribed" frame (or sends "resync_required" if too many
+    were missed), also when already subscribed: that's how a client catches
+    up after a "resync_required" from its outbox.
+    """
+
+    consumer_type = "stream"
+
+    async def connect(self):
+        self.user = self.scope["user"]
+        log.event("ws.connect", consumer="stream", path=self.scope.get("path"))
+        if not self.user.is_authenticated:
+            await self.reject("unauthenticated")
+            return
+        # The user may come from the token cache; deactivation is checked here
+        if not await database_read_async(is_active_member)(self.user.id):
+            await self.reject("inactive", user=self.user.id)
+            return
+
+        self.subscriptions = {}  # channel id -> Subscription
+        self.rooms = {}  # channel layer group -> channel id
+        await self.join_control_group()
+        await self.accept_protocol()
+        self.start_outbox()
+        self.start_flood_control()
+        self.connection_opened()
+        log.event("ws.connect.accepted", trace=self.trace, consumer="stream", user=self.user.id)
+
+    async def disconnect(self, close_code):
+        subscriptions = getattr(self, "subscriptions", None)
+        if subscriptions is not None:
+            log.event(
+                "ws.disconnect", trace=self.trace, consumer="stream", user=self.user.id,
+                subscriptions=len(subscriptions), code=close_code,
+            )
+        for channel in list(subscriptions or {}):
+            await self.unsubscribe(channel)
+        await self.leave_control_group()
+        await self.stop_outbox()
+        self.connection_closed()
+        await get_writer().flush()
+
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            data = self.decode_frame(text_data, bytes_data)
+        except InvalidFrame:
+            log.event("ws.message.invalid", trace=self.trace, user=self.user.id, reason="invalid_frame")
+            await self.send_error(None, f"Invalid {self.protocol.name}")
+            return
+
+        action = data.get("action")
+        channel = data.get("channel")
+        if not isinstance(channel, str):
+            await self.send_error(None, "Missing channel")
+            return
+
+        if action == "subscribe":
+            await self.subscribe(channel, data.get("resume_from"))
+        elif action == "unsubscribe":
+            if await self.unsubscribe(channel):
+                await self.send_frame({"type": "unsubscribed", "channel": channel})
+        elif action == "send":
+            await self.send_message(channel, data)
+        else:
+            await self.send_error(channel, f"Unknown action: {action}")
+
+    async def subscribe(self, channel, resume_from=None):
+        if channel in self.subscriptions:
+            await self.send_frame({"type": "subscribed", "channel": channel})
+            if isinstance(resume_from, int):
+                await self.replay_subscription(self.subscriptions[channel], resume_from)
+            return
+
+        limit = getattr(settings, "CHAT_STREAM_MAX_SUBSCRIPTIONS", 100)
+        if len(self.subscriptions) >= limit:
+            await self.send_error(channel, f"Too many subscriptions (max {limit})")
+            return
+
+        kind, _, ident = channel.partition(":")
+        if kind == "personal":
+            peer = await self.resolve_peer(ident)
+            if peer is None:
+                await self.send_error(channel, "User not found")
+                return
+            key = conversation_key(self.user.id, peer.id)
+            subscription = Subscription(
+                channel, kind, personal_group_name(key), peer,
+                key=key, watch=peer_group_name(peer.id),
+            )
+        elif kind == "guild":
+            guild = await self.resolve_guild(ident)
+            if guild is None:
+                await self.send_error(channel, "Guild not found or not a member")
+                return
+            subscription = Subscription(
+                channel, kind, guild_group_name(guild.id), guild,
+                group=guild_member_group(guild, self.user.id), groups=guild_groups(guild),
+            )
+        else:
+            await self.send_error(channel, "Unknown channel type")
+            return
+
+        if subscription.room in self.rooms:
+            await self.send_error(channel, f"Already subscribed as {self.rooms[subscription.room]}")
+            return
+
+        self.subscriptions[channel] = subscription
+        self.rooms[subscription.room] = channel
+        await self.channel_layer.group_add(subscription.group, self.channel_name)
+        if subscription.watch:
+            await self.channel_layer.group_add(subscription.watch, self.channel_name)
+        await self.send_frame({"type": "subscribed", "channel": channel})
+
+        if isinstance(resume_from, int):
+            await self.replay_subscription(subscription, resume_from)
+
+    async def replay_subscription(self, subscription, resume_from):
+        if subscription.kind == "personal":
+            queryset = PersonalChat.objects.filter(conversation_key=subscription.key)
+            sequence_key = f"personal:{subscription.key}"
+        else:
+            queryset = GroupMessage.objects.filter(group=subscription.target)
+            sequence_key = f"guild:{subscription.target.id}"
+        await self.replay(subscription, queryset, sequence_key, resume_from, channel=subscription.channel)
+
+    async def unsubscribe(self, channel):
+        subscription = self.subscriptions.pop(channel, None)
+        if subscription is None:
+            return False
 
-        group = await database_sync_to_async(Chat_Group.objects.get)(name=self.group_name)
-        await database_sync_to_async(GroupMessage.objects.create)(
-            group=group, sender=self.user, message=message
+        self.rooms.pop(subscription.room, None)
+        await self.channel_layer.group_discard(subscription.group, self.channel_name)
+        if subscription.watch:
+            await self.channel_layer.group_discard(subscription.watch, self.channel_name)
+        return True
+
+    async def send_message(self, channel, data):
+        subscription = self.subscriptions.get(channel)
+        if subscription is None:
+            await self.send_error(channel, "Not subscribed")
+            return
+
+        message = data.get("message")
+        if not message:
+            await self.send_error(channel, "Empty message")
+            return
+        if not isinstance(message, str):
+            await self.send_error(channel, "Message must be text")
+            return
+
+        guild_id = subscription.target.id if subscription.kind == "guild" else None
+        if self.throttled(guild_id=guild_id, channel=channel):
+            return
+
+        if subscription.kind == "personal":
+            # Re-resolve a peer whose cached instance was invalidated
+            if subscription.target is None:
+                subscription.target = await self.resolve_peer(channel.partition(":")[2])
+            if subscription.target is None:
+                await self.send_error(channel, "User not found")
+                return
+            row = PersonalChat(
+                sender=self.user,
+                receiver=subscription.target,
+                conversation_key=subscription.key,
+                message=message,
+            )
+        else:
+            row = GroupMessage(group=subscription.target, sender=self.user, message=message)
+
+        WS_MESSAGES_RECEIVED.labels(self.consumer_type).inc()
+        log.event(
+            "ws.message.received", sampled=True, trace=self.trace,
+            user=self.user.id, room=subscription.room, size=len(message),
         )
+        try:
+            await self.write_message(row)
+        except Exception:
+            log.event("ws.message.persist_failed", user=self.user.id, room=subscription.room, exc_info=True)
+            await self.send_error(channel, "Message could not be saved")
+            return
 
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                "type": "chat_message",
-                "message": message,
-                "sender": self.user.email,
-                "sender_name": self.user.name,
-                "timestamp": data.get("timestamp", "")
-            },
+        await self.broadcast(
+            subscription.groups,
+            chat_message_event(subscription.room, self.user, message, data.get("timestamp", ""), row.seq),
         )
+        log.event("ws.message.broadcast", sampled=True, trace=self.trace, room=subscription.room, seq=row.seq)
 
     async def chat_message(self, event):
-        await self.send(text_data=json.dumps({
-            "message": event["message"],
-            "sender": event["sender"],
-            "sender_name": event["sender_name"],
-            "timestamp": event["timestamp"]
-        }))
-
-    @database_sync_to_async
-    def add_member(self, group, user):
-        if group.members.count() >= 15:
-            raise ValueError("Group is full. Max 15 members allowed.")
-        group.members.add(user)
\ No newline at end of file
+        channel = self.rooms.get(event.get("room"))
+        if channel is None:
+            return  # raced with an unsubscribe
+
+        # Skip live copies of messages the resume replay already delivered
+        subscription = self.subscriptions[channel]
+        if self.already_replayed(event, subscription):
+            return
+        seq = event.get("seq")
+
+        self.queue_message(event, channel=channel, seq=seq)
+        log.event(
+            "ws.message.sent", sampled=True, trace=self.trace,
+            user=self.user.id, room=subscription.room, seq=seq,
+        )
+
+    async def guild_deleted(self, event):
+        channel = self.rooms.get(guild_group_name(event.get("guild_id")))
+        if channel is not None and await self.unsubscribe(channel):
+            await self.send_frame({"type": "unsubscribed", "channel": channel, "reason": "guild_deleted"})
+
+    async def peer_invalidated(self, event):
+        for subscription in self.subscriptions.values():
+            if subscription.kind == "personal" and subscription.watch == peer_group_name(event.get("user_id")):
+                subscription.target = None
+
+    async def send_frame(self, payload):
+        """Queue a control frame; these are never dropped by the outbox"""
+        self.queue_frame(payload, channel=payload.get("channel"), droppable=False)
+
+    def resync_frame(self, channel, resume_from):
+        return {"type": "resync_required", "channel": channel, "resume_from": resume_from}
+
+    def throttle_frame(self, channel, limit, retry_after):
+        return {"type": "throttled", "channel": channel, "limit": limit, "retry_after": retry_after}
+
+    def error_frame(self, channel, error):
+        return {"type": "error", "channel": channel, "error": error}
+
+    @database_read_async
+    def resolve_peer(self, email):
+        return User.objects.filter(email=email, is_active=True).first()
+
+    @database_read_async
+    def resolve_guild(self, ident):
+        """The guild with id ``ident`` if the user is currently a member of it"""
+        try:
+            guild_id = int(ident)
+        except ValueError:
+            return None
+        # Membership may have changed since the socket authenticated
+        if not is_active_member(self.user.id, guild_id):
+            return None
+        return Chat_Group.objects.filter(id=guild_id).first()
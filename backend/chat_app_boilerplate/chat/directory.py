@@ -0,0 +1,88 @@
+"""
+Guild directory listing.
+
+The guild browser is read far more often than guilds change, so pages of
+the directory are built with a single query (member counts come from the
+maintained ``Chat_Group.member_count`` column) and kept in the Django cache
+for a few seconds. Every page key embeds a directory version; creating,
+joining, leaving or deleting a guild bumps the version, which orphans all
+cached pages at once.
+"""
+
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+
+from .models import Chat_Group
+from .pagination import decode_cursor, encode_cursor
+
+VERSION_KEY = "chat:guild-directory:version"
+
+
+def _timeout():
+    return getattr(settings, "CHAT_GUILD_DIRECTORY_TTL", 30)
+
+
+def _version():
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, 1, timeout=None)
+        version = cache.get(VERSION_KEY, 1)
+    return version
+
+
+def invalidate_guild_directory():
+    """Drop every cached directory page"""
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        # no version yet, so nothing has been cached under one either
+        cache.add(VERSION_KEY, 1, timeout=None)
+
+
+def guild_directory_page(prefix="", after=None, limit=50):
+    """
+    Return ``(guilds, next_cursor)`` for one page of guilds ordered by
+    ``(name, id)``, optionally restricted to names starting with ``prefix``.
+
+    Raises ``InvalidCursor`` for a malformed ``after`` cursor.
+    """
+    if after:
+        decode_cursor(after, types=(str, int))  # validate before caching anything
+
+    # prefixes and cursors are user input; hash them into a memcached-safe key
+    query = hashlib.md5(f"{limit}|{prefix.lower()}|{after or ''}".encode()).hexdigest()
+    key = f"chat:guild-directory:{_version()}:{query}"
+    page = cache.get(key)
+    if page is None:
+        page = _build_page(prefix, after, limit)
+        cache.set(key, page, timeout=_timeout())
+    return page
+
+
+def _build_page(prefix, after, limit):
+    guilds = Chat_Group.objects.select_related("created_by")
+    if prefix:
+        guilds = guilds.filter(name__istartswith=prefix)
+    if after:
+        name, guild_id = decode_cursor(after, types=(str, int))
+        guilds = guilds.filter(Q(name__gt=name) | Q(name=name, id__gt=guild_id))
+
+    rows = list(guilds.order_by("name", "id")[:limit + 1])
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].name, rows[-1].id)
+
+    return [{
+        "id": guild.id,
+        "name": guild.name,
+        "description": guild.description or "No description",
+        "memberCount": guild.member_count,
+        "maxMembers": guild.max_members,
+        "isFull": guild.member_count >= guild.max_members,
+        "createdBy": guild.created_by.name if guild.created_by else "Unknown",
+        "createdAt": guild.created_at.isoformat(),
+    } for guild in rows], next_cursor
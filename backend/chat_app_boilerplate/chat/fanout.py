@@ -0,0 +1,86 @@
+"""
+Fan-out of guild messages to large guilds.
+
+A guild message is one ``group_send`` to the guild's channel layer group,
+which hands a copy to every socket in the group from that one call. That's
+fine at the default 15 members; for community guilds with thousands of
+members, one call and one group would carry the whole guild. Guilds whose
+``max_members`` is above ``SHARD_SIZE`` therefore spread their sockets over
+several groups, up to ``MAX_SHARDS``:
+
+* ``group_<id>.0``, ``group_<id>.1``, ...: ``ceil(max_members /
+  SHARD_SIZE)`` of them. A member's sockets all join shard ``user id %
+  shards``;
+* a broadcast is one ``group_send`` per shard, with at most
+  ``CONCURRENCY`` in flight. With the Redis channel layer the shards also
+  hash to different servers (chat_app_boilerplate/channel_layers.py).
+
+Guilds up to ``SHARD_SIZE`` members keep their single ``group_<id>`` group.
+
+Offline members cost nothing: groups only hold the sockets that are open,
+so a broadcast's work follows the members online, not ``member_count``.
+
+Every process must derive the same shards for a guild, so the shard count
+follows ``max_members``, which is set when the guild is created (up to
+``MAX_MEMBERS``, see ``GuildListView.post``). Sockets opened before a
+guild's ``max_members`` is changed miss its messages until they reconnect.
+
+Options come from ``settings.CHAT_GUILD_FANOUT``.
+"""
+
+import asyncio
+import math
+
+from django.conf import settings
+
+DEFAULTS = {
+    # largest max_members a new guild may ask for
+    "MAX_MEMBERS": 5000,
+    # members per shard group; guilds up to this size aren't sharded
+    "SHARD_SIZE": 100,
+    "MAX_SHARDS": 64,
+    # shard group_sends in flight per broadcast
+    "CONCURRENCY": 8,
+}
+
+
+def fanout_options():
+    options = {**DEFAULTS, **getattr(settings, "CHAT_GUILD_FANOUT", {})}
+    if options["SHARD_SIZE"] < 1 or options["MAX_SHARDS"] < 1 or options["CONCURRENCY"] < 1:
+        raise ValueError("CHAT_GUILD_FANOUT SHARD_SIZE, MAX_SHARDS and CONCURRENCY must be at least 1")
+    return options
+
+
+def shard_count(max_members):
+    """Groups a guild of ``max_members`` members is spread over"""
+    options = fanout_options()
+    return max(1, min(options["MAX_SHARDS"], math.ceil(max_members / options["SHARD_SIZE"])))
+
+
+def shard_groups(room, max_members):
+    """The channel layer groups carrying ``room``, a guild's group name"""
+    shards = shard_count(max_members)
+    if shards == 1:
+        return [room]
+    return [f"{room}.{shard}" for shard in range(shards)]
+
+
+def member_group(room, max_members, user_id):
+    """The group of ``room`` the sockets of ``user_id`` join"""
+    groups = shard_groups(room, max_members)
+    return groups[user_id % len(groups)]
+
+
+async def group_send_all(channel_layer, groups, event):
+    """``group_send`` ``event`` to every group, ``CONCURRENCY`` at a time"""
+    if len(groups) == 1:
+        await channel_layer.group_send(groups[0], event)
+        return
+
+    semaphore = asyncio.Semaphore(fanout_options()["CONCURRENCY"])
+
+    async def send(group):
+        async with semaphore:
+            await channel_layer.group_send(group, event)
+
+    await asyncio.gather(*(send(group) for group in groups))
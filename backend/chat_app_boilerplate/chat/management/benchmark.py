@@ -0,0 +1,102 @@
+"""
+Shared helpers for the benchmark management commands.
+
+Benchmarks run against throwaway test databases (the same ones
+``manage.py test`` would create) so they never touch real data, and report
+their results as JSON so runs can be compared across commits.
+"""
+
+import json
+import platform
+import subprocess
+import time
+from contextlib import ExitStack, contextmanager
+
+import django
+from django.db import connection, connections
+from django.test.utils import CaptureQueriesContext
+
+
+def percentiles(samples, points=(50, 95, 99)):
+    """Nearest-rank percentiles (plus min/max/mean) of ``samples``, rounded to 3 places"""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+    summary = {"count": len(ordered)}
+    for point in points:
+        rank = max(0, min(len(ordered) - 1, round(point / 100 * len(ordered)) - 1))
+        summary[f"p{point}"] = round(ordered[rank], 3)
+    summary["min"] = round(ordered[0], 3)
+    summary["max"] = round(ordered[-1], 3)
+    summary["mean"] = round(sum(ordered) / len(ordered), 3)
+    return summary
+
+
+def run_metadata():
+    """Where and on what a benchmark ran"""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "django": django.get_version(),
+        "database": connection.vendor,
+    }
+
+
+@contextmanager
+def throwaway_database(verbosity=0):
+    """Create fresh test databases (every configured alias) for the duration of the block"""
+    old_names = {}
+    mirrors = {}
+    for alias in connections:
+        if connections[alias].settings_dict["TEST"]["MIRROR"]:
+            mirrors[alias] = connections[alias].settings_dict["NAME"]
+        else:
+            old_names[alias] = connections[alias].settings_dict["NAME"]
+    try:
+        for alias in old_names:
+            connections[alias].creation.create_test_db(verbosity=verbosity, autoclobber=True, serialize=False)
+        # aliases mirroring one (the read pool's) follow it, as under the test runner
+        for alias in mirrors:
+            connections[alias].close()
+            primary = connections[alias].settings_dict["TEST"]["MIRROR"]
+            connections[alias].creation.set_as_test_mirror(connections[primary].settings_dict)
+        yield
+    finally:
+        for alias, old_name in mirrors.items():
+            # SQLite ignores close() while the name is an in-memory test
+            # database; a mirror left open would keep that database alive
+            connections[alias].settings_dict["NAME"] = old_name
+            connections[alias].close()
+        for alias, old_name in old_names.items():
+            if connections[alias].settings_dict["NAME"] != old_name:
+                connections[alias].creation.destroy_test_db(old_name, verbosity)
+
+
+class CaptureAllQueries(ExitStack):
+    """``CaptureQueriesContext`` over every database alias; ``len()`` counts them all"""
+
+    def __enter__(self):
+        super().__enter__()
+        self.contexts = [self.enter_context(CaptureQueriesContext(connections[alias])) for alias in connections]
+        return self
+
+    def __len__(self):
+        return sum(len(context) for context in self.contexts)
+
+
+def write_report(report, output, stdout):
+    """Write ``report`` as JSON to ``output`` (a path) or to ``stdout``"""
+    text = json.dumps(report, indent=2, default=str)
+    if output:
+        with open(output, "w") as f:
+            f.write(text + "\n")
+    else:
+        stdout.write(text)
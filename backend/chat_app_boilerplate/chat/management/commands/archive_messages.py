@@ -0,0 +1,63 @@
+"""
+Move old messages out of the message tables into archive segments.
+
+    python manage.py archive_messages [--older-than 90] [--pause 0.05]
+
+Every conversation with messages older than ``--older-than`` days (default
+CHAT_ARCHIVE["AGE_DAYS"]) has them written to compressed segment files of
+up to SEGMENT_SIZE messages (see chat/archive.py). Each segment is one
+short transaction, and ``--pause`` seconds are left between them for the
+live writers, so the job can run while the app serves traffic; run it
+from cron. An interrupted run leaves nothing half-archived, and the next
+run picks up where it stopped.
+"""
+
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from chat.archive import ArchiveConflict, archive_options, get_archive
+from chat.models import GroupMessage, PersonalChat
+
+
+class Command(BaseCommand):
+    help = "Archive messages older than the configured age into compressed segment files"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--older-than", type=float, help="Age in days (default CHAT_ARCHIVE['AGE_DAYS'])")
+        parser.add_argument("--pause", type=float, default=0.05, help="Seconds between segments (default 0.05)")
+
+    def handle(self, *args, **options):
+        days = options["older_than"]
+        if days is None:
+            days = archive_options()["AGE_DAYS"]
+        if days < 0:
+            raise CommandError("--older-than must not be negative")
+        cutoff = timezone.now() - timedelta(days=days)
+        archive = get_archive()
+        started = time.perf_counter()
+
+        conversations = [
+            *(f"personal:{key}" for key in (
+                PersonalChat.objects.filter(timestamp__lt=cutoff).order_by()
+                .values_list("conversation_key", flat=True).distinct()
+            )),
+            *(f"guild:{group_id}" for group_id in (
+                GroupMessage.objects.filter(timestamp__lt=cutoff).order_by()
+                .values_list("group_id", flat=True).distinct()
+            )),
+        ]
+        archived = conflicts = 0
+        for key in conversations:
+            try:
+                archived += archive.archive_conversation(key, cutoff, pause=options["pause"])
+            except ArchiveConflict:
+                conflicts += 1
+                self.stderr.write(f"{key}: messages were deleted while archiving; retry later")
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Archived {archived} message(s) of {len(conversations) - conflicts} conversation(s) in {elapsed:.1f}s"
+        ))
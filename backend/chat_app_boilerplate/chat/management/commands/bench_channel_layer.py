@@ -0,0 +1,299 @@
+"""
+Cross-process fan-out check and scaling benchmark of the sharded channel layer.
+
+    python manage.py bench_channel_layer --workers 1,2,4 --shards 2 --output layer.json
+
+Every worker is a separate process standing in for one ASGI worker. It
+opens its share of ``--sockets`` channels on a ShardedRedisChannelLayer
+(chat_app_boilerplate/channel_layers.py) and adds them to ``--groups``
+groups, each of which has members in every worker. All workers then
+group_send to random groups as fast as ``--concurrency`` in-flight sends
+allow for ``--duration`` seconds, while receiving on all of their channels.
+
+The run is repeated for each worker count. The report gives group sends and
+deliveries per second, the share of deliveries that crossed processes,
+latency percentiles, and how the groups were spread over the shards. The
+command fails if any delivery was lost, or if messages never crossed
+processes with more than one worker.
+
+Redis servers come from ``--redis`` (comma-separated URLs). Without it,
+one throwaway server per shard is started: ``redis-server`` if it is on the
+PATH, else a fakeredis TCP server process (``pip install "fakeredis[lua]"``;
+group_send needs Lua scripting). fakeredis proves delivery across
+processes, but it is itself the bottleneck; measure scaling against real
+servers. Every run uses its own key prefix and
+flushes it afterwards, so ``--redis`` may point at a shared server.
+"""
+
+import asyncio
+import multiprocessing
+import random
+import shutil
+import socket
+import subprocess
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.management.benchmark import percentiles, run_metadata, write_report
+from chat_app_boilerplate.channel_layers import ShardedRedisChannelLayer, host_id
+
+
+def group_name(index):
+    return f"bench_{index}"
+
+
+def socket_layout(sockets, groups, workers):
+    """(worker, group) of every socket; consecutive sockets go to different groups"""
+    return [((index // groups) % workers, index % groups) for index in range(sockets)]
+
+
+def make_layer(urls, prefix, capacity):
+    return ShardedRedisChannelLayer(
+        hosts=[{"address": url} for url in urls], prefix=prefix, capacity=capacity,
+    )
+
+
+def run_worker(worker, options, ready, start, results):
+    """Process entry point; reports to ``results`` once its channels are drained"""
+    results.put(asyncio.run(_worker(worker, options, ready, start)))
+
+
+async def _worker(worker, options, ready, start):
+    layer = make_layer(options["urls"], options["prefix"], options["capacity"])
+    layout = socket_layout(options["sockets"], options["groups"], options["workers"])
+    channels = []
+    for owner, group in layout:
+        if owner == worker:
+            channel = await layer.new_channel()
+            await layer.group_add(group_name(group), channel)
+            channels.append(channel)
+
+    stats = {"delivered": 0, "cross_process": 0, "last": time.perf_counter()}
+    latencies = []
+
+    async def receive(channel):
+        while True:
+            message = await layer.receive(channel)
+            stats["delivered"] += 1
+            stats["last"] = time.perf_counter()
+            if message["worker"] != worker:
+                stats["cross_process"] += 1
+            # wall clock: comparable between processes on one host
+            latencies.append((time.time() - message["sent"]) * 1000)
+
+    sent = Counter()
+    rng = random.Random(worker)
+
+    async def send(until):
+        while time.perf_counter() < until:
+            group = rng.randrange(options["groups"])
+            await layer.group_send(group_name(group), {"type": "bench", "worker": worker, "sent": time.time()})
+            sent[group] += 1
+
+    receivers = [asyncio.create_task(receive(channel)) for channel in channels]
+    ready.put(worker)
+    await asyncio.get_running_loop().run_in_executor(None, start.wait)
+
+    until = time.perf_counter() + options["duration"]
+    await asyncio.gather(*(send(until) for _ in range(options["concurrency"])))
+    # stop once nothing has arrived for a while (or the drain time is up)
+    deadline = time.perf_counter() + options["drain"]
+    while time.perf_counter() < deadline and time.perf_counter() - stats["last"] < 1.0:
+        await asyncio.sleep(0.1)
+
+    for receiver in receivers:
+        receiver.cancel()
+    await asyncio.gather(*receivers, return_exceptions=True)
+    await layer.close_pools()
+    return {
+        "worker": worker,
+        "channels": len(channels),
+        "sent": dict(sent),
+        "delivered": stats["delivered"],
+        "cross_process": stats["cross_process"],
+        "latencies": latencies,
+    }
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def run_fake_server(port):
+    """Process entry point serving one fakeredis instance over TCP"""
+    from fakeredis import TcpFakeServer
+
+    TcpFakeServer(("127.0.0.1", port)).serve_forever()
+
+
+def wait_until_up(url, timeout=10):
+    import redis
+
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            redis.Redis.from_url(url).ping()
+            return
+        except redis.ConnectionError:
+            if time.monotonic() > deadline:
+                raise CommandError(f"Redis at {url} did not come up")
+            time.sleep(0.05)
+
+
+@contextmanager
+def redis_servers(urls, shards, context):
+    """``(urls, kind)``: the given URLs, or those of ``shards`` throwaway local servers"""
+    if urls:
+        yield urls, "given"
+        return
+
+    ports = [free_port() for _ in range(shards)]
+    if shutil.which("redis-server"):
+        kind = "redis-server"
+        servers = [
+            subprocess.Popen(
+                ["redis-server", "--port", str(port), "--save", "", "--appendonly", "no"],
+                stdout=subprocess.DEVNULL,
+            )
+            for port in ports
+        ]
+        stop = [server.terminate for server in servers]
+    else:
+        try:
+            import fakeredis  # noqa: F401
+            import lupa  # noqa: F401
+        except ImportError:
+            raise CommandError(
+                'Pass --redis, put redis-server on the PATH, or pip install "fakeredis[lua]"'
+            )
+        kind = "fakeredis"
+        servers = [context.Process(target=run_fake_server, args=(port,), daemon=True) for port in ports]
+        for server in servers:
+            server.start()
+        stop = [server.kill for server in servers]
+
+    urls = [f"redis://127.0.0.1:{port}/0" for port in ports]
+    try:
+        for url in urls:
+            wait_until_up(url)
+        yield urls, kind
+    finally:
+        for terminate in stop:
+            terminate()
+
+
+class Command(BaseCommand):
+    help = "Check cross-process fan-out over the sharded Redis channel layer and measure how it scales"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", default="1,2,4", help="Comma-separated worker counts to run (default 1,2,4)")
+        parser.add_argument("--redis", help="Comma-separated Redis URLs to shard over instead of throwaway servers")
+        parser.add_argument("--shards", type=int, default=2, help="Throwaway Redis servers to start (default 2)")
+        parser.add_argument("--sockets", type=int, default=200, help="Channels across all workers (default 200)")
+        parser.add_argument("--groups", type=int, default=20, help="Groups the channels are spread over (default 20)")
+        parser.add_argument("--concurrency", type=int, default=8, help="In-flight group sends per worker (default 8)")
+        parser.add_argument("--duration", type=float, default=5, help="Seconds to send for (default 5)")
+        parser.add_argument("--drain", type=float, default=10, help="Most seconds to wait for in-flight deliveries (default 10)")
+        parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+
+    def handle(self, *args, **options):
+        try:
+            worker_counts = [int(count) for count in options["workers"].split(",") if count.strip()]
+        except ValueError:
+            raise CommandError("--workers must be comma-separated integers")
+        if not worker_counts or min(worker_counts) < 1:
+            raise CommandError("--workers must be at least 1")
+        if options["groups"] < 1 or options["sockets"] < options["groups"]:
+            raise CommandError("--sockets must be at least --groups, which must be at least 1")
+        urls = [url.strip() for url in (options["redis"] or "").split(",") if url.strip()]
+
+        # workers must not inherit the parent's threads (log writer, event loop)
+        context = multiprocessing.get_context("spawn")
+        report = {"run": run_metadata(), "config": {
+            key: options[key] for key in ("sockets", "groups", "concurrency", "duration")
+        }, "runs": {}}
+        failures = []
+        with redis_servers(urls, options["shards"], context) as (hosts, kind):
+            report["config"]["redis"] = kind
+            report["config"]["shards"] = len(hosts)
+            for workers in worker_counts:
+                self.stderr.write(f"Running {workers} worker(s)...")
+                result = self.run(context, hosts, workers, options)
+                report["runs"][workers] = result
+                if result["lost"]:
+                    failures.append(f"{workers} worker(s): {result['lost']} deliveries lost")
+                if workers > 1 and not result["cross_process"]:
+                    failures.append(f"{workers} worker(s): no message reached another process")
+
+        report["failures"] = failures
+        write_report(report, options["output"], self.stdout)
+        if failures:
+            raise CommandError("Fan-out check failed:\n  " + "\n  ".join(failures))
+
+    def run(self, context, hosts, workers, options):
+        worker_options = {
+            "urls": hosts,
+            "prefix": f"bench{uuid.uuid4().hex[:8]}",
+            "workers": workers,
+            # nothing may be dropped, however far the receivers fall behind
+            "capacity": 1_000_000,
+            **{key: options[key] for key in ("sockets", "groups", "concurrency", "duration", "drain")},
+        }
+        ready, start, results = context.Queue(), context.Event(), context.Queue()
+        processes = [
+            context.Process(target=run_worker, args=(worker, worker_options, ready, start, results))
+            for worker in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        try:
+            for _ in processes:
+                ready.get(timeout=60)
+            started = time.perf_counter()
+            start.set()
+            reports = [results.get(timeout=options["duration"] + options["drain"] + 60) for _ in processes]
+            elapsed = time.perf_counter() - started
+        finally:
+            for process in processes:
+                process.join(timeout=5)
+                if process.is_alive():
+                    process.kill()
+            asyncio.run(self.flush(hosts, worker_options["prefix"]))
+
+        group_sizes = Counter(group for _, group in socket_layout(options["sockets"], options["groups"], workers))
+        sent = Counter()
+        for worker_report in reports:
+            sent.update({int(group): count for group, count in worker_report["sent"].items()})
+        expected = sum(count * group_sizes[group] for group, count in sent.items())
+        delivered = sum(worker_report["delivered"] for worker_report in reports)
+        cross_process = sum(worker_report["cross_process"] for worker_report in reports)
+
+        layer = make_layer(hosts, worker_options["prefix"], 1)
+        shard_groups = Counter(
+            host_id(layer.hosts[layer.consistent_hash(group_name(group))]) for group in range(options["groups"])
+        )
+        return {
+            "group_sends": sum(sent.values()),
+            "group_sends_per_sec": round(sum(sent.values()) / options["duration"], 1),
+            "expected_deliveries": expected,
+            "delivered": delivered,
+            "lost": expected - delivered,
+            "deliveries_per_sec": round(delivered / elapsed, 1),
+            "cross_process": cross_process,
+            "cross_process_share": round(cross_process / delivered, 3) if delivered else None,
+            "latency_ms": percentiles([ms for worker_report in reports for ms in worker_report["latencies"]]),
+            "channels_per_worker": [worker_report["channels"] for worker_report in reports],
+            "groups_per_shard": dict(shard_groups),
+            "elapsed_s": round(elapsed, 3),
+        }
+
+    async def flush(self, hosts, prefix):
+        layer = make_layer(hosts, prefix, 1)
+        await layer.flush()
+        await layer.close_pools()
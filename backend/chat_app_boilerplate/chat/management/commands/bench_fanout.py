@@ -0,0 +1,201 @@
+"""
+How guild broadcast latency scales with the number of members.
+
+    python manage.py bench_fanout --members 15,100,1000,5000 --online 0.5 --output fanout.json
+
+For every member count, ``--online`` of the members have a socket open: a
+channel on the channel layer, in the group a GroupChatConsumer would put it
+in. ``--messages`` broadcasts are then sent one after another, each after
+the previous one reached every online member, in two layouts:
+
+* ``single``: one group for the whole guild (every guild before
+  chat/fanout.py, and guilds up to ``SHARD_SIZE`` members now);
+* ``sharded``: the shard groups of a guild of that many ``max_members``,
+  sent to through ``group_send_all`` (``CHAT_GUILD_FANOUT``).
+
+Per layout it reports how long the broadcast call took ("send_ms"), the
+time until the first and the last member had the message ("first_ms",
+"all_ms"), and the longest the event loop went without running anything
+else during the run ("max_loop_stall_ms"): what every other socket served
+by the same worker waits.
+
+The channel layer is a ShardedRedisChannelLayer over ``--redis`` URLs, or
+over throwaway servers as bench_channel_layer starts them. fakeredis costs
+far more per call than Redis, which penalizes the sharded layout's extra
+group_sends; measure against real servers. ``--layer memory`` uses the
+in-memory layer, which scans every channel on each receive: keep
+``--members`` to a few hundred with it.
+"""
+
+import asyncio
+import multiprocessing
+import random
+import time
+import uuid
+
+from channels.layers import InMemoryChannelLayer
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.consumers import guild_group_name
+from chat.fanout import fanout_options, group_send_all, member_group, shard_groups
+from chat.management.benchmark import percentiles, run_metadata, write_report
+from chat.management.commands.bench_channel_layer import make_layer, redis_servers
+
+LAYOUTS = ("single", "sharded")
+
+
+class LoopStallMonitor:
+    """Longest gap between wake-ups of a task asking to run every millisecond"""
+
+    def __init__(self, interval=0.001):
+        self.interval = interval
+        self.max_stall = 0.0
+        self._task = None
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.max_stall = max(self.max_stall, time.perf_counter() - started - self.interval)
+
+    def __enter__(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        return self
+
+    def __exit__(self, *exc_info):
+        self._task.cancel()
+
+
+async def run_layout(layer, layout, members, online, messages, timeout):
+    room = guild_group_name(f"bench{uuid.uuid4().hex[:8]}")
+    groups = shard_groups(room, members) if layout == "sharded" else [room]
+    user_ids = sorted(random.Random(members).sample(range(members), online))
+
+    joined = []
+    for user_id in user_ids:
+        channel = await layer.new_channel()
+        group = member_group(room, members, user_id) if layout == "sharded" else room
+        await layer.group_add(group, channel)
+        joined.append((group, channel))
+
+    arrivals = []  # (message number, perf_counter) of every delivery
+    delivered = asyncio.Event()
+
+    async def receive(channel):
+        while True:
+            message = await layer.receive(channel)
+            arrivals.append((message["n"], time.perf_counter()))
+            if len(arrivals) == online * (message["n"] + 1):
+                delivered.set()
+
+    receivers = [asyncio.create_task(receive(channel)) for _, channel in joined]
+    send_ms, first_ms, all_ms = [], [], []
+    lost = 0
+    try:
+        with LoopStallMonitor() as monitor:
+            for n in range(messages):
+                delivered.clear()
+                received_before = len(arrivals)
+                sent = time.perf_counter()
+                await group_send_all(layer, groups, {"type": "bench", "n": n})
+                send_ms.append((time.perf_counter() - sent) * 1000)
+                try:
+                    await asyncio.wait_for(delivered.wait(), timeout)
+                except asyncio.TimeoutError:
+                    lost += online * (n + 1) - len(arrivals)
+                    break
+                times = [at for number, at in arrivals[received_before:] if number == n]
+                first_ms.append((min(times) - sent) * 1000)
+                all_ms.append((max(times) - sent) * 1000)
+    finally:
+        for receiver in receivers:
+            receiver.cancel()
+        await asyncio.gather(*receivers, return_exceptions=True)
+        for group, channel in joined:
+            await layer.group_discard(group, channel)
+
+    return {
+        "groups": len(groups),
+        "broadcasts": len(all_ms),
+        "lost": lost,
+        "send_ms": percentiles(send_ms),
+        "first_ms": percentiles(first_ms),
+        "all_ms": percentiles(all_ms),
+        "max_loop_stall_ms": round(monitor.max_stall * 1000, 3),
+    }
+
+
+class Command(BaseCommand):
+    help = "Measure guild broadcast latency against member count, single group vs sharded fan-out"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--members", default="15,100,1000,5000",
+            help="Comma-separated guild sizes (max_members) to run (default 15,100,1000,5000)",
+        )
+        parser.add_argument(
+            "--online", type=float, default=1.0,
+            help="Share of the members with a socket open (default 1.0)",
+        )
+        parser.add_argument("--messages", type=int, default=50, help="Broadcasts per guild size and layout (default 50)")
+        parser.add_argument("--timeout", type=float, default=30, help="Most seconds to wait for one broadcast (default 30)")
+        parser.add_argument("--layer", choices=("redis", "memory"), default="redis", help="Channel layer (default redis)")
+        parser.add_argument("--redis", help="Comma-separated Redis URLs for --layer redis instead of throwaway servers")
+        parser.add_argument("--shards", type=int, default=2, help="Throwaway Redis servers to start (default 2)")
+        parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options["members"].split(",") if size.strip()]
+        except ValueError:
+            raise CommandError("--members must be comma-separated integers")
+        if not sizes or min(sizes) < 1:
+            raise CommandError("--members must be at least 1")
+        if not 0 < options["online"] <= 1:
+            raise CommandError("--online must be in (0, 1]")
+        if options["messages"] < 1:
+            raise CommandError("--messages must be at least 1")
+
+        fanout = fanout_options()
+        report = {"run": run_metadata(), "config": {
+            **{key: options[key] for key in ("online", "messages", "layer")},
+            "fanout": {key: fanout[key] for key in ("SHARD_SIZE", "MAX_SHARDS", "CONCURRENCY")},
+        }, "runs": {}}
+
+        if options["layer"] == "memory":
+            report["runs"] = asyncio.run(self.run(lambda: InMemoryChannelLayer(capacity=1000), sizes, options))
+        else:
+            urls = [url.strip() for url in (options["redis"] or "").split(",") if url.strip()]
+            with redis_servers(urls, options["shards"], multiprocessing.get_context("spawn")) as (hosts, kind):
+                report["config"]["redis"] = kind
+                report["config"]["shards"] = len(hosts)
+                prefix = f"bench{uuid.uuid4().hex[:8]}"
+                report["runs"] = asyncio.run(self.run(lambda: make_layer(hosts, prefix, 1000), sizes, options))
+
+        write_report(report, options["output"], self.stdout)
+        lost = [
+            f"{members} members, {layout}: {result['lost']} deliveries lost"
+            for members, run in report["runs"].items()
+            for layout, result in run.items() if isinstance(result, dict) and result["lost"]
+        ]
+        if lost:
+            raise CommandError("Broadcasts were lost:\n  " + "\n  ".join(lost))
+
+    async def run(self, new_layer, sizes, options):
+        runs = {}
+        for members in sizes:
+            online = max(1, round(members * options["online"]))
+            runs[members] = {"online": online}
+            for layout in LAYOUTS:
+                self.stderr.write(f"{members} members ({online} online), {layout}...")
+                layer = new_layer()
+                try:
+                    runs[members][layout] = await run_layout(
+                        layer, layout, members, online, options["messages"], options["timeout"],
+                    )
+                finally:
+                    if hasattr(layer, "flush"):
+                        await layer.flush()
+                    if hasattr(layer, "close_pools"):
+                        await layer.close_pools()
+        return runs
@@ -0,0 +1,205 @@
+"""
+REST endpoint benchmark with query budgets.
+
+    python manage.py bench_rest --sizes small,medium --repeat 20 --output rest.json
+
+For every dataset size a throwaway test database is seeded (see
+chat/management/seeding.py). The chat endpoints are then requested as a
+busy user: a member of the most active guild who has many conversations.
+Requests go through the normal cookie JWT authentication. The command
+records each endpoint's latency percentiles and the most SQL queries any
+request made.
+
+Query budgets are declared in ENDPOINTS below and include authentication.
+The command exits with an error if any endpoint exceeds its budget or
+returns a non-200 response, so it can gate changes in CI.
+"""
+
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from accounts.token_cache import get_token_cache
+from chat.management.benchmark import (
+    CaptureAllQueries, percentiles, run_metadata, throwaway_database, write_report,
+)
+from chat.management.seeding import seed_dataset
+from chat.models import Chat_Group, ConversationSummary, GroupMessage, PersonalChat
+from chat.recent import get_recent_messages
+
+User = get_user_model()
+
+SIZES = {
+    "small": {"users": 500, "guilds": 25, "personal_messages": 20_000, "group_messages": 20_000},
+    "medium": {"users": 2_000, "guilds": 100, "personal_messages": 200_000, "group_messages": 200_000},
+    "large": {"users": 10_000, "guilds": 500, "personal_messages": 2_000_000, "group_messages": 2_000_000},
+}
+
+# (name, path, most SQL queries one request may run)
+# Paths are formatted with the subject's context. Budgets count the queries
+# of every database and include the user lookup of a cold token cache; guild
+# pages are served from a cold directory cache first. Messages and their
+# senders are in separate databases, so the conversation and history pages
+# look users up separately, and a history page that reaches the oldest live
+# message also checks the archive. History pages re-check the requester's
+# account in the database, past the token cache.
+ENDPOINTS = [
+    ("user_list", "/chat/users/", 4),
+    ("user_list_search", "/chat/users/?search=a", 4),
+    ("user_list_page_2", "/chat/users/?after={users_cursor}", 4),
+    ("guild_list", "/chat/guilds/", 2),
+    ("guild_list_page_2", "/chat/guilds/?after={guilds_cursor}", 2),
+    ("guild_detail", "/chat/guilds/{guild_id}/", 3),
+    ("my_guild", "/chat/guilds/my-guild/", 3),
+    ("personal_history", "/chat/messages/{peer_email}/", 7),
+    ("personal_history_page_2", "/chat/messages/{peer_email}/?before={personal_cursor}", 6),
+    ("group_history", "/chat/group/{guild_name}/messages/", 5),
+    ("group_history_page_2", "/chat/group/{guild_name}/messages/?before={group_cursor}", 5),
+]
+
+
+class Command(BaseCommand):
+    help = "Benchmark the chat REST endpoints on seeded datasets and enforce their query budgets"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes", default="small,medium",
+            help=f"Comma-separated dataset sizes from {', '.join(SIZES)} (default small,medium)",
+        )
+        parser.add_argument("--repeat", type=int, default=20, help="Requests per endpoint (default 20)")
+        parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+
+    def handle(self, *args, **options):
+        sizes = [size.strip() for size in options["sizes"].split(",") if size.strip()]
+        unknown = [size for size in sizes if size not in SIZES]
+        if unknown:
+            raise CommandError(f"Unknown dataset size(s): {', '.join(unknown)}")
+        if options["repeat"] < 1:
+            raise CommandError("--repeat must be at least 1")
+
+        report = {"run": run_metadata(), "config": {"repeat": options["repeat"]}, "sizes": {}}
+        violations = []
+        for size in sizes:
+            self.stderr.write(f"Seeding {size} dataset...")
+            with throwaway_database():
+                cache.clear()
+                get_recent_messages().clear()
+                started = time.perf_counter()
+                dataset = seed_dataset(**SIZES[size])
+                seed_elapsed = time.perf_counter() - started
+                endpoints = self.run_endpoints(options["repeat"])
+
+            report["sizes"][size] = {
+                "dataset": dataset,
+                "seed_s": round(seed_elapsed, 1),
+                "endpoints": endpoints,
+            }
+            for name, result in endpoints.items():
+                if "skipped" in result:
+                    continue
+                if result["queries"] > result["budget"]:
+                    violations.append(f"{size}/{name}: {result['queries']} queries (budget {result['budget']})")
+                if result["status"] != 200:
+                    violations.append(f"{size}/{name}: HTTP {result['status']}")
+
+        report["budget_violations"] = violations
+        write_report(report, options["output"], self.stdout)
+        if violations:
+            raise CommandError("Query budget exceeded:\n  " + "\n  ".join(violations))
+
+    def run_endpoints(self, repeat):
+        user, context = self.subject()
+        # user ids repeat across throwaway databases
+        get_token_cache().invalidate_user(user.id)
+
+        # outside the test runner "testserver" is not an allowed host
+        client = APIClient(SERVER_NAME="localhost")
+        client.cookies["access_token"] = str(AccessToken.for_user(user))
+        context.update(self.page_2_cursors(client, context))
+        # measure from a cold guild directory and recent messages cache, like
+        # the first request after a deploy
+        cache.clear()
+        get_recent_messages().clear()
+
+        results = {}
+        for name, path, budget in ENDPOINTS:
+            # access tokens are short-lived; a fresh one per endpoint outlasts its
+            # requests, and each endpoint's first request pays the user lookup
+            client.cookies["access_token"] = str(AccessToken.for_user(user))
+            get_token_cache().invalidate_user(user.id)
+            url = path.format(**context)
+            if "None" in url:
+                results[name] = {"skipped": "the first page is the only page", "budget": budget}
+                continue
+            timings = []
+            most_queries = 0
+            status = None
+            for _ in range(repeat):
+                with CaptureAllQueries() as queries:
+                    started = time.perf_counter()
+                    response = client.get(url)
+                    timings.append((time.perf_counter() - started) * 1000)
+                most_queries = max(most_queries, len(queries))
+                status = response.status_code
+                if status != 200:
+                    break
+            results[name] = {
+                "latency_ms": percentiles(timings),
+                "queries": most_queries,
+                "budget": budget,
+                "status": status,
+            }
+        return results
+
+    def subject(self):
+        """An active member of the busiest guild with the most conversations, and their busiest peer"""
+        # messages may be in another database than guilds: no join
+        busiest_guild = GroupMessage.objects.values("group_id").annotate(
+            messages_count=Count("id")
+        ).order_by("-messages_count").first()
+        guild = busiest_guild and Chat_Group.objects.filter(id=busiest_guild["group_id"]).first()
+        if guild is None:
+            raise CommandError("The dataset has no guilds")
+        user = max(
+            User.objects.filter(guild=guild, is_active=True),
+            key=lambda member: ConversationSummary.objects.for_user(member).count(),
+        )
+        summaries = {
+            summary.conversation_key: summary
+            for summary in ConversationSummary.objects.for_user(user)
+        }
+        busiest = PersonalChat.objects.filter(conversation_key__in=summaries).values(
+            "conversation_key"
+        ).annotate(messages_count=Count("id")).order_by("-messages_count").first()
+        if busiest is None:
+            raise CommandError("The benchmark user has no conversations")
+        summary = summaries[busiest["conversation_key"]]
+        return user, {
+            "guild_id": guild.id,
+            "guild_name": guild.name,
+            "peer_email": summary.peer_of(user).email,
+        }
+
+    def page_2_cursors(self, client, context):
+        """
+        Cursors of the second page of every paginated endpoint, taken from a
+        short first page so small datasets have a second page too
+        """
+        first_pages = {
+            "users_cursor": "/chat/users/?limit=10",
+            "guilds_cursor": "/chat/guilds/?limit=10",
+            "personal_cursor": "/chat/messages/{peer_email}/?limit=10",
+            "group_cursor": "/chat/group/{guild_name}/messages/?limit=10",
+        }
+        cursors = {}
+        for name, path in first_pages.items():
+            response = client.get(path.format(**context))
+            if response.status_code != 200:
+                raise CommandError(f"{path} returned HTTP {response.status_code}")
+            cursors[name] = response.data.get("next_cursor")
+        return cursors
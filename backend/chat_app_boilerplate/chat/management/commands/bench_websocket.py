@@ -0,0 +1,298 @@
+"""
+WebSocket load test for the chat consumers.
+
+    python manage.py bench_websocket --users 50 --guilds 5 --rate 500 --duration 20 --output ws.json
+
+Seeds N users and M guilds in a throwaway test database, opens one
+authenticated socket per user and conversation through the full ASGI stack
+(origin check, JWT cookie middleware, URL router), then has every socket
+send at a share of ``--rate`` messages/sec for ``--duration`` seconds.
+
+Reports connect time, send-to-receive latency percentiles (measured at every
+receiving socket other than the sender), messages/sec, deliveries/sec and
+database rows/sec as written by the message writer.
+
+Flood control (chat/throttle.py) is switched off so the configured rate is
+what reaches the server. With ``--flood-control`` the configured limits
+apply: "throttled" counts the throttled frames received, and messages
+refused silently while a client was already throttled show up as "lost".
+
+``--protocol msgpack`` connects with the "chat.msgpack" subprotocol instead
+of JSON (chat/protocols.py); "bytes_received" compares the frame sizes.
+"""
+
+import asyncio
+import time
+from collections import defaultdict
+
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework_simplejwt.tokens import AccessToken
+
+from chat.management.benchmark import percentiles, run_metadata, throwaway_database, write_report
+from chat.models import Chat_Group
+from chat.persistence import get_writer, messages_persisted
+from chat.protocols import PROTOCOLS
+from chat.throttle import FloodControl, set_flood_control
+
+User = get_user_model()
+
+MODES = ("personal", "guild", "both")
+
+# --protocol value -> chat/protocols.py protocol, e.g. "msgpack" for "chat.msgpack"
+PROTOCOL_CHOICES = {protocol.subprotocol.partition(".")[2]: protocol for protocol in PROTOCOLS}
+
+
+class BenchSocket:
+    def __init__(self, application, user, kind, room, path, token, protocol):
+        self.user = user
+        self.kind = kind  # "personal" or "guild"
+        self.room = room  # sockets sharing a room receive each other's messages
+        self.protocol = protocol
+        self.communicator = WebsocketCommunicator(application, path, headers=[
+            (b"cookie", f"access_token={token}".encode()),
+            (b"origin", b"http://localhost"),
+        ], subprotocols=[protocol.subprotocol])
+        self.connect_ms = None
+        self.connected = False
+
+    async def connect(self):
+        started = time.perf_counter()
+        self.connected, _ = await self.communicator.connect(timeout=10)
+        self.connect_ms = (time.perf_counter() - started) * 1000
+        return self.connected
+
+
+class WebsocketBenchmark:
+    def __init__(self, sockets, rate, duration, drain, message_size):
+        self.sockets = sockets
+        self.rate = rate
+        self.duration = duration
+        self.drain = drain
+        self.padding = "x" * max(0, message_size)
+
+        self.room_sizes = defaultdict(int)
+        self.sent_at = {}  # message id -> (perf_counter at send, sending socket)
+        self.latencies = defaultdict(list)  # socket kind -> ms
+        self.sent = 0
+        self.send_errors = 0
+        self.throttled = 0
+        self.expected = 0
+        self.delivered = 0
+        self.bytes_received = 0
+        self.db_rows = 0
+        self.db_batches = 0
+        self.last_write = None
+
+    def on_persisted(self, sender, messages, **kwargs):
+        self.db_rows += len(messages)
+        self.db_batches += 1
+        self.last_write = time.perf_counter()
+
+    async def run(self):
+        connect_started = time.perf_counter()
+        results = await asyncio.gather(*(socket.connect() for socket in self.sockets))
+        connect_elapsed = time.perf_counter() - connect_started
+        open_sockets = [socket for socket, ok in zip(self.sockets, results) if ok]
+        if not open_sockets:
+            raise CommandError("No benchmark socket could connect")
+        for socket in open_sockets:
+            self.room_sizes[socket.room] += 1
+
+        messages_persisted.connect(self.on_persisted, weak=False)
+        readers = [asyncio.create_task(self.read(socket)) for socket in open_sockets]
+        try:
+            started = time.perf_counter()
+            interval = len(open_sockets) / self.rate
+            await asyncio.gather(*(
+                self.send_loop(socket, started, started + self.duration, interval)
+                for socket in open_sockets
+            ))
+            send_elapsed = time.perf_counter() - started
+
+            deadline = time.perf_counter() + self.drain
+            while self.delivered < self.expected and time.perf_counter() < deadline:
+                await asyncio.sleep(0.05)
+            await get_writer().flush()
+            elapsed = time.perf_counter() - started
+        finally:
+            messages_persisted.disconnect(self.on_persisted)
+            for reader in readers:
+                reader.cancel()
+            await asyncio.gather(*readers, return_exceptions=True)
+            for socket in open_sockets:
+                await socket.communicator.disconnect()
+
+        write_elapsed = (self.last_write - started) if self.last_write else elapsed
+        all_latencies = [ms for samples in self.latencies.values() for ms in samples]
+        return {
+            "connections": {
+                "attempted": len(self.sockets),
+                "opened": len(open_sockets),
+                "failed": len(self.sockets) - len(open_sockets),
+                "connect_ms": percentiles([socket.connect_ms for socket in self.sockets]),
+                "connects_per_sec": round(len(self.sockets) / connect_elapsed, 1),
+            },
+            "messages": {
+                "sent": self.sent,
+                "send_errors": self.send_errors,
+                "throttled": self.throttled,
+                "expected_deliveries": self.expected,
+                "delivered": self.delivered,
+                "lost": self.expected - self.delivered,
+                "per_sec": round(self.sent / send_elapsed, 1),
+                "deliveries_per_sec": round(self.delivered / elapsed, 1),
+                "bytes_received": self.bytes_received,
+            },
+            "latency_ms": percentiles(all_latencies),
+            "latency_ms_by_kind": {kind: percentiles(samples) for kind, samples in self.latencies.items()},
+            "db": {
+                "rows": self.db_rows,
+                "batches": self.db_batches,
+                "rows_per_sec": round(self.db_rows / write_elapsed, 1) if write_elapsed else None,
+                "rows_per_batch": round(self.db_rows / self.db_batches, 1) if self.db_batches else None,
+            },
+            "elapsed_s": round(elapsed, 3),
+        }
+
+    async def send_loop(self, socket, started, until, interval):
+        # Fixed schedule (not sleep-after-send) so slow sends don't lower the rate
+        tick = 0
+        while True:
+            at = started + tick * interval
+            if at >= until:
+                return
+            delay = at - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tick += 1
+
+            message_id = f"{socket.user.id}-{socket.kind}-{tick}"
+            self.sent_at[message_id] = (time.perf_counter(), socket)
+            try:
+                data = socket.protocol.encode({"message": f"{message_id}|{self.padding}", "timestamp": ""})
+                if isinstance(data, bytes):
+                    await socket.communicator.send_to(bytes_data=data)
+                else:
+                    await socket.communicator.send_to(text_data=data)
+            except Exception:
+                self.send_errors += 1
+                continue
+            self.sent += 1
+            self.expected += self.room_sizes[socket.room] - 1
+
+    async def read(self, socket):
+        while True:
+            data = await socket.communicator.receive_from(timeout=3600)
+            received = time.perf_counter()
+            self.bytes_received += len(data.encode() if isinstance(data, str) else data)
+            if isinstance(data, bytes):
+                frame = socket.protocol.decode(bytes_data=data)
+            else:
+                frame = socket.protocol.decode(text_data=data)
+            if frame.get("type") == "throttled":
+                # the refused message was never broadcast; messages refused
+                # silently after this one go uncounted (see chat/throttle.py)
+                self.throttled += 1
+                self.expected -= self.room_sizes[socket.room] - 1
+                continue
+            message = frame.get("message")
+            if not isinstance(message, str):
+                continue
+            sent = self.sent_at.get(message.partition("|")[0])
+            if sent is None or sent[1] is socket:
+                continue  # not ours, or the sender's own echo
+            self.delivered += 1
+            self.latencies[socket.kind].append((received - sent[0]) * 1000)
+
+
+class Command(BaseCommand):
+    help = "Load-test the chat WebSocket consumers and report latency/throughput as JSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=20, help="Users to connect (default 20)")
+        parser.add_argument("--guilds", type=int, default=2, help="Guilds the users are spread over (default 2)")
+        parser.add_argument(
+            "--mode", choices=MODES, default="both",
+            help="personal: pairs of users chat 1:1, guild: users chat in their guild, both: each user does both",
+        )
+        parser.add_argument("--rate", type=float, default=200, help="Total messages/sec across all sockets (default 200)")
+        parser.add_argument("--duration", type=float, default=10, help="Seconds to send for (default 10)")
+        parser.add_argument("--drain", type=float, default=5, help="Seconds to wait for in-flight deliveries (default 5)")
+        parser.add_argument("--message-size", type=int, default=32, help="Padding characters per message (default 32)")
+        parser.add_argument(
+            "--protocol", choices=sorted(PROTOCOL_CHOICES), default="json",
+            help="WebSocket wire format the sockets negotiate (default json)",
+        )
+        parser.add_argument(
+            "--flood-control", action="store_true",
+            help="Enforce CHAT_FLOOD_CONTROL instead of lifting the limits for the run",
+        )
+        parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+
+    def handle(self, *args, **options):
+        if options["users"] < 2:
+            raise CommandError("--users must be at least 2")
+        if options["rate"] <= 0 or options["duration"] <= 0:
+            raise CommandError("--rate and --duration must be positive")
+        if options["mode"] != "personal" and options["guilds"] < 1:
+            raise CommandError("--guilds must be at least 1")
+
+        from chat_app_boilerplate.asgi import application
+
+        report = {"run": run_metadata(), "config": {
+            key: options[key] for key in ("users", "guilds", "mode", "rate", "duration", "message_size", "protocol", "flood_control")
+        }}
+        set_flood_control(None if options["flood_control"] else FloodControl())
+        with throwaway_database():
+            sockets = self.build_sockets(application, options)
+            benchmark = WebsocketBenchmark(
+                sockets,
+                rate=options["rate"],
+                duration=options["duration"],
+                drain=options["drain"],
+                message_size=options["message_size"],
+            )
+            report.update(asyncio.run(benchmark.run()))
+
+        write_report(report, options["output"], self.stdout)
+        if options["output"]:
+            self.stdout.write(self.style.SUCCESS(f"Report written to {options['output']}"))
+
+    def build_sockets(self, application, options):
+        User.objects.bulk_create([
+            User(email=f"bench{i}@bench.invalid", name=f"bench{i}", is_active=True)
+            for i in range(options["users"])
+        ])
+        users = list(User.objects.filter(email__endswith="@bench.invalid").order_by("id"))
+        tokens = {user.id: str(AccessToken.for_user(user)) for user in users}
+        mode = options["mode"]
+        protocol = PROTOCOL_CHOICES[options["protocol"]]
+        sockets = []
+
+        if mode in ("personal", "both"):
+            # users 2k and 2k+1 talk to each other
+            for a, b in zip(users[0::2], users[1::2]):
+                room = f"personal:{a.id}:{b.id}"
+                sockets.append(BenchSocket(application, a, "personal", room, f"/ws/personal/{b.email}/", tokens[a.id], protocol))
+                sockets.append(BenchSocket(application, b, "personal", room, f"/ws/personal/{a.email}/", tokens[b.id], protocol))
+
+        if mode in ("guild", "both"):
+            count = min(options["guilds"], len(users))
+            for index in range(count):
+                members = users[index::count]
+                guild = Chat_Group.objects.create(
+                    name=f"bench-guild-{index}",
+                    created_by=members[0],
+                    max_members=len(members),
+                    member_count=len(members),
+                )
+                User.objects.filter(id__in=[user.id for user in members]).update(guild=guild)
+                for user in members:
+                    sockets.append(BenchSocket(
+                        application, user, "guild", f"guild:{guild.id}",
+                        f"/ws/group/{guild.name}/", tokens[user.id], protocol,
+                    ))
+
+        return sockets
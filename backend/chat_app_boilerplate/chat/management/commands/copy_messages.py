@@ -0,0 +1,63 @@
+"""
+Copy the messages of an existing install into the chat database.
+
+    python manage.py copy_messages [--batch-size 5000]
+
+Once ``CHAT_DATABASE_NAME`` is set, the message tables are read from the
+``chat`` database (chat/routers.py) and the rows stored in ``default`` so
+far are no longer seen. With the app stopped, run ``migrate --database
+chat`` and then this command: it copies every message, sequence,
+conversation summary and archive segment over with their ids, and indexes
+the copied messages for search. An interrupted run continues after the
+last row it copied. The rows left in ``default`` are not read anymore and
+can be dropped once the copy is checked.
+"""
+
+import time
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Max
+
+from chat.models import ArchiveSegment, ConversationSummary, GroupMessage, MessageSequence, PersonalChat
+from chat.routers import MESSAGE_DATABASE, MessageRouter
+
+MODELS = (MessageSequence, PersonalChat, GroupMessage, ConversationSummary, ArchiveSegment)
+
+
+class Command(BaseCommand):
+    help = "Copy the message tables from the default database into the chat database"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=5000)
+
+    def handle(self, *args, **options):
+        if options["batch_size"] < 1:
+            raise CommandError("--batch-size must be at least 1")
+        if not MessageRouter.enabled():
+            raise CommandError("The chat database isn't configured; set CHAT_DATABASE_NAME first")
+        started = time.perf_counter()
+
+        for model in MODELS:
+            source = model.objects.using(DEFAULT_DB_ALIAS)
+            target = model.objects.using(MESSAGE_DATABASE)
+            # continue after the rows an interrupted run already copied
+            last_id = target.aggregate(last=Max("id"))["last"] or 0
+            copied = 0
+            while True:
+                batch = list(source.filter(id__gt=last_id).order_by("id")[:options["batch_size"]])
+                if not batch:
+                    break
+                # commit batch by batch instead of holding one long write lock
+                with transaction.atomic(using=MESSAGE_DATABASE):
+                    target.bulk_create(batch)
+                copied += len(batch)
+                last_id = batch[-1].id
+            self.stdout.write(f"{model.__name__}: copied {copied} row(s)")
+
+        # bulk_create skips the indexing done on save
+        call_command("search_index", batch_size=options["batch_size"], stdout=self.stdout)
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(f"Messages copied in {elapsed:.1f}s"))
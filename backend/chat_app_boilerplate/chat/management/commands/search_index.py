@@ -0,0 +1,55 @@
+"""
+Index stored messages for full-text search.
+
+    python manage.py search_index [--rebuild] [--batch-size 5000]
+
+New messages are indexed as they are saved (chat/signals.py), but rows
+written with ``bulk_create`` outside the message writer, like those of
+``seed_chat``, are not. This indexes every message that isn't indexed yet.
+``--rebuild`` empties the index first, which also drops the entries of
+deleted messages.
+"""
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from chat.models import GroupMessage, PersonalChat, message_database
+from chat.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = "Index stored messages that are not yet searchable"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rebuild", action="store_true", help="Empty the index and index every message again")
+        parser.add_argument("--batch-size", type=int, default=5000)
+
+    def handle(self, *args, **options):
+        if options["batch_size"] < 1:
+            raise CommandError("--batch-size must be at least 1")
+        backend = get_search_backend()
+        if not backend.available:
+            raise CommandError("The search index is not available on this database (see chat/search.py)")
+        started = time.perf_counter()
+        if options["rebuild"]:
+            backend.clear()
+
+        for model in (PersonalChat, GroupMessage):
+            indexed = 0
+            last_id = 0
+            while True:
+                ids = list(
+                    model.objects.filter(id__gt=last_id).order_by("id").values_list("id", flat=True)[:options["batch_size"]]
+                )
+                if not ids:
+                    break
+                # commit batch by batch instead of holding one long write lock
+                with transaction.atomic(using=message_database()):
+                    indexed += backend.backfill(model, ids)
+                last_id = ids[-1]
+            self.stdout.write(f"{model.__name__}: indexed {indexed} message(s)")
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(f"Search index up to date in {elapsed:.1f}s"))
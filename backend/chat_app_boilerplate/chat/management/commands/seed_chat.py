@@ -0,0 +1,53 @@
+"""
+Seed the configured database with a large, realistic chat dataset.
+
+    python manage.py seed_chat --users 10000 --guilds 500 --personal-messages 1000000 --group-messages 1000000
+
+Rows are inserted in bulk (see chat/management/seeding.py). Run with
+``--flush`` to delete a previous seed first.
+"""
+
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.management.seeding import EMAIL_DOMAIN, clear_dataset, seed_dataset
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = "Bulk-insert seed users, guilds and messages for development and benchmarks"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=10_000)
+        parser.add_argument("--guilds", type=int, default=500)
+        parser.add_argument("--personal-messages", type=int, default=1_000_000)
+        parser.add_argument("--group-messages", type=int, default=1_000_000)
+        parser.add_argument("--conversations-per-user", type=int, default=5)
+        parser.add_argument("--batch-size", type=int, default=5000)
+        parser.add_argument("--seed", type=int, default=0, help="Random seed, for reproducible datasets")
+        parser.add_argument("--flush", action="store_true", help="Delete previously seeded rows first")
+
+    def handle(self, *args, **options):
+        if User.objects.filter(email__endswith=f"@{EMAIL_DOMAIN}").exists():
+            if not options["flush"]:
+                raise CommandError("The database already holds seeded data; rerun with --flush to replace it")
+            self.stdout.write("Deleting the previous seed...")
+            clear_dataset()
+
+        started = time.perf_counter()
+        counts = seed_dataset(
+            users=options["users"],
+            guilds=options["guilds"],
+            personal_messages=options["personal_messages"],
+            group_messages=options["group_messages"],
+            conversations_per_user=options["conversations_per_user"],
+            batch_size=options["batch_size"],
+            seed=options["seed"],
+            log=self.stdout.write,
+        )
+        elapsed = time.perf_counter() - started
+        summary = ", ".join(f"{count} {kind.replace('_', ' ')}" for kind, count in counts.items())
+        self.stdout.write(self.style.SUCCESS(f"Seeded {summary} in {elapsed:.1f}s"))
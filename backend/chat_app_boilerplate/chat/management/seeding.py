@@ -0,0 +1,258 @@
+"""
+Bulk generation of a realistic chat dataset, used by ``seed_chat`` and the
+REST benchmark.
+
+Everything is written with ``bulk_create`` in fixed-size batches, and the
+derived state the normal write path would maintain is filled in directly:
+
+* ``PersonalChat.conversation_key`` and per-conversation ``seq``
+* ``GroupMessage.seq``, plus the ``MessageSequence`` counters behind both
+* one ``ConversationSummary`` per conversation
+* ``Chat_Group.member_count``
+
+Seeded users have ``@seed.invalid`` emails and unusable passwords; seeded
+guilds are named ``seed-guild-<n>``.
+"""
+
+import random
+from contextlib import contextmanager
+from datetime import timedelta
+from itertools import islice
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+from django.utils import timezone
+
+from chat.models import (
+    Chat_Group,
+    ConversationSummary,
+    GroupMessage,
+    MessageSequence,
+    PersonalChat,
+    conversation_key,
+    message_database,
+)
+
+User = get_user_model()
+
+EMAIL_DOMAIN = "seed.invalid"
+GUILD_PREFIX = "seed-guild-"
+
+FIRST_NAMES = [
+    "Aarav", "Aditi", "Ananya", "Arjun", "Diya", "Emma", "Ishaan", "Kabir", "Liam", "Maya",
+    "Meera", "Noah", "Olivia", "Priya", "Rahul", "Riya", "Rohan", "Sara", "Vikram", "Zoya",
+]
+LAST_NAMES = [
+    "Bose", "Chen", "Das", "Garcia", "Gupta", "Iyer", "Jain", "Kapoor", "Khan", "Kumar",
+    "Mehta", "Nair", "Patel", "Rao", "Reddy", "Shah", "Singh", "Smith", "Verma", "Wong",
+]
+WORDS = (
+    "hey hi hello ok sure yes no maybe later tonight tomorrow game match raid loot guild "
+    "meeting lunch coffee code bug deploy review thanks lol nice great cool see you soon"
+).split()
+
+# messages span this much history, oldest first
+HISTORY = timedelta(days=90)
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+@contextmanager
+def explicit_timestamps(*models):
+    """Let bulk_create keep the timestamps set on instances instead of now()"""
+    fields = [model._meta.get_field("timestamp") for model in models]
+    try:
+        for field in fields:
+            field.auto_now_add = False
+        yield
+    finally:
+        for field in fields:
+            field.auto_now_add = True
+
+
+def split(total, parts, rng):
+    """``total`` split into ``parts`` skewed, positive-where-possible counts"""
+    if parts == 0:
+        return []
+    weights = [rng.expovariate(1.0) for _ in range(parts)]
+    scale = total / sum(weights)
+    counts = [int(weight * scale) for weight in weights]
+    for index in range(total - sum(counts)):
+        counts[index % parts] += 1
+    return counts
+
+
+def seed_dataset(
+    users=10_000,
+    guilds=500,
+    personal_messages=1_000_000,
+    group_messages=1_000_000,
+    conversations_per_user=5,
+    batch_size=5000,
+    seed=0,
+    log=None,
+):
+    """Insert a dataset of the given size and return the number of rows of each kind"""
+    rng = random.Random(seed)
+    log = log or (lambda message: None)
+    now = timezone.now()
+    start = now - HISTORY
+
+    # Users
+    password = make_password(None)
+    User.objects.bulk_create((
+        User(
+            email=f"user{index}@{EMAIL_DOMAIN}",
+            name=f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}",
+            password=password,
+            is_active=rng.random() > 0.02,
+        )
+        for index in range(users)
+    ), batch_size=batch_size)
+    user_ids = list(
+        User.objects.filter(email__endswith=f"@{EMAIL_DOMAIN}").order_by("id").values_list("id", flat=True)
+    )
+    log(f"users: {len(user_ids)}")
+
+    # Guilds: disjoint member sets of 2..max_members users; the first member created it
+    max_members = Chat_Group._meta.get_field("max_members").default
+    unassigned = user_ids[:]
+    rng.shuffle(unassigned)
+    memberships = []
+    for index in range(guilds):
+        size = min(rng.randint(2, max_members), len(unassigned))
+        if size < 2:
+            break
+        members, unassigned = unassigned[:size], unassigned[size:]
+        memberships.append((index, members))
+
+    Chat_Group.objects.bulk_create((
+        Chat_Group(
+            name=f"{GUILD_PREFIX}{index}",
+            description=" ".join(rng.choices(WORDS, k=8)),
+            created_by_id=members[0],
+            max_members=max_members,
+            member_count=len(members),
+        )
+        for index, members in memberships
+    ), batch_size=batch_size)
+    guild_ids = dict(
+        Chat_Group.objects.filter(name__startswith=GUILD_PREFIX).values_list("name", "id")
+    )
+    guild_members = []
+    with transaction.atomic():
+        for index, members in memberships:
+            guild_id = guild_ids[f"{GUILD_PREFIX}{index}"]
+            User.objects.filter(id__in=members).update(guild_id=guild_id)
+            guild_members.append((guild_id, members))
+    log(f"guilds: {len(guild_members)}")
+
+    # Personal conversations: each user talks to a few random others
+    keys = {}
+    for user_id in user_ids:
+        for peer_id in rng.sample(user_ids, min(conversations_per_user, len(user_ids) - 1)):
+            if peer_id != user_id:
+                low, high = sorted((user_id, peer_id))
+                keys[conversation_key(low, high)] = (low, high)
+    conversations = list(keys.items())
+
+    personal_counts = split(personal_messages, len(conversations), rng)
+    summaries = []
+    sequences = []
+
+    def personal_rows():
+        for (key, (low, high)), count in zip(conversations, personal_counts):
+            if not count:
+                continue
+            timestamps = sorted(start + HISTORY * rng.random() for _ in range(count))
+            for seq, timestamp in enumerate(timestamps, start=1):
+                sender, receiver = (low, high) if rng.random() < 0.5 else (high, low)
+                row = PersonalChat(
+                    sender_id=sender,
+                    receiver_id=receiver,
+                    conversation_key=key,
+                    seq=seq,
+                    message=" ".join(rng.choices(WORDS, k=rng.randint(1, 12))),
+                    timestamp=timestamp,
+                )
+                yield row
+            summaries.append(ConversationSummary(
+                conversation_key=key,
+                user_low_id=low,
+                user_high_id=high,
+                last_message=row.message[:ConversationSummary.PREVIEW_LENGTH],
+                last_sender_id=row.sender_id,
+                last_timestamp=row.timestamp,
+                unread_low=rng.choice((0, 0, 0, 1, 3)) if row.sender_id == high else 0,
+                unread_high=rng.choice((0, 0, 0, 1, 3)) if row.sender_id == low else 0,
+            ))
+            sequences.append(MessageSequence(key=row.sequence_key(), last_seq=count))
+
+    group_counts = split(group_messages, len(guild_members), rng)
+
+    def group_rows():
+        for (guild_id, members), count in zip(guild_members, group_counts):
+            if not count:
+                continue
+            timestamps = sorted(start + HISTORY * rng.random() for _ in range(count))
+            for seq, timestamp in enumerate(timestamps, start=1):
+                yield GroupMessage(
+                    group_id=guild_id,
+                    sender_id=rng.choice(members),
+                    seq=seq,
+                    message=" ".join(rng.choices(WORDS, k=rng.randint(1, 12))),
+                    timestamp=timestamp,
+                )
+            sequences.append(MessageSequence(key=f"guild:{guild_id}", last_seq=count))
+
+    inserted = {"personal": 0, "group": 0}
+    with explicit_timestamps(PersonalChat, GroupMessage):
+        for kind, model, rows in (("personal", PersonalChat, personal_rows()), ("group", GroupMessage, group_rows())):
+            for batch in batched(rows, batch_size):
+                with transaction.atomic(using=message_database()):
+                    model.objects.bulk_create(batch)
+                inserted[kind] += len(batch)
+                if inserted[kind] % (batch_size * 20) == 0:
+                    log(f"{kind} messages: {inserted[kind]}")
+    log(f"personal messages: {inserted['personal']}, group messages: {inserted['group']}")
+
+    ConversationSummary.objects.bulk_create(summaries, batch_size=batch_size)
+    MessageSequence.objects.bulk_create(sequences, batch_size=batch_size)
+
+    return {
+        "users": len(user_ids),
+        "guilds": len(guild_members),
+        "conversations": len(summaries),
+        "personal_messages": inserted["personal"],
+        "group_messages": inserted["group"],
+    }
+
+
+def clear_dataset():
+    """Delete everything ``seed_dataset`` inserted"""
+    seeded = User.objects.filter(email__endswith=f"@{EMAIL_DOMAIN}")
+    guilds = Chat_Group.objects.filter(name__startswith=GUILD_PREFIX)
+    user_ids = list(seeded.values_list("id", flat=True))
+    guild_ids = list(guilds.values_list("id", flat=True))
+
+    # messages may be in another database (chat/routers.py) and don't cascade;
+    # seeded users only talk to each other
+    with transaction.atomic(using=message_database()):
+        for ids in batched(user_ids, 500):
+            summaries = ConversationSummary.objects.filter(user_low_id__in=ids)
+            keys = [f"personal:{key}" for key in summaries.values_list("conversation_key", flat=True)]
+            MessageSequence.objects.filter(key__in=keys).delete()
+            summaries.delete()
+            PersonalChat.objects.filter(sender_id__in=ids).delete()
+        for ids in batched(guild_ids, 500):
+            MessageSequence.objects.filter(key__in=[f"guild:{guild_id}" for guild_id in ids]).delete()
+            GroupMessage.objects.filter(group_id__in=ids).delete()
+
+    with transaction.atomic():
+        guilds.delete()
+        seeded.delete()
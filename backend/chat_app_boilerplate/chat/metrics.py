@@ -0,0 +1,64 @@
+"""
+Metrics of the chat WebSocket consumers and the message write path,
+exported at /metrics (see chat_app_boilerplate/metrics.py).
+
+Consumer metrics are labelled with the consumer type: "personal",
+"guild" or "stream".
+"""
+
+from chat_app_boilerplate.metrics import counter, gauge, histogram
+
+WS_CONNECTIONS = gauge(
+    "chat_ws_connections", "Open WebSocket connections", ["consumer"]
+)
+WS_CONNECTS = counter(
+    "chat_ws_connects_total", "Accepted WebSocket connections", ["consumer"]
+)
+WS_REJECTS = counter(
+    "chat_ws_rejects_total", "Refused WebSocket connections by reason", ["consumer", "reason"]
+)
+WS_MESSAGES_RECEIVED = counter(
+    "chat_ws_messages_received_total", "Chat messages received from clients", ["consumer"]
+)
+WS_MESSAGES_BROADCAST = counter(
+    "chat_ws_messages_broadcast_total", "Chat messages broadcast to a room group", ["consumer"]
+)
+WS_MESSAGES_SENT = counter(
+    "chat_ws_messages_sent_total", "Chat messages delivered to client sockets", ["consumer"]
+)
+WS_DB_WRITE_SECONDS = histogram(
+    "chat_ws_db_write_seconds",
+    "Time a consumer waits for the message writer to accept (or persist) a message",
+    ["consumer"],
+)
+WS_GROUP_SEND_SECONDS = histogram(
+    "chat_ws_group_send_seconds", "Channel layer group_send latency", ["consumer"]
+)
+WS_OUTBOX_FRAMES = gauge(
+    "chat_ws_outbox_frames", "Frames queued in connection outboxes, waiting for slow clients", ["consumer"]
+)
+WS_OUTBOX_DEPTH = histogram(
+    "chat_ws_outbox_depth",
+    "Depth of a connection outbox when a frame is queued",
+    ["consumer"],
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024),
+)
+WS_OUTBOX_OVERFLOWS = counter(
+    "chat_ws_outbox_overflows_total", "Frames queued into a full outbox, by overflow policy", ["consumer", "policy"]
+)
+WS_OUTBOX_DROPPED = counter(
+    "chat_ws_outbox_dropped_total", "Chat messages dropped or coalesced away by full outboxes", ["consumer"]
+)
+WS_THROTTLED = counter(
+    "chat_ws_messages_throttled_total", "Chat messages refused by flood control, by limit", ["consumer", "limit"]
+)
+
+DB_FLUSH_SECONDS = histogram(
+    "chat_db_flush_seconds", "Duration of one message writer flush transaction"
+)
+DB_FLUSHED_ROWS = counter(
+    "chat_db_flushed_rows_total", "Messages written by the message writer"
+)
+DB_FLUSH_FAILURES = counter(
+    "chat_db_flush_failures_total", "Message writer flushes that failed"
+)
@@ -0,0 +1,52 @@
+# Generated by Django 5.2.5 on 2026-10-17 10:01
+
+from django.conf import settings
+from django.db import migrations, models, transaction
+
+BATCH_SIZE = 2000
+
+
+def backfill_conversation_key(apps, schema_editor):
+    PersonalChat = apps.get_model('chat', 'PersonalChat')
+    db_alias = schema_editor.connection.alias
+    rows = PersonalChat.objects.using(db_alias).filter(conversation_key='').order_by('id')
+
+    last_id = 0
+    while True:
+        batch = list(rows.filter(id__gt=last_id).only('id', 'sender_id', 'receiver_id')[:BATCH_SIZE])
+        if not batch:
+            break
+        for row in batch:
+            low, high = sorted((row.sender_id, row.receiver_id))
+            row.conversation_key = f"{low}_{high}"
+        with transaction.atomic(using=db_alias):
+            PersonalChat.objects.using(db_alias).bulk_update(batch, ['conversation_key'])
+        last_id = batch[-1].id
+
+
+class Migration(migrations.Migration):
+    # commit the backfill batch by batch instead of holding one long write lock
+    atomic = False
+
+    dependencies = [
+        ('chat', '0004_chat_group_created_by'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='personalchat',
+            name='conversation_key',
+            field=models.CharField(default='', editable=False, max_length=41),
+            preserve_default=False,
+        ),
+        migrations.RunPython(backfill_conversation_key, migrations.RunPython.noop, hints={'model_name': 'personalchat'}),
+        migrations.AddIndex(
+            model_name='groupmessage',
+            index=models.Index(fields=['group', 'timestamp', 'id'], name='groupmessage_group_ts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='personalchat',
+            index=models.Index(fields=['conversation_key', 'timestamp', 'id'], name='personalchat_conv_ts_idx'),
+        ),
+    ]
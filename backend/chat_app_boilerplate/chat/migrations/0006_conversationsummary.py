@@ -0,0 +1,73 @@
+# Generated by Django 5.2.5 on 2026-10-17 10:03
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+BATCH_SIZE = 2000
+
+
+def backfill_summaries(apps, schema_editor):
+    """Build one summary per existing conversation from its latest message"""
+    PersonalChat = apps.get_model('chat', 'PersonalChat')
+    ConversationSummary = apps.get_model('chat', 'ConversationSummary')
+    db_alias = schema_editor.connection.alias
+
+    latest = {}
+    last_id = 0
+    while True:
+        batch = list(
+            PersonalChat.objects.using(db_alias)
+            .filter(id__gt=last_id)
+            .order_by('id')
+            .values('id', 'conversation_key', 'sender_id', 'receiver_id', 'message', 'timestamp')[:BATCH_SIZE]
+        )
+        if not batch:
+            break
+        for row in batch:
+            current = latest.get(row['conversation_key'])
+            if current is None or (row['timestamp'], row['id']) >= (current['timestamp'], current['id']):
+                latest[row['conversation_key']] = row
+        last_id = batch[-1]['id']
+
+    summaries = []
+    for key, row in latest.items():
+        low, high = sorted((row['sender_id'], row['receiver_id']))
+        summaries.append(ConversationSummary(
+            conversation_key=key,
+            user_low_id=low,
+            user_high_id=high,
+            last_message=row['message'][:50],
+            last_sender_id=row['sender_id'],
+            last_timestamp=row['timestamp'],
+        ))
+    ConversationSummary.objects.using(db_alias).bulk_create(summaries, batch_size=BATCH_SIZE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_personalchat_conversation_key_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConversationSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('conversation_key', models.CharField(max_length=41, unique=True)),
+                ('last_message', models.CharField(max_length=50)),
+                ('last_timestamp', models.DateTimeField()),
+                ('unread_low', models.PositiveIntegerField(default=0)),
+                ('unread_high', models.PositiveIntegerField(default=0)),
+                ('last_sender', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user_high', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user_low', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user_low', '-last_timestamp'], name='convsummary_low_ts_idx'), models.Index(fields=['user_high', '-last_timestamp'], name='convsummary_high_ts_idx')],
+            },
+        ),
+        migrations.RunPython(backfill_summaries, migrations.RunPython.noop, hints={'model_name': 'conversationsummary'}),
+    ]
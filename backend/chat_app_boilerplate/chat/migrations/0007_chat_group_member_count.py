@@ -0,0 +1,36 @@
+# Generated by Django 5.2.5 on 2026-10-17 10:05
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_member_count(apps, schema_editor):
+    Chat_Group = apps.get_model('chat', 'Chat_Group')
+    db_alias = schema_editor.connection.alias
+    guilds = Chat_Group.objects.using(db_alias).annotate(num_members=models.Count('group_members'))
+    for guild in guilds:
+        guild.member_count = guild.num_members
+        # guilds that the old check-then-act joins overfilled keep their members
+        guild.max_members = max(guild.max_members, guild.num_members)
+        guild.save(update_fields=['member_count', 'max_members'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_conversationsummary'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat_group',
+            name='member_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_member_count, migrations.RunPython.noop, hints={'model_name': 'chat_group'}),
+        migrations.AddConstraint(
+            model_name='chat_group',
+            constraint=models.CheckConstraint(condition=models.Q(('member_count__lte', models.F('max_members'))), name='chat_group_member_count_lte_max'),
+        ),
+    ]
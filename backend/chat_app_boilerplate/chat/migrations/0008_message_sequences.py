@@ -0,0 +1,77 @@
+# Generated by Django 5.2.5 on 2026-10-17 10:09
+
+from django.conf import settings
+from django.db import migrations, models, transaction
+
+BATCH_SIZE = 2000
+
+
+def _number(model, key_of, db_alias, counters):
+    """Number a model's rows per conversation in insertion (id) order"""
+    last_id = 0
+    while True:
+        batch = list(model.objects.using(db_alias).filter(id__gt=last_id).order_by('id')[:BATCH_SIZE])
+        if not batch:
+            break
+        for row in batch:
+            key = key_of(row)
+            counters[key] = counters.get(key, 0) + 1
+            row.seq = counters[key]
+        with transaction.atomic(using=db_alias):
+            model.objects.using(db_alias).bulk_update(batch, ['seq'])
+        last_id = batch[-1].id
+
+
+def backfill_sequences(apps, schema_editor):
+    PersonalChat = apps.get_model('chat', 'PersonalChat')
+    GroupMessage = apps.get_model('chat', 'GroupMessage')
+    MessageSequence = apps.get_model('chat', 'MessageSequence')
+    db_alias = schema_editor.connection.alias
+
+    counters = {}
+    _number(PersonalChat, lambda row: f"personal:{row.conversation_key}", db_alias, counters)
+    _number(GroupMessage, lambda row: f"guild:{row.group_id}", db_alias, counters)
+    MessageSequence.objects.using(db_alias).bulk_create(
+        [MessageSequence(key=key, last_seq=last_seq) for key, last_seq in counters.items()],
+        batch_size=BATCH_SIZE,
+    )
+
+
+class Migration(migrations.Migration):
+    # commit the backfill batch by batch instead of holding one long write lock
+    atomic = False
+
+    dependencies = [
+        ('chat', '0007_chat_group_member_count'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageSequence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64, unique=True)),
+                ('last_seq', models.PositiveBigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='groupmessage',
+            name='seq',
+            field=models.PositiveBigIntegerField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='personalchat',
+            name='seq',
+            field=models.PositiveBigIntegerField(editable=False, null=True),
+        ),
+        migrations.RunPython(backfill_sequences, migrations.RunPython.noop, hints={'model_name': 'messagesequence'}),
+        migrations.AddConstraint(
+            model_name='groupmessage',
+            constraint=models.UniqueConstraint(fields=('group', 'seq'), name='groupmessage_group_seq_uniq'),
+        ),
+        migrations.AddConstraint(
+            model_name='personalchat',
+            constraint=models.UniqueConstraint(fields=('conversation_key', 'seq'), name='personalchat_conv_seq_uniq'),
+        ),
+    ]
@@ -0,0 +1,49 @@
+from django.db import migrations
+
+# Full-text index of chat/search.py's SQLiteFTS5Backend. Contentless: only the
+# inverted index is stored, the text stays in the message tables.
+CREATE_INDEX = """
+    CREATE VIRTUAL TABLE chat_message_fts USING fts5(
+        body, scope, content='', tokenize='unicode61 remove_diacritics 2'
+    )
+"""
+
+# Entry ids: personal message n -> 2n, guild message n -> 2n + 1
+INDEX_MESSAGES = [
+    """
+    INSERT INTO chat_message_fts (rowid, body, scope)
+    SELECT id * 2, message, 'u' || sender_id || ' u' || receiver_id FROM chat_personalchat
+    """,
+    """
+    INSERT INTO chat_message_fts (rowid, body, scope)
+    SELECT id * 2 + 1, message, 'g' || group_id FROM chat_groupmessage
+    """,
+]
+
+
+def create_search_index(apps, schema_editor):
+    # other databases need another CHAT_SEARCH backend
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(CREATE_INDEX)
+        for sql in INDEX_MESSAGES:
+            cursor.execute(sql)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute('DROP TABLE IF EXISTS chat_message_fts')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_message_sequences'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index, hints={'model_name': 'personalchat'}),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.5 on 2026-10-17 10:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0009_message_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchiveSegment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64)),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('count', models.PositiveIntegerField()),
+                ('size', models.PositiveIntegerField()),
+                ('first_seq', models.PositiveBigIntegerField(null=True)),
+                ('last_seq', models.PositiveBigIntegerField(null=True)),
+                ('first_timestamp', models.DateTimeField()),
+                ('first_id', models.BigIntegerField()),
+                ('last_timestamp', models.DateTimeField()),
+                ('last_id', models.BigIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['key', 'last_timestamp', 'last_id'], name='archivesegment_key_last_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.5 on 2026-10-17 11:41
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def backfill_last_seq(apps, schema_editor):
+    PersonalChat = apps.get_model('chat', 'PersonalChat')
+    ConversationSummary = apps.get_model('chat', 'ConversationSummary')
+    db_alias = schema_editor.connection.alias
+
+    newest = (
+        PersonalChat.objects.using(db_alias)
+        .filter(conversation_key=OuterRef('conversation_key'), seq__isnull=False)
+        .order_by('-seq')
+        .values('seq')[:1]
+    )
+    ConversationSummary.objects.using(db_alias).update(last_seq=Subquery(newest))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0011_message_database'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversationsummary',
+            name='last_seq',
+            field=models.PositiveBigIntegerField(null=True),
+        ),
+        migrations.RunPython(backfill_last_seq, migrations.RunPython.noop, hints={'model_name': 'conversationsummary'}),
+    ]
@@ -1,8 +1,11 @@
-from django.db import models
+from django.db import IntegrityError, models, router, transaction
+from django.db.models import Case, F, Q, Value, When
 from django.contrib.auth import get_user_model
 
 from django.core.exceptions import ValidationError
 
+from accounts.token_cache import get_token_cache
+
 User = get_user_model()
 
 
@@ -12,55 +15,343 @@ class Chat_Group(models.Model):
     # related names meaning --> user model mei aisa dekhega --> created_group karke refer karenge
     # this should be on the user model
     created_by = models.OneToOneField(User, on_delete=models.SET_NULL, null=True, related_name='created_group')
-    # many users 
-    # members = models.ForeignKey(User, related_name="chat_groups", blank=True, on_delete=models.DO_NOTHING)
+    # members are the users whose CustomUser.guild points here (related_name='group_members');
+    # member_count mirrors their number so joins can enforce max_members in one UPDATE
     created_at = models.DateTimeField(auto_now_add=True)
     max_members = models.IntegerField(default=15)
+    member_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.CheckConstraint(
+                condition=Q(member_count__lte=F('max_members')),
+                name='chat_group_member_count_lte_max',
+            ),
+        ]
 
     def add_member(self, user):
-        """Add a member to the guild with validation"""
-        # Check if user is already in another guild
-        existing_guilds = Chat_Group.objects.filter(members=user)
-        if existing_guilds.exists():
-            raise ValidationError(f"User {user.email} is already in guild: {existing_guilds.first().name}")
-        
-        # Check if guild is full
-        if self.members.count() >= self.max_members:
-            raise ValidationError(f"Guild is full. Maximum {self.max_members} members allowed.")
-        
-        self.members.add(user)
+        """
+        Add a member to the guild with validation.
+
+        Capacity and one-guild-per-user are both enforced by conditional
+        UPDATEs in one transaction, so concurrent joins can't overshoot
+        max_members or put a user in two guilds.
+        """
+        with transaction.atomic():
+            # Claim a seat; fails when the guild is full
+            claimed = Chat_Group.objects.filter(
+                id=self.id, member_count__lt=F('max_members')
+            ).update(member_count=F('member_count') + 1)
+            if not claimed:
+                raise ValidationError(f"Guild is full. Maximum {self.max_members} members allowed.")
+
+            # Take the user only if they aren't in a guild yet; raising rolls the seat back
+            joined = User.objects.filter(id=user.id, guild__isnull=True).update(guild=self)
+            if not joined:
+                current = Chat_Group.objects.filter(group_members=user).values_list('name', flat=True).first()
+                raise ValidationError(f"User {user.email} is already in guild: {current}")
+
+            # membership changed through update(), which sends no post_save
+            transaction.on_commit(lambda: get_token_cache().invalidate_user(user.id))
+
+        user.guild = self
+        self.refresh_from_db(fields=['member_count'])
 
     def remove_member(self, user):
-        """Remove a member from the guild"""
-        self.members.remove(user)
+        """
+        Remove a member from the guild. Returns True if that left the guild
+        empty and it was deleted.
+        """
+        with transaction.atomic():
+            left = User.objects.filter(id=user.id, guild=self).update(guild=None)
+            if not left:
+                raise ValidationError(f"User {user.email} is not a member of {self.name}")
+            Chat_Group.objects.filter(id=self.id).update(member_count=F('member_count') - 1)
+            # Only deletes if nobody joined in the meantime
+            deleted, _ = Chat_Group.objects.filter(id=self.id, member_count=0).delete()
+            transaction.on_commit(lambda: get_token_cache().invalidate_user(user.id))
+
+        user.guild = None
+        if not deleted:
+            self.refresh_from_db(fields=['member_count'])
+        return bool(deleted)
 
     def __str__(self):
-        return f"{self.name} ({self.members.count()}/{self.max_members} members)"
+        return f"{self.name} ({self.member_count}/{self.max_members} members)"
+
+
+def message_database():
+    """Alias the message models are written to, ``chat`` when configured (see chat/routers.py)"""
+    return router.db_for_write(PersonalChat)
+
+
+def is_active_member(user_id, guild_id=None):
+    """
+    Whether ``user_id`` is active (and in guild ``guild_id``, if given) in the
+    database. Authenticated users may come from another process's token
+    cache (accounts/token_cache.py), which only invalidates its own entries.
+    """
+    users = User.objects.filter(id=user_id, is_active=True)
+    if guild_id is not None:
+        users = users.filter(guild_id=guild_id)
+    return users.exists()
+
+
+def conversation_key(user_id, other_user_id):
+    """Canonical key of a personal conversation: the ordered pair of user ids"""
+    low, high = sorted((user_id, other_user_id))
+    return f"{low}_{high}"
+
+
+class MessageSequenceManager(models.Manager):
+    def allocate(self, key, count=1):
+        """Reserve ``count`` consecutive numbers in sequence ``key``; returns the first"""
+        if not self._advance(key, count):
+            try:
+                with transaction.atomic(using=router.db_for_write(self.model)):
+                    self.create(key=key, last_seq=count)
+                return 1
+            except IntegrityError:
+                # another writer created the counter first
+                self._advance(key, count)
+        last_seq = self.filter(key=key).values_list('last_seq', flat=True).get()
+        return last_seq - count + 1
+
+    def _advance(self, key, count):
+        return self.filter(key=key).update(last_seq=F('last_seq') + count)
+
+    def assign(self, messages):
+        """Give every unsaved message without a seq the next number of its conversation"""
+        by_key = {}
+        for msg in messages:
+            if msg.seq is None:
+                by_key.setdefault(msg.sequence_key(), []).append(msg)
+        for key, rows in by_key.items():
+            first = self.allocate(key, len(rows))
+            for offset, msg in enumerate(rows):
+                msg.seq = first + offset
+
+
+# per-conversation counter behind PersonalChat.seq / GroupMessage.seq
+class MessageSequence(models.Model):
+    key = models.CharField(max_length=64, unique=True)
+    last_seq = models.PositiveBigIntegerField(default=0)
+
+    objects = MessageSequenceManager()
+
+    def __str__(self):
+        return f"{self.key}: {self.last_seq}"
 
 
 # this is the schema of every message of personal chat
 # TODO add end to end encryption
 class PersonalChat(models.Model):
-    sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name="sent_messages")
-    receiver = models.ForeignKey(User, on_delete=models.CASCADE, related_name="received_messages")
+    # users live in the default database (chat/routers.py): no constraint, and
+    # the user_deleted receiver deletes their messages instead of a cascade
+    sender = models.ForeignKey(User, on_delete=models.DO_NOTHING, db_constraint=False, related_name="sent_messages")
+    receiver = models.ForeignKey(User, on_delete=models.DO_NOTHING, db_constraint=False, related_name="received_messages")
+    # denormalized so a conversation is a single index range instead of an OR of two pairs
+    conversation_key = models.CharField(max_length=41, editable=False)
+    # monotonic position within the conversation, lets reconnecting clients resume
+    seq = models.PositiveBigIntegerField(null=True, editable=False)
     message = models.TextField()
     timestamp = models.DateTimeField(auto_now_add=True)
 
     class Meta:
         ordering = ["timestamp"]
+        indexes = [
+            models.Index(fields=["conversation_key", "timestamp", "id"], name="personalchat_conv_ts_idx"),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=["conversation_key", "seq"], name="personalchat_conv_seq_uniq"),
+        ]
+
+    def sequence_key(self):
+        return f"personal:{self.conversation_key}"
+
+    def save(self, *args, **kwargs):
+        # bulk_create skips save(), so bulk writers must set the key and seq themselves
+        if not self.conversation_key:
+            self.conversation_key = conversation_key(self.sender_id, self.receiver_id)
+        if self._state.adding:
+            MessageSequence.objects.assign([self])
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return f"{self.sender} → {self.receiver}: {self.message[:20]}"
 
 
 class GroupMessage(models.Model):
-    group = models.ForeignKey(Chat_Group, on_delete=models.CASCADE, related_name="messages")
-    sender = models.ForeignKey(User, on_delete=models.CASCADE)
+    # deleted with their guild / sender by chat/signals.py, see PersonalChat
+    group = models.ForeignKey(Chat_Group, on_delete=models.DO_NOTHING, db_constraint=False, related_name="messages")
+    sender = models.ForeignKey(User, on_delete=models.DO_NOTHING, db_constraint=False)
+    # monotonic position within the guild, lets reconnecting clients resume
+    seq = models.PositiveBigIntegerField(null=True, editable=False)
     message = models.TextField()
     timestamp = models.DateTimeField(auto_now_add=True)
 
     class Meta:
         ordering = ["timestamp"]
+        indexes = [
+            models.Index(fields=["group", "timestamp", "id"], name="groupmessage_group_ts_idx"),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=["group", "seq"], name="groupmessage_group_seq_uniq"),
+        ]
+
+    def sequence_key(self):
+        return f"guild:{self.group_id}"
+
+    def save(self, *args, **kwargs):
+        if self._state.adding:
+            MessageSequence.objects.assign([self])
+        super().save(*args, **kwargs)
+
+    def __str__(self):
+        return f"[{self.group.name}] {self.sender}: {self.message[:20]}"
+
+
+# one compressed file of archived messages (see chat/archive.py)
+class ArchiveSegment(models.Model):
+    key = models.CharField(max_length=64)  # sequence key of the conversation
+    name = models.CharField(max_length=255, unique=True)  # file in the archive storage
+    count = models.PositiveIntegerField()
+    size = models.PositiveIntegerField()  # compressed bytes
+    first_seq = models.PositiveBigIntegerField(null=True)
+    last_seq = models.PositiveBigIntegerField(null=True)
+    # (timestamp, id) of the oldest and newest message, the history page order
+    first_timestamp = models.DateTimeField()
+    first_id = models.BigIntegerField()
+    last_timestamp = models.DateTimeField()
+    last_id = models.BigIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["key", "last_timestamp", "last_id"], name="archivesegment_key_last_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.key}: {self.count} messages ({self.name})"
+
+
+def _position(msg):
+    """Order of messages within a conversation: seq, or time for rows without one"""
+    return (msg.seq or 0, msg.timestamp, msg.id or 0)
+
+
+class ConversationSummaryManager(models.Manager):
+    def for_user(self, user):
+        """The user's conversations, most recently active first"""
+        return self.filter(Q(user_low=user) | Q(user_high=user)).order_by('-last_timestamp')
+
+    def record_messages(self, messages):
+        """Fold newly stored PersonalChat rows into their conversation summaries"""
+        changes = {}
+        for msg in messages:
+            key = msg.conversation_key or conversation_key(msg.sender_id, msg.receiver_id)
+            low, high = sorted((msg.sender_id, msg.receiver_id))
+            change = changes.setdefault(key, {
+                "user_low_id": low,
+                "user_high_id": high,
+                "unread_low": 0,
+                "unread_high": 0,
+                "last": msg,
+            })
+            if _position(msg) >= _position(change["last"]):
+                change["last"] = msg
+            if msg.receiver_id == low:
+                change["unread_low"] += 1
+            else:
+                change["unread_high"] += 1
+
+        for key, change in changes.items():
+            last = change["last"]
+            latest = {
+                "last_message": last.message[:ConversationSummary.PREVIEW_LENGTH],
+                "last_sender_id": last.sender_id,
+                "last_timestamp": last.timestamp,
+                "last_seq": last.seq,
+            }
+            if self._bump(key, change, latest):
+                continue
+            try:
+                with transaction.atomic(using=router.db_for_write(self.model)):
+                    self.create(
+                        conversation_key=key,
+                        user_low_id=change["user_low_id"],
+                        user_high_id=change["user_high_id"],
+                        unread_low=change["unread_low"],
+                        unread_high=change["unread_high"],
+                        **latest,
+                    )
+            except IntegrityError:
+                # another writer created the row first
+                self._bump(key, change, latest)
+
+    def _bump(self, key, change, latest):
+        # batches may be flushed out of order: the preview only moves forward
+        if latest["last_seq"] is None:
+            newer = Q(last_timestamp__lte=latest["last_timestamp"])
+        else:
+            newer = Q(last_seq__isnull=True) | Q(last_seq__lt=latest["last_seq"])
+        return self.filter(conversation_key=key).update(
+            unread_low=F("unread_low") + change["unread_low"],
+            unread_high=F("unread_high") + change["unread_high"],
+            **{
+                name: Case(
+                    When(newer, then=Value(value)),
+                    default=F(name),
+                    output_field=self.model._meta.get_field(name),
+                )
+                for name, value in latest.items()
+            },
+        )
+
+    def mark_read(self, key, user_id):
+        """Reset ``user_id``'s unread counter in the conversation ``key``"""
+        low, high = (int(part) for part in key.split("_"))
+        if user_id == low:
+            self.filter(conversation_key=key).exclude(unread_low=0).update(unread_low=0)
+        elif user_id == high:
+            self.filter(conversation_key=key).exclude(unread_high=0).update(unread_high=0)
+
+
+# one row per pair of users who have talked, maintained by the message write path
+class ConversationSummary(models.Model):
+    PREVIEW_LENGTH = 50
+
+    conversation_key = models.CharField(max_length=41, unique=True)
+    # deleted with either user by chat/signals.py, see PersonalChat
+    user_low = models.ForeignKey(User, on_delete=models.DO_NOTHING, db_constraint=False, related_name="+")
+    user_high = models.ForeignKey(User, on_delete=models.DO_NOTHING, db_constraint=False, related_name="+")
+    last_message = models.CharField(max_length=PREVIEW_LENGTH)
+    last_sender = models.ForeignKey(
+        User, on_delete=models.DO_NOTHING, db_constraint=False, null=True, related_name="+"
+    )
+    last_timestamp = models.DateTimeField()
+    # seq of the last message; older messages stored later don't replace it
+    last_seq = models.PositiveBigIntegerField(null=True)
+    # unread messages for each side of the conversation
+    unread_low = models.PositiveIntegerField(default=0)
+    unread_high = models.PositiveIntegerField(default=0)
+
+    objects = ConversationSummaryManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user_low", "-last_timestamp"], name="convsummary_low_ts_idx"),
+            models.Index(fields=["user_high", "-last_timestamp"], name="convsummary_high_ts_idx"),
+        ]
+
+    def peer_of(self, user):
+        return self.user_high if self.user_low_id == user.id else self.user_low
+
+    def peer_id_of(self, user):
+        return self.user_high_id if self.user_low_id == user.id else self.user_low_id
+
+    def unread_for(self, user):
+        return self.unread_low if self.user_low_id == user.id else self.unread_high
 
     def __str__(self):
-        return f"[{self.group.name}] {self.sender}: {self.message[:20]}"
\ No newline at end of file
+        return f"{self.conversation_key}: {self.last_message[:20]}"
@@ -0,0 +1,210 @@
+"""
+Bounded per-connection outbound queues.
+
+Consumer handlers used to ``await self.send(...)`` for every channel layer
+event. A slow client therefore stalled the consumer's receive loop, and
+undelivered events piled up in the channel layer. Frames now go into
+the connection's ``Outbox``, a bounded deque drained by a separate sender
+task. Handlers never wait on the client.
+
+When the outbox holds ``MAX_FRAMES`` frames, ``settings.CHAT_OUTBOX["POLICY"]``
+decides what happens:
+
+* ``coalesce`` (default): the queued chat messages are collapsed into one
+  ``{"type": "resync_required", "resume_from": <seq>}`` frame per
+  conversation. The client then fetches what it missed with
+  ``resume_from``.
+* ``drop_oldest``: the oldest queued chat message is discarded.
+* ``disconnect``: the socket is closed with ``CLOSE_TOO_SLOW`` (4008) and
+  the client reconnects and resumes.
+
+Control frames (subscribed, errors, resync markers) are never dropped or
+coalesced. They still count towards ``HARD_LIMIT``: a connection with that
+many frames of any kind queued is closed with ``CLOSE_TOO_SLOW``, whatever
+the policy.
+
+Resume replays can be longer than the outbox, so they don't rely on the
+policy: each replayed message waits for room (``wait_for_room``), and a
+client that doesn't make room within ``REPLAY_TIMEOUT`` seconds is closed
+with ``CLOSE_TOO_SLOW``. Coalescing a replay would only send the client
+back to where it resumed from.
+"""
+
+import asyncio
+from collections import deque
+
+from django.conf import settings
+
+from .metrics import (
+    WS_MESSAGES_SENT,
+    WS_OUTBOX_DEPTH,
+    WS_OUTBOX_DROPPED,
+    WS_OUTBOX_FRAMES,
+    WS_OUTBOX_OVERFLOWS,
+)
+
+DROP_OLDEST = "drop_oldest"
+COALESCE = "coalesce"
+DISCONNECT = "disconnect"
+POLICIES = (DROP_OLDEST, COALESCE, DISCONNECT)
+
+# application close code (4000-4999) for a client that can't keep up
+CLOSE_TOO_SLOW = 4008
+
+DEFAULTS = {
+    "MAX_FRAMES": 256,
+    "POLICY": COALESCE,
+    # frames of any kind, control frames included
+    "HARD_LIMIT": 1024,
+    # seconds a resume replay waits for the client to make room
+    "REPLAY_TIMEOUT": 10,
+}
+
+
+def outbox_options():
+    options = {**DEFAULTS, **getattr(settings, "CHAT_OUTBOX", {})}
+    if options["POLICY"] not in POLICIES:
+        raise ValueError(f"Unknown outbox policy: {options['POLICY']}")
+    if not 1 <= options["MAX_FRAMES"] <= options["HARD_LIMIT"]:
+        raise ValueError("CHAT_OUTBOX MAX_FRAMES must be at least 1 and at most HARD_LIMIT")
+    return options
+
+
+class Frame:
+    __slots__ = ("data", "channel", "seq", "droppable", "resync")
+
+    def __init__(self, data, channel=None, seq=None, droppable=True, resync=False):
+        self.data = data  # serialized frame: text, or bytes for binary frames
+        self.channel = channel  # stream channel id; None on per-room sockets
+        self.seq = seq
+        self.droppable = droppable  # chat messages are, control frames aren't
+        self.resync = resync  # a resync marker left by coalescing
+
+
+class Outbox:
+    def __init__(self, send, close, consumer_type, max_frames, hard_limit, policy, marker):
+        self._send = send  # coroutine function taking the serialized frame
+        self._close = close  # coroutine function closing the socket with a code
+        self.consumer_type = consumer_type
+        self.max_frames = max_frames
+        self.hard_limit = hard_limit
+        self.policy = policy
+        self._marker = marker  # (channel, resume_from) -> serialized resync frame
+        self._frames = deque()
+        self._wakeup = asyncio.Event()
+        self._taken = asyncio.Event()  # set whenever the sender takes a frame
+        self._task = None
+        self.closed = False
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        self.closed = True
+        self._taken.set()  # wake a replay waiting for room
+        WS_OUTBOX_FRAMES.labels(self.consumer_type).dec(len(self._frames))
+        self._frames.clear()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._task = None
+
+    def __len__(self):
+        return len(self._frames)
+
+    def put(self, frame):
+        """Queue ``frame`` without waiting; applies the overflow policy when full"""
+        if self.closed:
+            return
+        if len(self._frames) >= self.hard_limit:
+            # control frames alone have filled the outbox
+            WS_OUTBOX_OVERFLOWS.labels(self.consumer_type, DISCONNECT).inc()
+            self._disconnect()
+            return
+        if frame.droppable and len(self._frames) >= self.max_frames:
+            WS_OUTBOX_OVERFLOWS.labels(self.consumer_type, self.policy).inc()
+            if self.policy == DISCONNECT:
+                self._disconnect()
+                return
+            if self.policy == DROP_OLDEST:
+                self._drop_oldest()
+            else:
+                self._coalesce()
+                if any(queued.resync and queued.channel == frame.channel for queued in self._frames):
+                    # the client will refetch this conversation anyway
+                    WS_OUTBOX_DROPPED.labels(self.consumer_type).inc()
+                    return
+
+        self._frames.append(frame)
+        WS_OUTBOX_FRAMES.labels(self.consumer_type).inc()
+        WS_OUTBOX_DEPTH.labels(self.consumer_type).observe(len(self._frames))
+        self._wakeup.set()
+
+    async def wait_for_room(self, timeout):
+        """
+        Wait until a chat message can be queued without overflowing; closes
+        the socket with ``CLOSE_TOO_SLOW`` after ``timeout`` seconds. Returns
+        whether the outbox is still open.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while not self.closed and len(self._frames) >= self.max_frames:
+            self._taken.clear()
+            try:
+                await asyncio.wait_for(self._taken.wait(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                if not self.closed:
+                    WS_OUTBOX_OVERFLOWS.labels(self.consumer_type, DISCONNECT).inc()
+                    self._disconnect()
+        return not self.closed
+
+    def _disconnect(self):
+        self.closed = True
+        asyncio.ensure_future(self._close(CLOSE_TOO_SLOW))
+
+    def _drop_oldest(self):
+        for index, queued in enumerate(self._frames):
+            if queued.droppable:
+                del self._frames[index]
+                WS_OUTBOX_DROPPED.labels(self.consumer_type).inc()
+                WS_OUTBOX_FRAMES.labels(self.consumer_type).dec()
+                return
+
+    def _coalesce(self):
+        kept = deque()
+        # conversations with a marker still queued from an earlier overflow
+        marked = {queued.channel for queued in self._frames if queued.resync}
+        markers = 0
+        dropped = 0
+        for queued in self._frames:
+            if not queued.droppable:
+                kept.append(queued)
+                continue
+            dropped += 1
+            if queued.channel in marked:
+                continue
+            marked.add(queued.channel)
+            markers += 1
+            # everything before the first dropped message was already queued in order
+            resume_from = queued.seq - 1 if queued.seq is not None else None
+            kept.append(Frame(
+                self._marker(queued.channel, resume_from), queued.channel, droppable=False, resync=True,
+            ))
+        self._frames = kept
+        WS_OUTBOX_DROPPED.labels(self.consumer_type).inc(dropped)
+        WS_OUTBOX_FRAMES.labels(self.consumer_type).dec(dropped - markers)
+
+    async def _run(self):
+        while True:
+            while not self._frames:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            frame = self._frames.popleft()
+            self._taken.set()
+            WS_OUTBOX_FRAMES.labels(self.consumer_type).dec()
+            await self._send(frame.data)
+            if frame.droppable:
+                WS_MESSAGES_SENT.labels(self.consumer_type).inc()
@@ -0,0 +1,143 @@
+"""
+Keyset (cursor) pagination for message history.
+
+Pages are windows of the newest ``limit`` messages older than the cursor,
+ordered by ``(timestamp, id)`` so rows sharing a timestamp are never skipped
+or repeated. A cursor is the opaque, URL-safe encoding of the oldest row of
+the previous page; pass it back as ``?before=<cursor>`` to page further back.
+"""
+
+import base64
+import binascii
+from datetime import datetime
+
+from django.contrib.auth import get_user_model
+from django.db.models import Q
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+
+# Only the columns the history payload needs; senders are looked up once per
+# page (``with_senders``), as users may live in another database than messages
+MESSAGE_FIELDS = ("id", "seq", "message", "timestamp", "sender_id")
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(*values):
+    raw = "|".join(
+        value.isoformat() if isinstance(value, datetime) else str(value)
+        for value in values
+    ).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def parse_timestamp(value):
+    """An aware datetime; message timestamps are compared with aware ones"""
+    timestamp = datetime.fromisoformat(value)
+    if timestamp.tzinfo is None:
+        raise ValueError(f"Timestamp without a time zone: {value}")
+    return timestamp
+
+
+def decode_cursor(cursor, types=(parse_timestamp, int)):
+    """
+    Return the values encoded in ``cursor``, each parsed by the matching
+    callable in ``types`` - by default a message ``(timestamp, id)`` pair.
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        # only the leading value may itself contain "|" (e.g. a user name)
+        values = base64.urlsafe_b64decode(padded).decode().rsplit("|", len(types) - 1)
+        if len(values) != len(types):
+            raise ValueError(cursor)
+        return tuple(parse(value) for parse, value in zip(types, values))
+    except (binascii.Error, UnicodeDecodeError, ValueError) as e:
+        raise InvalidCursor(f"Invalid cursor: {cursor}") from e
+
+
+def with_senders(rows):
+    """
+    ``rows`` (with a ``sender_id``) with ``sender__email`` / ``sender__name``
+    filled in by one query; rows of senders that no longer exist are dropped
+    """
+    if not rows:
+        return rows
+    senders = {
+        pk: (email, name)
+        for pk, email, name in get_user_model().objects.filter(
+            id__in={row["sender_id"] for row in rows}
+        ).values_list("id", "email", "name")
+    }
+    found = []
+    for row in rows:
+        sender = senders.get(row["sender_id"])
+        if sender is not None:
+            row["sender__email"], row["sender__name"] = sender
+            found.append(row)
+    return found
+
+
+def parse_limit(value):
+    if value in (None, ""):
+        return DEFAULT_LIMIT
+    try:
+        limit = int(value)
+    except (TypeError, ValueError) as e:
+        raise InvalidCursor(f"Invalid limit: {value}") from e
+    return max(1, min(limit, MAX_LIMIT))
+
+
+def paginate_messages(queryset, before=None, limit=DEFAULT_LIMIT):
+    """
+    Return one page of ``queryset`` as ``(rows, next_cursor)``.
+
+    ``rows`` are value dicts in chronological order (oldest first) so a
+    client can prepend older pages; ``next_cursor`` is ``None`` on the last page.
+    """
+    if before:
+        timestamp, pk = decode_cursor(before)
+        queryset = queryset.filter(
+            Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=pk)
+        )
+
+    window = list(
+        queryset.order_by("-timestamp", "-id").values(*MESSAGE_FIELDS)[:limit + 1]
+    )
+    has_more = len(window) > limit
+    window = window[:limit]
+    window.reverse()
+
+    next_cursor = None
+    if has_more:
+        # from the stored rows: with_senders may leave some out
+        oldest = window[0]
+        next_cursor = encode_cursor(oldest["timestamp"], oldest["id"])
+    return with_senders(window), next_cursor
+
+
+def messages_after(queryset, after_seq, limit):
+    """
+    Messages of ``queryset`` with a seq greater than ``after_seq``, in seq
+    order - or ``None`` if more than ``limit`` are missing, in which case the
+    client should reload history instead of replaying.
+    """
+    rows = list(
+        queryset.filter(seq__gt=after_seq).order_by("seq").values(*MESSAGE_FIELDS)[:limit + 1]
+    )
+    if len(rows) > limit:
+        return None
+    return with_senders(rows)
+
+
+def serialize_message(row):
+    return {
+        "id": row["id"],
+        "seq": row["seq"],
+        "message": row["message"],
+        "sender": row["sender__email"],
+        "sender_name": row["sender__name"],
+        "timestamp": row["timestamp"].isoformat(),
+    }
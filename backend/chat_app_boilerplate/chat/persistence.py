@@ -0,0 +1,225 @@
+"""
+Write-behind persistence for chat messages.
+
+The consumers used to run one ``objects.create`` per frame, which meant one
+thread-pool hop and one INSERT/commit (one SQLite write lock) per message.
+Instead they now hand unsaved ``PersonalChat``/``GroupMessage`` instances to
+the per-process ``MessageWriter``, which buffers them and writes them with
+``bulk_create`` once a batch is full or the flush interval has elapsed.
+
+Durability is configured through ``settings.CHAT_PERSISTENCE["DURABILITY"]``:
+
+* ``ack_after_persist`` (default) - ``write()`` returns once the batch holding
+  the message is committed, so a broadcast always refers to a stored row and
+  carries its per-conversation ``seq``.
+* ``ack_after_enqueue`` - ``write()`` returns as soon as the message is queued.
+  Broadcast latency no longer depends on the INSERT at all, at the cost of
+  losing at most one flush interval of messages if the process crashes.
+  Sequence numbers are assigned at flush time, so broadcasts carry no ``seq``:
+  clients can't tell how far they got from live messages, and resuming
+  (``?resume_from=``, chat/consumers.py) only works from the seq of a
+  replayed or fetched message. Use ``ack_after_persist`` if clients resume.
+
+All flushes run on one dedicated writer thread with its own connection, so
+chat writes never compete with each other for SQLite's write lock. A flush
+takes everything buffered by the time the thread gets to it: while one
+transaction commits, the next batch collects, and commits as one group.
+
+Pending rows are flushed on every consumer disconnect and on interpreter
+shutdown (``atexit``).
+"""
+
+import asyncio
+import atexit
+import logging
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.dispatch import Signal
+
+from chat_app_boilerplate.metrics import REGISTRY
+
+from .metrics import DB_FLUSH_FAILURES, DB_FLUSH_SECONDS, DB_FLUSHED_ROWS
+from .models import MessageSequence, message_database
+
+logger = logging.getLogger(__name__)
+
+# Sent inside the flush transaction once per model with the rows just
+# inserted (sender=model class, messages=[instances]). bulk_create doesn't
+# send post_save, so derived state (summaries, indexes, ...) hooks in here.
+messages_persisted = Signal()
+
+ACK_AFTER_PERSIST = "ack_after_persist"
+ACK_AFTER_ENQUEUE = "ack_after_enqueue"
+
+DEFAULTS = {
+    "DURABILITY": ACK_AFTER_PERSIST,
+    "BATCH_SIZE": 100,
+    # seconds a message may wait in the buffer before a partial batch is flushed
+    "FLUSH_INTERVAL": 0.02,
+}
+
+
+class MessageWriter:
+    """Buffers unsaved message instances and flushes them in bulk."""
+
+    def __init__(self, batch_size, flush_interval, durability):
+        if durability not in (ACK_AFTER_PERSIST, ACK_AFTER_ENQUEUE):
+            raise ValueError(f"Unknown durability mode: {durability}")
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.durability = durability
+
+        # (instance, future) pairs; future is None in ack-after-enqueue mode
+        self._pending = []
+        self._lock = threading.Lock()
+        self._timer = None
+        self._timer_loop = None
+        self._tasks = set()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chat-db-writer")
+
+    async def write(self, obj):
+        """
+        Queue ``obj`` for insertion.
+
+        In ack-after-persist mode this waits for the batch to be committed and
+        re-raises any database error; otherwise it returns immediately.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future() if self.durability == ACK_AFTER_PERSIST else None
+
+        with self._lock:
+            self._pending.append((obj, future))
+            batch_full = len(self._pending) >= self.batch_size
+
+        if batch_full:
+            self._start_flush(loop)
+        else:
+            self._arm_timer(loop)
+
+        if future is not None:
+            await future
+        return obj
+
+    async def flush(self):
+        """Write everything that is currently buffered."""
+        with self._lock:
+            self._cancel_timer()
+            if not self._pending:
+                return
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._drain)
+
+    def flush_sync(self):
+        """Synchronous flush used at interpreter shutdown, when no loop is running."""
+        with self._lock:
+            self._timer = None
+            self._timer_loop = None
+        # the writer thread has been joined by now; new work can't be submitted to it
+        self._drain()
+
+    def _drain(self):
+        # on the writer thread: everything buffered so far becomes one transaction
+        with self._lock:
+            batch, self._pending = self._pending, []
+        if not batch:
+            return
+
+        try:
+            self._persist([obj for obj, _ in batch])
+        except Exception as exc:
+            DB_FLUSH_FAILURES.inc()
+            # don't reuse a connection the failure may have broken
+            close_old_connections()
+            waiting = [future for _, future in batch if future is not None]
+            if not waiting:
+                logger.exception("Dropped %d chat messages: bulk insert failed", len(batch))
+            for future in waiting:
+                _resolve(future, exc)
+            return
+
+        for _, future in batch:
+            if future is not None:
+                _resolve(future)
+
+    def _persist(self, objs):
+        by_model = defaultdict(list)
+        for obj in objs:
+            by_model[type(obj)].append(obj)
+
+        started = time.perf_counter()
+        with transaction.atomic(using=message_database()):
+            for model, rows in by_model.items():
+                # numbered inside the transaction so a failed batch leaves no gaps
+                MessageSequence.objects.assign(rows)
+                model.objects.bulk_create(rows)
+                messages_persisted.send(sender=model, messages=rows)
+        DB_FLUSH_SECONDS.observe_since(started)
+        DB_FLUSHED_ROWS.inc(len(objs))
+
+    def _arm_timer(self, loop):
+        with self._lock:
+            if self._timer is not None and self._timer_loop is loop:
+                return
+            self._cancel_timer()
+            self._timer = loop.call_later(self.flush_interval, self._start_flush, loop)
+            self._timer_loop = loop
+
+    def _cancel_timer(self):
+        # caller holds self._lock
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = None
+        self._timer_loop = None
+
+    def _start_flush(self, loop):
+        task = loop.create_task(self.flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+
+def _resolve(future, exc=None):
+    """Complete ``future`` from the writer thread, on its own event loop"""
+    def complete():
+        if future.done():
+            return
+        if exc is None:
+            future.set_result(None)
+        else:
+            future.set_exception(exc)
+
+    try:
+        future.get_loop().call_soon_threadsafe(complete)
+    except RuntimeError:
+        pass  # the loop is closed; nobody is waiting any more
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    """Return the process-wide writer, creating it from settings on first use."""
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                options = {**DEFAULTS, **getattr(settings, "CHAT_PERSISTENCE", {})}
+                _writer = MessageWriter(
+                    batch_size=options["BATCH_SIZE"],
+                    flush_interval=options["FLUSH_INTERVAL"],
+                    durability=options["DURABILITY"],
+                )
+                atexit.register(_writer.flush_sync)
+    return _writer
+
+
+def _writer_samples():
+    pending = len(_writer._pending) if _writer is not None else 0
+    return [("chat_db_pending_messages", "gauge", "Messages buffered in the message writer", [({}, pending)])]
+
+
+REGISTRY.register_collector(_writer_samples)
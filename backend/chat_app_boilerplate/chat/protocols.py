@@ -0,0 +1,151 @@
+"""
+Wire formats of the chat WebSockets.
+
+A client picks one when it connects, through the WebSocket subprotocol
+(``new WebSocket(url, ["chat.msgpack"])``):
+
+* ``chat.json`` (default, also used when no subprotocol is offered): JSON
+  text frames, encoded through chat_app_boilerplate/fastjson.py.
+* ``chat.msgpack``: the same frame objects as MessagePack binary frames,
+  smaller and cheaper to parse for mobile clients and bots. Text frames are
+  still read as JSON on these sockets.
+
+Incoming frames must decode to a map; anything else raises
+``InvalidFrame``. MessagePack extension types are refused, so frames carry
+only plain values, and so are NaN and infinite floats, which JSON can't
+carry: a frame is accepted or refused the same with either protocol.
+
+A broadcast's JSON frame is serialized once by the sender
+(``chat_message_event``) and sent as is by every JSON socket. MessagePack
+sockets encode the frame themselves, about a microsecond each.
+"""
+
+import math
+
+import msgpack
+
+from chat_app_boilerplate import fastjson
+
+
+class InvalidFrame(ValueError):
+    pass
+
+
+def message_frame(event):
+    """The frame a per-room socket sends for a ``chat_message`` event"""
+    return {
+        "message": event["message"],
+        "sender": event["sender"],
+        "sender_name": event["sender_name"],
+        "timestamp": event["timestamp"],
+        "seq": event.get("seq"),
+    }
+
+
+def chat_message_event(room, sender, message, timestamp, seq):
+    """
+    The channel layer event of a new message. Its JSON frame is serialized
+    here, once per broadcast, and every JSON socket sends (or extends) that text.
+    """
+    event = {
+        "type": "chat_message",
+        "room": room,
+        "message": message,
+        "sender": sender.email,
+        "sender_name": sender.name,
+        "timestamp": timestamp,
+        "seq": seq,
+    }
+    event["frame"] = fastjson.dumps(message_frame(event))
+    return event
+
+
+def _as_map(data):
+    if not isinstance(data, dict):
+        raise InvalidFrame("Frames must be objects")
+    return data
+
+
+class JSONProtocol:
+    name = "JSON"
+    subprotocol = "chat.json"
+
+    def encode(self, payload):
+        return fastjson.dumps(payload)
+
+    def encode_message(self, event, channel=None):
+        """The frame of a ``chat_message`` event, tagged with ``channel`` on stream sockets"""
+        # events sent by workers running older code carry no frame
+        frame = event.get("frame") or fastjson.dumps(message_frame(event))
+        if channel is None:
+            return frame
+        # {"type": "message", "channel": ..., **message_frame(event)}, reusing the broadcast's text
+        return '{"type":"message","channel":' + fastjson.dumps(channel) + "," + frame[1:]
+
+    def decode(self, text_data=None, bytes_data=None):
+        try:
+            return _as_map(fastjson.loads(text_data if text_data is not None else bytes_data))
+        except (ValueError, TypeError) as e:  # JSONDecodeError is a ValueError
+            raise InvalidFrame(str(e)) from e
+
+
+def _refuse_ext(code, data):
+    raise InvalidFrame(f"MessagePack extension type {code} is not allowed")
+
+
+def _refuse_non_finite(values):
+    for value in values:
+        if isinstance(value, float) and not math.isfinite(value):
+            raise InvalidFrame(f"Out of range float values are not allowed: {value}")
+
+
+def _finite_map(data):
+    _refuse_non_finite(data.values())
+    return data
+
+
+def _finite_list(data):
+    _refuse_non_finite(data)
+    return data
+
+
+class MessagePackProtocol(JSONProtocol):
+    name = "MessagePack"
+    subprotocol = "chat.msgpack"
+
+    def encode(self, payload):
+        return msgpack.packb(payload)
+
+    def encode_message(self, event, channel=None):
+        frame = message_frame(event)
+        if channel is not None:
+            frame = {"type": "message", "channel": channel, **frame}
+        return msgpack.packb(frame)
+
+    def decode(self, text_data=None, bytes_data=None):
+        if bytes_data is None:
+            return super().decode(text_data)
+        try:
+            return _as_map(msgpack.unpackb(
+                bytes_data, ext_hook=_refuse_ext, object_hook=_finite_map, list_hook=_finite_list,
+            ))
+        except (ValueError, TypeError, msgpack.UnpackException) as e:
+            raise InvalidFrame(str(e)) from e
+
+
+JSON = JSONProtocol()
+MESSAGEPACK = MessagePackProtocol()
+
+PROTOCOLS = (JSON, MESSAGEPACK)
+
+
+def negotiate(subprotocols):
+    """
+    ``(protocol, subprotocol to accept)`` for the subprotocols a client
+    offered: the first supported one it listed, else JSON without one
+    """
+    supported = {protocol.subprotocol: protocol for protocol in PROTOCOLS}
+    for offered in subprotocols:
+        if offered in supported:
+            return supported[offered], offered
+    return JSON, None
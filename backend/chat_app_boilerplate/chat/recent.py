@@ -0,0 +1,258 @@
+"""
+Recent messages of active conversations, kept in memory.
+
+Most history reads are the newest page of a handful of busy guilds and
+DMs. For each conversation read or written recently, the newest ``SIZE``
+messages are kept as history rows (the ``MESSAGE_FIELDS`` dicts of
+chat/pagination.py) together with a version: the ``seq`` of the newest
+one.
+
+* The message writer appends every committed batch (``messages_persisted``,
+  on commit); a batch that doesn't continue the version drops the entry.
+* A first-page read is served from the entry when it holds enough rows,
+  after checking its version against the conversation's MessageSequence
+  counter. That one-row lookup replaces the history query. If another
+  process wrote since, the versions differ and the read falls back to the
+  database, whose page then refills the entry.
+* Guild deletion (e.g. the last member leaving) and message deletion in the
+  admin drop the affected entries.
+
+``BACKEND`` "local" keeps entries in this process, bounded by ``MAX_ROOMS``
+conversations and roughly ``MAX_BYTES`` of rows, evicting the least
+recently used. "shared" keeps them in the Django cache named ``CACHE`` (for
+several workers behind a shared cache), expiring after ``TIMEOUT`` seconds.
+The version check keeps both correct when several processes write.
+"""
+
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+from chat_app_boilerplate.metrics import REGISTRY
+
+from .models import MessageSequence
+from .pagination import encode_cursor
+
+LOCAL = "local"
+SHARED = "shared"
+
+DEFAULTS = {
+    "BACKEND": LOCAL,
+    "SIZE": 50,  # messages kept per conversation
+    "MAX_ROOMS": 1000,  # local: conversations kept
+    "MAX_BYTES": 32 * 1024 * 1024,  # local: approximate size of the kept rows
+    "CACHE": "default",  # shared: cache alias
+    "TIMEOUT": 3600,  # shared: seconds an idle conversation is kept
+}
+
+# rough per-row cost of the dict, its keys and the datetime, besides the strings
+ROW_OVERHEAD = 400
+
+
+def message_row(message):
+    """The history row of a saved PersonalChat / GroupMessage"""
+    return {
+        "id": message.id,
+        "seq": message.seq,
+        "message": message.message,
+        "timestamp": message.timestamp,
+        "sender_id": message.sender_id,
+        "sender__email": message.sender.email,
+        "sender__name": message.sender.name,
+    }
+
+
+def row_size(row):
+    return ROW_OVERHEAD + len(row["message"]) + len(row["sender__email"]) + len(row["sender__name"] or "")
+
+
+def current_version(key):
+    return MessageSequence.objects.filter(key=key).values_list("last_seq", flat=True).first() or 0
+
+
+class Entry:
+    """Immutable; appending builds a new entry, so readers never see one change"""
+
+    __slots__ = ("rows", "version", "complete", "size")
+
+    def __init__(self, rows, version, complete):
+        self.rows = tuple(rows)
+        self.version = version  # seq of the newest row; 0 for an empty conversation
+        self.complete = complete  # rows start at the conversation's first message
+        self.size = sum(row_size(row) for row in self.rows)
+
+    def extended(self, rows, maxlen):
+        """This entry plus ``rows``, or None if they don't continue it (it is stale)"""
+        if rows[0]["seq"] != self.version + 1:
+            return None
+        kept = (self.rows + tuple(rows))[-maxlen:]
+        complete = self.complete and len(self.rows) + len(rows) <= maxlen
+        return Entry(kept, rows[-1]["seq"], complete)
+
+    def page(self, limit):
+        """``(rows, next_cursor)`` of the newest ``limit`` rows, or None if not held"""
+        if len(self.rows) < limit and not self.complete:
+            return None
+        rows = list(self.rows[-limit:])
+        next_cursor = None
+        if len(self.rows) > limit or (rows and not self.complete):
+            next_cursor = encode_cursor(rows[0]["timestamp"], rows[0]["id"])
+        return rows, next_cursor
+
+
+class RecentMessages:
+    """Shared logic of both backends; subclasses store entries by sequence key"""
+
+    def __init__(self, size):
+        self.size = size
+
+    def first_page(self, key, limit):
+        """
+        The newest page of conversation ``key`` as ``paginate_messages``
+        returns it, or None if it must come from the database
+        """
+        entry = self.get(key)
+        if entry is None:
+            return None
+        page = entry.page(limit)
+        if page is None:
+            return None
+        if current_version(key) != entry.version:
+            self.discard(key)
+            return None
+        return page
+
+    def fill(self, key, rows, next_cursor):
+        """Remember the newest page just read from the database"""
+        if any(row["seq"] is None for row in rows):
+            return  # written before messages were numbered
+        version = rows[-1]["seq"] if rows else 0
+        complete = next_cursor is None and len(rows) <= self.size
+        self.set(key, Entry(rows[-self.size:], version, complete))
+
+    def record(self, messages):
+        """Append a committed batch of saved messages to the entries of their conversations"""
+        by_key = {}
+        for message in messages:
+            by_key.setdefault(message.sequence_key(), []).append(message)
+        for key, batch in by_key.items():
+            entry = self.get(key)
+            if entry is None:
+                continue  # not read recently; the next read fills it
+            rows = [message_row(message) for message in sorted(batch, key=lambda message: message.seq)]
+            entry = entry.extended(rows, self.size)
+            if entry is None:
+                self.discard(key)
+            else:
+                self.set(key, entry)
+
+
+class LocalRecentMessages(RecentMessages):
+    def __init__(self, size, max_rooms, max_bytes):
+        super().__init__(size)
+        self.max_rooms = max_rooms
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        # views run in worker threads, the writer in the sync_to_async thread
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous.size
+            self._entries[key] = entry
+            self._bytes += entry.size
+            while len(self._entries) > self.max_rooms or self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.size
+
+    def discard(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._bytes -= entry.size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {"rooms": len(self._entries), "bytes": self._bytes}
+
+
+class SharedRecentMessages(RecentMessages):
+    GENERATION_KEY = "chat:recent:generation"
+
+    def __init__(self, size, cache_alias, timeout):
+        super().__init__(size)
+        self.cache = caches[cache_alias]
+        self.timeout = timeout
+
+    def _key(self, key):
+        # a new generation (see clear) orphans every stored entry at once
+        generation = self.cache.get_or_set(self.GENERATION_KEY, 1, timeout=None)
+        return f"chat:recent:{generation}:{key}"
+
+    def get(self, key):
+        return self.cache.get(self._key(key))
+
+    def set(self, key, entry):
+        self.cache.set(self._key(key), entry, timeout=self.timeout)
+
+    def discard(self, key):
+        self.cache.delete(self._key(key))
+
+    def clear(self):
+        try:
+            self.cache.incr(self.GENERATION_KEY)
+        except ValueError:
+            pass  # no generation yet, so nothing was stored under one
+
+
+def _build():
+    options = {**DEFAULTS, **getattr(settings, "CHAT_RECENT_MESSAGES", {})}
+    if options["BACKEND"] == LOCAL:
+        return LocalRecentMessages(options["SIZE"], options["MAX_ROOMS"], options["MAX_BYTES"])
+    if options["BACKEND"] == SHARED:
+        return SharedRecentMessages(options["SIZE"], options["CACHE"], options["TIMEOUT"])
+    raise ValueError(f"Unknown recent messages backend: {options['BACKEND']}")
+
+
+_recent = None
+_recent_lock = threading.Lock()
+
+
+def get_recent_messages():
+    """Return the process-wide recent messages store, creating it from settings on first use."""
+    global _recent
+    if _recent is None:
+        with _recent_lock:
+            if _recent is None:
+                _recent = _build()
+    return _recent
+
+
+def _samples():
+    if not isinstance(_recent, LocalRecentMessages):
+        return []
+    stats = _recent.stats()
+    return [
+        ("chat_recent_messages_rooms", "gauge", "Conversations held by the recent messages cache", [({}, stats["rooms"])]),
+        ("chat_recent_messages_bytes", "gauge", "Approximate size of the rows held by the recent messages cache", [({}, stats["bytes"])]),
+    ]
+
+
+REGISTRY.register_collector(_samples)
@@ -0,0 +1,90 @@
+"""
+Keeps the chat message tables in their own database.
+
+Messages are most of the rows and nearly all of the writes, so giving them
+a separate database (a second SQLite file locally) gives them their own
+write lock, WAL and backups, and leaves accounts and guilds in ``default``.
+``MessageRouter`` places the ``MESSAGE_MODELS`` in the ``chat`` alias when
+it is configured (``CHAT_DATABASE_NAME``); without it everything stays in
+``default``.
+
+Nothing joins or cascades across databases:
+
+* the message tables keep user and guild ids without foreign key
+  constraints (``db_constraint=False``, ``DO_NOTHING``), and pages resolve
+  their senders with one extra lookup (``pagination.with_senders``);
+* deleting a user or a guild deletes its messages in the chat database once
+  the deletion is committed (chat/signals.py);
+* membership, ``Chat_Group.member_count`` included, stays in ``default``
+  and is checked there before a message is written, as before.
+
+Migrations run per database::
+
+    python manage.py migrate
+    python manage.py migrate --database chat
+
+Messages already stored in ``default`` stay there when the alias is added,
+and would no longer be read. Move an existing install over with the app
+stopped: set ``CHAT_DATABASE_NAME``, run both migrations, then ``manage.py
+copy_messages``.
+"""
+
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from chat_app_boilerplate.database import primary_database, read_database
+
+MESSAGE_DATABASE = "chat"
+
+# lower-case model names of the chat app that live in MESSAGE_DATABASE
+MESSAGE_MODELS = {"personalchat", "groupmessage", "messagesequence", "conversationsummary", "archivesegment"}
+
+
+def is_message_model(model):
+    return model._meta.app_label == "chat" and model._meta.model_name in MESSAGE_MODELS
+
+
+class MessageRouter:
+    """Routes the MESSAGE_MODELS to the ``chat`` database, if configured"""
+
+    @staticmethod
+    def enabled():
+        return MESSAGE_DATABASE in connections.databases
+
+    def db_for_read(self, model, **hints):
+        if not self.enabled():
+            return None
+        if is_message_model(model):
+            return read_database(MESSAGE_DATABASE)
+        if self._from_messages(hints):
+            # e.g. message.sender: the user is in default, not where the message is
+            return read_database(DEFAULT_DB_ALIAS)
+        return None
+
+    def db_for_write(self, model, **hints):
+        if not self.enabled():
+            return None
+        if is_message_model(model):
+            return MESSAGE_DATABASE
+        if self._from_messages(hints):
+            return DEFAULT_DB_ALIAS
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if self.enabled() and (is_message_model(type(obj1)) or is_message_model(type(obj2))):
+            # ids only, the foreign keys have no constraints
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if not self.enabled():
+            return None
+        if db == MESSAGE_DATABASE:
+            return app_label == "chat" and model_name in MESSAGE_MODELS
+        if app_label == "chat" and model_name in MESSAGE_MODELS:
+            return False
+        return None
+
+    @staticmethod
+    def _from_messages(hints):
+        instance = hints.get("instance")
+        return instance is not None and primary_database(instance._state.db) == MESSAGE_DATABASE
@@ -9,4 +9,7 @@ websocket_urlpatterns = [
     # Group chat - matches any characters including URL-encoded ones
     # Handles: ws/group/Guild%20Name/ or ws/group/GuildName/
     re_path(r"^/?ws/group/(?P<group_name>[^/]+)/$", consumers.GroupChatConsumer.as_asgi()),
+
+    # Multiplexed stream - one socket per user, subscribes to many personal/guild channels
+    re_path(r"^/?ws/stream/$", consumers.StreamConsumer.as_asgi()),
 ]
\ No newline at end of file
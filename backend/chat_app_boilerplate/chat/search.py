@@ -0,0 +1,280 @@
+"""
+Full-text search over the messages a user can read.
+
+The search endpoint talks to a ``SearchBackend``, chosen by
+``settings.CHAT_SEARCH["BACKEND"]`` (a dotted path):
+
+* ``index(messages)`` adds saved PersonalChat / GroupMessage instances to
+  the index. The message writer calls it inside the flush transaction
+  (``messages_persisted``) and one-off saves call it from ``post_save``, so
+  an index entry commits together with its message.
+* ``backfill(model, ids)`` indexes existing rows not indexed yet, e.g. rows
+  bulk-inserted by ``seed_chat`` (``manage.py search_index``); ``clear()``
+  empties the index.
+* ``search(user, text, after, limit)`` returns ``(results, next_cursor)``
+  for one page of the user's matching messages. Results are ranked by
+  relevance and recency and scoped to the user's personal conversations
+  and current guild.
+
+``SQLiteFTS5Backend`` keeps a contentless FTS5 table next to the message
+tables (migration 0009 creates it and indexes the messages already stored):
+no copy of the text is stored, only the inverted index. Each entry
+holds the message body and scope tokens, ``u<id>`` for both participants
+of a personal message or ``g<id>`` for a guild message. A search matches
+the body terms and the caller's scope tokens in the same index lookup.
+Deleted messages leave entries behind (contentless tables can't delete
+rows on SQLite < 3.43); the join back to the message tables drops them,
+and ``search_index --rebuild`` compacts the index. On databases other than
+SQLite, where migration 0009 creates no table, or before it has run, the
+backend is unavailable: indexing does nothing and searches raise
+``SearchUnavailable``. Such deployments name another ``SearchBackend``
+subclass in ``CHAT_SEARCH["BACKEND"]``.
+
+Ranking is bm25 relevance divided by ``1 + age / RECENCY_DAYS``, so a
+match ``RECENCY_DAYS`` old needs twice the relevance of one sent now.
+Pages use keyset cursors over (score, entry) with the page-1 clock frozen
+in the cursor, so later pages keep the same order.
+"""
+
+import re
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connections, router
+from django.utils.module_loading import import_string
+
+from .models import Chat_Group, GroupMessage, PersonalChat
+from .pagination import decode_cursor, encode_cursor
+
+DEFAULTS = {
+    "BACKEND": "chat.search.SQLiteFTS5Backend",
+    # age, in days, at which a match needs twice the relevance to rank the same
+    "RECENCY_DAYS": 30,
+}
+
+# terms of one query beyond this are ignored
+MAX_TERMS = 16
+
+PERSONAL = "personal"
+GUILD = "guild"
+
+
+class InvalidQuery(ValueError):
+    pass
+
+
+class SearchUnavailable(Exception):
+    pass
+
+
+def query_terms(text):
+    """Words of the user's query; raises InvalidQuery if there are none"""
+    terms = re.findall(r"\w+", text or "")[:MAX_TERMS]
+    if not terms:
+        raise InvalidQuery("Search query must contain at least one word")
+    return terms
+
+
+class SearchBackend:
+    """
+    Base class of search backends, the extension point for databases without
+    FTS5: subclass it and name the subclass in ``CHAT_SEARCH["BACKEND"]``.
+    Backends are built with the CHAT_SEARCH options.
+    """
+
+    def __init__(self, options):
+        self.options = options
+
+    @property
+    def available(self):
+        """Whether the index exists; indexing is skipped while it doesn't"""
+        return True
+
+    def index(self, messages):
+        raise NotImplementedError
+
+    def backfill(self, model, ids):
+        """Index the rows of ``model`` with these ids that aren't indexed yet; returns how many"""
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def search(self, user, text, after=None, limit=50):
+        raise NotImplementedError
+
+
+class SQLiteFTS5Backend(SearchBackend):
+    table = "chat_message_fts"  # created by migration 0009
+
+    def __init__(self, options):
+        super().__init__(options)
+        # database alias -> whether it has the table, checked once per process
+        self._available = {}
+
+    @property
+    def connection(self):
+        return connections[router.db_for_write(PersonalChat)]
+
+    @property
+    def available(self):
+        connection = self.connection
+        if connection.alias not in self._available:
+            self._available[connection.alias] = (
+                connection.vendor == "sqlite" and self.table in connection.introspection.table_names()
+            )
+        return self._available[connection.alias]
+
+    # Entry ids interleave both message tables: personal 2n, guild 2n + 1
+
+    @staticmethod
+    def entry_id(message):
+        return message.id * 2 + (1 if isinstance(message, GroupMessage) else 0)
+
+    @staticmethod
+    def scope(message):
+        if isinstance(message, GroupMessage):
+            return f"g{message.group_id}"
+        return f"u{message.sender_id} u{message.receiver_id}"
+
+    def index(self, messages):
+        if not self.available:
+            return
+        with self.connection.cursor() as cursor:
+            cursor.executemany(
+                f"INSERT INTO {self.table} (rowid, body, scope) VALUES (%s, %s, %s)",
+                [(self.entry_id(message), message.message, self.scope(message)) for message in messages],
+            )
+
+    def backfill(self, model, ids):
+        if not self.available:
+            return 0
+        offset = 1 if model is GroupMessage else 0
+        with self.connection.cursor() as cursor:
+            placeholders = ", ".join(["%s"] * len(ids))
+            cursor.execute(
+                f"SELECT rowid FROM {self.table} WHERE rowid IN ({placeholders})",
+                [pk * 2 + offset for pk in ids],
+            )
+            indexed = {rowid // 2 for (rowid,) in cursor.fetchall()}
+        missing = [pk for pk in ids if pk not in indexed]
+        if missing:
+            self.index(model.objects.filter(id__in=missing).only(
+                "id", "message", *(("group_id",) if model is GroupMessage else ("sender_id", "receiver_id"))
+            ))
+        return len(missing)
+
+    def clear(self):
+        if not self.available:
+            return
+        with self.connection.cursor() as cursor:
+            cursor.execute(f"INSERT INTO {self.table} ({self.table}) VALUES ('delete-all')")
+
+    def search(self, user, text, after=None, limit=50):
+        terms = query_terms(text)
+        if not self.available:
+            raise SearchUnavailable("Search is not available on this database")
+        # the last word is matched as a prefix, so results follow typing
+        body = " ".join(f'"{term}"' for term in terms) + "*"
+        scopes = f"u{user.id}" + (f" OR g{user.guild_id}" if user.guild_id else "")
+        match = f"body : ({body}) AND scope : ({scopes})"
+
+        if after:
+            as_of, last_score, last_entry = decode_cursor(after, types=(float, float, int))
+        else:
+            # Julian day, the unit of SQLite's julianday()
+            as_of, last_score, last_entry = time.time() / 86400 + 2440587.5, None, None
+
+        personal = PersonalChat._meta.db_table
+        guild = GroupMessage._meta.db_table
+        sql = f"""
+            SELECT entry, score FROM (
+                SELECT {self.table}.rowid AS entry,
+                       bm25({self.table}, 1.0, 0.0)
+                         / (1.0 + (%s - julianday(COALESCE(p.timestamp, g.timestamp))) / %s) AS score
+                FROM {self.table}
+                LEFT JOIN {personal} AS p ON ({self.table}.rowid & 1) = 0 AND p.id = ({self.table}.rowid >> 1)
+                LEFT JOIN {guild} AS g ON ({self.table}.rowid & 1) = 1 AND g.id = ({self.table}.rowid >> 1)
+                WHERE {self.table} MATCH %s AND COALESCE(p.id, g.id) IS NOT NULL
+            )
+        """
+        params = [as_of, self.options["RECENCY_DAYS"], match]
+        if after:
+            # bm25 is negative: better matches have lower scores
+            sql += " WHERE score > %s OR (score = %s AND entry < %s)"
+            params += [last_score, last_score, last_entry]
+        sql += " ORDER BY score, entry DESC LIMIT %s"
+        params.append(limit + 1)
+
+        with self.connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            ranked = cursor.fetchall()
+
+        next_cursor = None
+        if len(ranked) > limit:
+            ranked = ranked[:limit]
+            next_cursor = encode_cursor(as_of, ranked[-1][1], ranked[-1][0])
+        return self.results(user, [entry for entry, _ in ranked]), next_cursor
+
+    def results(self, user, entries):
+        """``user``'s search results for ranked entry ids, in rank order"""
+        personal_ids = [entry // 2 for entry in entries if entry % 2 == 0]
+        guild_ids = [entry // 2 for entry in entries if entry % 2 == 1]
+        fields = ("id", "seq", "message", "timestamp", "sender_id")
+        personal = list(PersonalChat.objects.filter(id__in=personal_ids).values(*fields, "receiver_id")) if personal_ids else []
+        guild = list(GroupMessage.objects.filter(id__in=guild_ids).values(*fields, "group_id")) if guild_ids else []
+
+        # users and guilds may live in another database than messages: no joins
+        user_ids = {row["sender_id"] for row in personal + guild} | {row["receiver_id"] for row in personal}
+        users = {
+            pk: (email, name)
+            for pk, email, name in get_user_model().objects.filter(id__in=user_ids).values_list("id", "email", "name")
+        }
+        guild_names = dict(
+            Chat_Group.objects.filter(id__in={row["group_id"] for row in guild}).values_list("id", "name")
+        ) if guild else {}
+
+        rows = {}
+        for row in personal:
+            # the conversation is named after the other participant
+            peer_id = row["receiver_id"] if row["sender_id"] == user.id else row["sender_id"]
+            if row["sender_id"] in users and peer_id in users:
+                peer_email, peer_name = users[peer_id]
+                rows[row["id"] * 2] = _result(row, users, PERSONAL, peer=peer_email, peer_name=peer_name)
+        for row in guild:
+            if row["sender_id"] in users and row["group_id"] in guild_names:
+                rows[row["id"] * 2 + 1] = _result(
+                    row, users, GUILD, guild_id=row["group_id"], guild_name=guild_names[row["group_id"]]
+                )
+        return [rows[entry] for entry in entries if entry in rows]
+
+
+def _result(row, users, kind, **conversation):
+    sender_email, sender_name = users[row["sender_id"]]
+    return {
+        "id": row["id"],
+        "kind": kind,
+        "seq": row["seq"],
+        "message": row["message"],
+        "sender": sender_email,
+        "sender_name": sender_name,
+        "timestamp": row["timestamp"].isoformat(),
+        **conversation,
+    }
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_search_backend():
+    """Return the configured backend, creating it from settings on first use."""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                options = {**DEFAULTS, **getattr(settings, "CHAT_SEARCH", {})}
+                _backend = import_string(options["BACKEND"])(options)
+    return _backend
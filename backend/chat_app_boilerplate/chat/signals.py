@@ -0,0 +1,142 @@
+"""
+Signal receivers for the chat app.
+
+Consumers resolve their peer user / guild once at connect time. When one of
+those rows goes away (guild deleted, peer deactivated or deleted) we notify
+the affected sockets through the channel layer once the change is committed.
+
+Messages may live in another database than users and guilds (see
+chat/routers.py), so nothing cascades to them: once a guild or user
+deletion is committed, its messages, summaries and archived messages are
+deleted here.
+
+Message writes also keep the derived ConversationSummary rows and the
+recent messages cache and the search index up to date, both for batched
+inserts from the consumers and for one-off saves, and guild changes
+invalidate the cached guild directory.
+"""
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .archive import get_archive
+from .consumers import guild_groups, peer_group_name
+from .directory import invalidate_guild_directory
+from .models import Chat_Group, ConversationSummary, GroupMessage, PersonalChat, conversation_key, message_database
+from .persistence import messages_persisted
+from .recent import get_recent_messages
+from .search import get_search_backend
+
+User = get_user_model()
+
+
+def _notify(group, event):
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    transaction.on_commit(
+        lambda: async_to_sync(channel_layer.group_send)(group, event)
+    )
+
+
+def delete_guild_messages(guild_id):
+    with transaction.atomic(using=message_database()):
+        GroupMessage.objects.filter(group_id=guild_id).delete()
+        get_archive().discard_guild(guild_id)
+    get_recent_messages().discard(f"guild:{guild_id}")  # GroupMessage.sequence_key()
+
+
+def delete_user_messages(user_id):
+    summaries = ConversationSummary.objects.filter(Q(user_low_id=user_id) | Q(user_high_id=user_id))
+    sent_to_guilds = GroupMessage.objects.filter(sender_id=user_id)
+    with transaction.atomic(using=message_database()):
+        # the cached conversations holding their messages: every personal one
+        # (archived ones included) and the guilds they wrote in
+        keys = [
+            f"personal:{conversation_key(low, high)}"
+            for low, high in summaries.values_list("user_low_id", "user_high_id")
+        ] + [
+            f"guild:{group_id}"
+            for group_id in sent_to_guilds.order_by().values_list("group_id", flat=True).distinct()
+        ]
+        PersonalChat.objects.filter(Q(sender_id=user_id) | Q(receiver_id=user_id)).delete()
+        sent_to_guilds.delete()
+        summaries.delete()
+        get_archive().discard_user(user_id)
+    recent = get_recent_messages()
+    for key in keys:
+        recent.discard(key)
+
+
+@receiver(post_delete, sender=Chat_Group)
+def guild_deleted(sender, instance, **kwargs):
+    invalidate_guild_directory()
+    guild_id = instance.id  # the instance's pk is cleared once the delete completes
+    get_recent_messages().discard(f"guild:{guild_id}")
+    transaction.on_commit(lambda: delete_guild_messages(guild_id))
+    for group in guild_groups(instance):
+        _notify(group, {"type": "guild.deleted", "guild_id": instance.id})
+
+
+@receiver(post_save, sender=Chat_Group)
+def guild_saved(sender, instance, **kwargs):
+    invalidate_guild_directory()
+
+
+@receiver(post_save, sender=User)
+def user_deactivated(sender, instance, created, **kwargs):
+    if not created and not instance.is_active:
+        _notify(peer_group_name(instance.id), {"type": "peer.invalidated", "user_id": instance.id})
+
+
+@receiver(post_delete, sender=User)
+def user_deleted(sender, instance, **kwargs):
+    user_id = instance.id  # the instance's pk is cleared once the delete completes
+    transaction.on_commit(lambda: delete_user_messages(user_id))
+    _notify(peer_group_name(instance.id), {"type": "peer.invalidated", "user_id": instance.id})
+
+
+@receiver(messages_persisted, sender=PersonalChat)
+def summarize_batch(sender, messages, **kwargs):
+    ConversationSummary.objects.record_messages(messages)
+
+
+@receiver(post_save, sender=PersonalChat)
+def summarize_message(sender, instance, created, **kwargs):
+    if created:
+        ConversationSummary.objects.record_messages([instance])
+
+
+@receiver(messages_persisted, sender=PersonalChat)
+@receiver(messages_persisted, sender=GroupMessage)
+def remember_batch(sender, messages, **kwargs):
+    transaction.on_commit(lambda: get_recent_messages().record(messages), using=message_database())
+
+
+@receiver(post_save, sender=PersonalChat)
+@receiver(post_save, sender=GroupMessage)
+def remember_message(sender, instance, created, using, **kwargs):
+    if created:
+        transaction.on_commit(lambda: get_recent_messages().record([instance]), using=using)
+    else:
+        # an edit (e.g. in the admin) leaves the sequence unchanged
+        transaction.on_commit(lambda: get_recent_messages().discard(instance.sequence_key()), using=using)
+
+
+@receiver(messages_persisted, sender=PersonalChat)
+@receiver(messages_persisted, sender=GroupMessage)
+def index_batch(sender, messages, **kwargs):
+    # inside the flush transaction: indexed if and only if stored
+    get_search_backend().index(messages)
+
+
+@receiver(post_save, sender=PersonalChat)
+@receiver(post_save, sender=GroupMessage)
+def index_message(sender, instance, created, **kwargs):
+    if created:
+        get_search_backend().index([instance])
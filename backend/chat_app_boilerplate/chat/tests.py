@@ -1,3 +1,1256 @@
-from django.test import TestCase
+import asyncio
+import json
+import math
+import tempfile
+from contextlib import ExitStack
+from datetime import datetime, timedelta, timezone as dt_timezone
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+import msgpack
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.storage import FileSystemStorage
+from django.core.management import CommandError, call_command
+from django.core.exceptions import ValidationError
+from django.db import DatabaseError, IntegrityError, connections, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from accounts.models import CustomUser
+from chat_app_boilerplate import fastjson
+from chat_app_boilerplate.metrics import HTTP_RESPONSES, Counter, Gauge, Histogram, Registry
+from chat_app_boilerplate.channel_layers import HashRing, ShardedRedisChannelLayer
+from chat import archive as archive_module
+from chat.archive import MessageArchive
+from chat.consumers import guild_groups, guild_member_group
+from chat.fanout import group_send_all, member_group, shard_count, shard_groups
+from chat.models import (
+    ArchiveSegment, Chat_Group, ConversationSummary, GroupMessage, MessageSequence, PersonalChat, conversation_key,
+    message_database,
+)
+from chat.outbox import CLOSE_TOO_SLOW, COALESCE, DISCONNECT, DROP_OLDEST, Frame, Outbox
+from chat.persistence import ACK_AFTER_ENQUEUE, ACK_AFTER_PERSIST, MessageWriter
+from chat.pagination import InvalidCursor, decode_cursor, encode_cursor
+from chat.protocols import JSON, MESSAGEPACK, InvalidFrame, chat_message_event, message_frame
+from chat.recent import LocalRecentMessages, SharedRecentMessages, get_recent_messages, message_row
+from chat.routers import MESSAGE_DATABASE, MessageRouter
+from chat import search as search_module
+from chat.search import SQLiteFTS5Backend
+from chat.throttle import PRUNE_INTERVAL, FloodControl, TokenBucket, set_flood_control
+from chat.routing import websocket_urlpatterns
+
+
+# every database but the read pool's mirrors, which can't read through the
+# transaction TestCase holds open (chat_app_boilerplate/database.py)
+PRIMARY_DATABASES = {alias for alias, database in settings.DATABASES.items() if not database.get("TEST", {}).get("MIRROR")}
+
+
+def create_user(email, **fields):
+    return CustomUser.objects.create_user(email, name=email.split("@")[0], is_active=True, **fields)
+
+
+def communicator(user, path, subprotocols=None):
+    """A WebSocket to ``path`` authenticated as ``user``, without the JWT middleware"""
+    router = URLRouter(websocket_urlpatterns)
+
+    async def application(scope, receive, send):
+        return await router({**scope, "user": user}, receive, send)
+
+    return WebsocketCommunicator(application, path, subprotocols=subprotocols)
+
+
+class ChatTestCase(TestCase):
+    databases = PRIMARY_DATABASES
+
+    def setUp(self):
+        # process-wide caches outlive each test's rollback
+        cache.clear()
+        get_recent_messages().clear()
+        self.alice = create_user("alice@example.com")
+        self.bob = create_user("bob@example.com")
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def create_guild(self, name, *members):
+        guild = Chat_Group.objects.create(name=name, created_by=members[0])
+        for member in members:
+            guild.add_member(member)
+        return guild
+
+    def assertQueryBudget(self, budget, method, *args, **kwargs):
+        """Call ``method`` and check it ran at most ``budget`` queries over every database"""
+        with ExitStack() as stack:
+            contexts = [stack.enter_context(CaptureQueriesContext(connections[alias])) for alias in self.databases]
+            response = method(*args, **kwargs)
+        queries = [query["sql"] for context in contexts for query in context.captured_queries]
+        self.assertLessEqual(len(queries), budget, "\n".join(queries))
+        return response
+
+
+class CursorTests(ChatTestCase):
+    def test_encode_decode_round_trip(self):
+        timestamp = timezone.now()
+        self.assertEqual(decode_cursor(encode_cursor(timestamp, 42)), (timestamp, 42))
+        # only the leading value may contain the separator
+        self.assertEqual(decode_cursor(encode_cursor("a|b", 7), types=(str, int)), ("a|b", 7))
+
+    def test_invalid_cursors(self):
+        invalid = (
+            "", "!!!", encode_cursor("not a date", 1), encode_cursor(timezone.now()),
+            encode_cursor(datetime(2024, 1, 1), 1),  # naive
+        )
+        for cursor in invalid:
+            with self.assertRaises(InvalidCursor):
+                decode_cursor(cursor)
+        response = self.client.get("/chat/messages/bob@example.com/?before=garbage")
+        self.assertEqual(response.status_code, 400)
+
+    def test_history_pages_cover_every_message_once(self):
+        now = timezone.now()
+        key = conversation_key(self.alice.id, self.bob.id)
+        # pairs of messages share a timestamp: the cursor breaks ties by id
+        PersonalChat.objects.bulk_create([
+            PersonalChat(
+                sender=self.alice if i % 2 else self.bob,
+                receiver=self.bob if i % 2 else self.alice,
+                conversation_key=key,
+                message=f"m{i}",
+                timestamp=now + timedelta(seconds=i // 2),
+            )
+            for i in range(25)
+        ])
+
+        seen = []
+        cursor = None
+        while True:
+            url = "/chat/messages/bob@example.com/?limit=10" + (f"&before={cursor}" if cursor else "")
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            seen = response.data["results"] + seen
+            cursor = response.data["next_cursor"]
+            self.assertEqual(response.data["has_more"], cursor is not None)
+            if cursor is None:
+                break
+
+        self.assertEqual([message["message"] for message in seen], [f"m{i}" for i in range(25)])
+
+
+class SearchScopeTests(ChatTestCase):
+    def test_search_only_returns_readable_messages(self):
+        carol = create_user("carol@example.com")
+        dave = create_user("dave@example.com")
+        mine = self.create_guild("Mine", self.alice, self.bob)
+        other = self.create_guild("Other", carol, dave)
+
+        PersonalChat.objects.create(sender=self.bob, receiver=self.alice, message="banana personal")
+        PersonalChat.objects.create(sender=carol, receiver=dave, message="banana elsewhere")
+        GroupMessage.objects.create(group=mine, sender=self.bob, message="banana guild")
+        GroupMessage.objects.create(group=other, sender=carol, message="banana other guild")
+
+        response = self.client.get("/chat/search/?q=banana")
+        self.assertEqual(response.status_code, 200)
+        self.assertCountEqual(
+            [result["message"] for result in response.data["results"]],
+            ["banana personal", "banana guild"],
+        )
+
+    def test_search_follows_guild_changes(self):
+        guild = self.create_guild("Mine", self.alice, self.bob)
+        GroupMessage.objects.create(group=guild, sender=self.bob, message="banana guild")
+        guild.remove_member(self.alice)
+
+        response = self.client.get("/chat/search/?q=banana")
+        self.assertEqual(response.data["results"], [])
+
+    def test_unavailable_index(self):
+        backend = SQLiteFTS5Backend(search_module.DEFAULTS)
+        with mock.patch.object(backend, "table", "chat_missing_fts"), \
+                mock.patch.object(search_module, "_backend", backend):
+            # saving doesn't touch the missing table
+            PersonalChat.objects.create(sender=self.bob, receiver=self.alice, message="banana")
+            self.assertEqual(backend.backfill(PersonalChat, [1]), 0)
+            response = self.client.get("/chat/search/?q=banana")
+            self.assertEqual(response.status_code, 503)
+            with self.assertRaises(CommandError):
+                call_command("search_index")
+
+    def test_unavailable_on_other_databases(self):
+        backend = SQLiteFTS5Backend(search_module.DEFAULTS)
+        other = mock.Mock(alias="other", vendor="postgresql")
+        with mock.patch.object(SQLiteFTS5Backend, "connection", mock.PropertyMock(return_value=other)):
+            self.assertFalse(backend.available)
+            backend.index([PersonalChat(id=1, sender=self.bob, receiver=self.alice, message="banana")])
+        other.cursor.assert_not_called()
+        other.introspection.table_names.assert_not_called()
+
+
+class QueryBudgetTests(ChatTestCase):
+    """Queries per request, independent of how many rows are stored"""
+
+    def setUp(self):
+        super().setUp()
+        self.guild = self.create_guild("Guild One", self.alice, self.bob)
+        for i in range(30):
+            PersonalChat.objects.create(sender=self.bob, receiver=self.alice, message=f"personal {i}")
+            GroupMessage.objects.create(group=self.guild, sender=self.bob, message=f"guild {i}")
+        for i in range(10):
+            peer = create_user(f"peer{i}@example.com")
+            PersonalChat.objects.create(sender=peer, receiver=self.alice, message="hello")
+
+    def test_history(self):
+        response = self.assertQueryBudget(5, self.client.get, "/chat/messages/bob@example.com/?limit=10")
+        self.assertEqual(len(response.data["results"]), 10)
+        cursor = response.data["next_cursor"]
+        self.assertQueryBudget(4, self.client.get, f"/chat/messages/bob@example.com/?limit=10&before={cursor}")
+
+        response = self.assertQueryBudget(4, self.client.get, "/chat/group/Guild%20One/messages/?limit=10")
+        self.assertEqual(len(response.data["results"]), 10)
+        cursor = response.data["next_cursor"]
+        self.assertQueryBudget(4, self.client.get, f"/chat/group/Guild%20One/messages/?limit=10&before={cursor}")
+
+    def test_user_list(self):
+        response = self.assertQueryBudget(3, self.client.get, "/chat/users/")
+        self.assertEqual(len(response.data["conversations"]), 11)
+        response = self.assertQueryBudget(3, self.client.get, "/chat/users/?limit=1")
+        self.assertQueryBudget(2, self.client.get, f"/chat/users/?limit=1&after={response.data['next_cursor']}")
+
+    @override_settings(CHAT_MAX_CONVERSATIONS=5)
+    def test_user_list_caps_conversations(self):
+        response = self.assertQueryBudget(4, self.client.get, "/chat/users/?limit=50")
+        # the newest five
+        self.assertEqual(
+            [contact["email"] for contact in response.data["conversations"]],
+            [f"peer{i}@example.com" for i in range(9, 4, -1)],
+        )
+        # the older ones are listed as users with a conversation, nobody twice
+        users = {user["email"]: user["hasConversation"] for user in response.data["users"]}
+        self.assertEqual(users, {
+            "bob@example.com": True, **{f"peer{i}@example.com": True for i in range(5)},
+        })
+
+        response = self.client.get("/chat/users/?limit=2")
+        response = self.assertQueryBudget(3, self.client.get, f"/chat/users/?limit=2&after={response.data['next_cursor']}")
+        self.assertEqual(response.data["conversations"], [])
+        self.assertEqual([user["email"] for user in response.data["users"]], ["peer1@example.com", "peer2@example.com"])
+
+    def test_guilds(self):
+        self.assertQueryBudget(1, self.client.get, "/chat/guilds/")
+        self.assertQueryBudget(2, self.client.get, f"/chat/guilds/{self.guild.id}/")
+        self.assertQueryBudget(2, self.client.get, "/chat/guilds/my-guild/")
+
+    def test_search(self):
+        self.assertQueryBudget(5, self.client.get, "/chat/search/?q=guild")
+
+
+class ResumeTests(TransactionTestCase):
+    # consumers read through the read pool, whose aliases mirror the databases
+    databases = "__all__"
+
+    def setUp(self):
+        get_recent_messages().clear()
+        self.alice = create_user("alice@example.com")
+        self.bob = create_user("bob@example.com")
+        for i in range(5):
+            PersonalChat.objects.create(sender=self.alice, receiver=self.bob, message=f"m{i}")
+
+    def receive_seqs(self, path, count):
+        async def run():
+            socket = communicator(self.bob, path)
+            connected, _ = await socket.connect()
+            self.assertTrue(connected)
+            frames = [await socket.receive_json_from(timeout=3) for _ in range(count)]
+            self.assertTrue(await socket.receive_nothing(timeout=0.2))
+            await socket.disconnect()
+            return frames
+
+        return [frame.get("seq") for frame in async_to_sync(run)()]
+
+    def test_resume_replays_messages_after_seq(self):
+        self.assertEqual(self.receive_seqs("/ws/personal/alice@example.com/?resume_from=2", 3), [3, 4, 5])
+
+    def test_resume_skips_seq_gaps(self):
+        PersonalChat.objects.filter(seq__in=[2, 4]).delete()
+        self.assertEqual(self.receive_seqs("/ws/personal/alice@example.com/?resume_from=1", 2), [3, 5])
+
+    @override_settings(CHAT_RESUME_MAX_REPLAY=2)
+    def test_resume_too_far_behind(self):
+        async def run():
+            socket = communicator(self.bob, "/ws/personal/alice@example.com/?resume_from=1")
+            await socket.connect()
+            frame = await socket.receive_json_from(timeout=3)
+            await socket.disconnect()
+            return frame
+
+        self.assertEqual(async_to_sync(run)(), {"type": "resync_required", "resume_from": 1})
+
+    def test_live_messages_continue_the_sequence(self):
+        async def run():
+            bob = communicator(self.bob, "/ws/personal/alice@example.com/?resume_from=4")
+            await bob.connect()
+            replayed = await bob.receive_json_from(timeout=3)
+            alice = communicator(self.alice, "/ws/personal/bob@example.com/")
+            await alice.connect()
+            await alice.send_json_to({"message": "live"})
+            live = await bob.receive_json_from(timeout=3)
+            self.assertTrue(await bob.receive_nothing(timeout=0.2))
+            await alice.disconnect()
+            await bob.disconnect()
+            return replayed, live
+
+        replayed, live = async_to_sync(run)()
+        self.assertEqual(replayed["seq"], 5)
+        self.assertEqual((live["message"], live["seq"]), ("live", 6))
+
+    def test_stream_resume(self):
+        async def run():
+            socket = communicator(self.bob, "/ws/stream/")
+            await socket.connect()
+            await socket.send_json_to({"action": "subscribe", "channel": "personal:alice@example.com", "resume_from": 3})
+            frames = [await socket.receive_json_from(timeout=3) for _ in range(3)]
+            await socket.disconnect()
+            return frames
+
+        subscribed, *messages = async_to_sync(run)()
+        self.assertEqual(subscribed, {"type": "subscribed", "channel": "personal:alice@example.com"})
+        self.assertEqual([(frame["channel"], frame["seq"]) for frame in messages], [
+            ("personal:alice@example.com", 4), ("personal:alice@example.com", 5),
+        ])
+
+    def test_stream_resubscribe_resumes(self):
+        """How a stream client recovers from a resync_required marker"""
+        channel = "personal:alice@example.com"
+
+        async def run():
+            socket = communicator(self.bob, "/ws/stream/")
+            await socket.connect()
+            await socket.send_json_to({"action": "subscribe", "channel": channel})
+            frames = [await socket.receive_json_from(timeout=3)]
+            await socket.send_json_to({"action": "subscribe", "channel": channel, "resume_from": 3})
+            frames += [await socket.receive_json_from(timeout=3) for _ in range(3)]
+            # live copies of replayed messages are skipped, later ones delivered
+            alice = communicator(self.alice, "/ws/personal/bob@example.com/")
+            await alice.connect()
+            await alice.send_json_to({"message": "live"})
+            frames.append(await socket.receive_json_from(timeout=3))
+            self.assertTrue(await socket.receive_nothing(timeout=0.2))
+            await alice.disconnect()
+            await socket.disconnect()
+            return frames
+
+        frames = async_to_sync(run)()
+        self.assertEqual(frames[:2], [{"type": "subscribed", "channel": channel}] * 2)
+        self.assertEqual([(frame["type"], frame["seq"]) for frame in frames[2:]], [
+            ("message", 4), ("message", 5), ("message", 6),
+        ])
+
+    @override_settings(CHAT_RESUME_MAX_REPLAY=2)
+    def test_stream_resume_too_far_behind(self):
+        async def run():
+            socket = communicator(self.bob, "/ws/stream/")
+            await socket.connect()
+            await socket.send_json_to({"action": "subscribe", "channel": "personal:alice@example.com", "resume_from": 0})
+            frames = [await socket.receive_json_from(timeout=3) for _ in range(2)]
+            await socket.disconnect()
+            return frames
+
+        self.assertEqual(async_to_sync(run)(), [
+            {"type": "subscribed", "channel": "personal:alice@example.com"},
+            {"type": "resync_required", "channel": "personal:alice@example.com", "resume_from": 0},
+        ])
+
+    @override_settings(CHAT_OUTBOX={"MAX_FRAMES": 2, "POLICY": COALESCE})
+    def test_replay_longer_than_the_outbox(self):
+        self.assertEqual(self.receive_seqs("/ws/personal/alice@example.com/?resume_from=0", 5), [1, 2, 3, 4, 5])
+
+
+class OutboxTests(SimpleTestCase):
+    def run_outbox(self, policy, scenario, max_frames=3, hard_limit=10):
+        async def run():
+            sent, closed = [], []
+            released = asyncio.Event()
+
+            async def send(data):
+                await released.wait()
+                sent.append(data)
+
+            async def close(code):
+                closed.append(code)
+
+            def marker(channel, resume_from):
+                return json.dumps({"type": "resync_required", "channel": channel, "resume_from": resume_from})
+
+            outbox = Outbox(send, close, "personal", max_frames, hard_limit, policy, marker)
+            outbox.start()
+            await asyncio.sleep(0)  # the sender takes nothing while the outbox is empty
+            await scenario(outbox)
+            released.set()
+            await asyncio.sleep(0.01)
+            await outbox.stop()
+            return sent, closed
+
+        return asyncio.run(run())
+
+    async def put_messages(self, outbox, count, channel=None):
+        for seq in range(1, count + 1):
+            outbox.put(Frame(f"m{seq}", channel, seq))
+        await asyncio.sleep(0)
+
+    def test_drop_oldest(self):
+        sent, closed = self.run_outbox(DROP_OLDEST, lambda outbox: self.put_messages(outbox, 8))
+        self.assertEqual(sent, ["m6", "m7", "m8"])
+        self.assertEqual(closed, [])
+
+    def test_coalesce(self):
+        async def scenario(outbox):
+            outbox.put(Frame("subscribed", droppable=False))
+            # a3 overflows: a1 and a2 become one marker, a3 is left to it
+            await self.put_messages(outbox, 3, channel="a")
+
+        sent, closed = self.run_outbox(COALESCE, scenario)
+        self.assertEqual(sent[0], "subscribed")
+        self.assertEqual(json.loads(sent[1]), {"type": "resync_required", "channel": "a", "resume_from": 0})
+        self.assertEqual(len(sent), 2)
+        self.assertEqual(closed, [])
+
+    def test_disconnect(self):
+        sent, closed = self.run_outbox(DISCONNECT, lambda outbox: self.put_messages(outbox, 8))
+        self.assertEqual(closed, [CLOSE_TOO_SLOW])
+
+    def test_control_frames_never_dropped(self):
+        async def scenario(outbox):
+            for i in range(5):
+                outbox.put(Frame(f"c{i}", droppable=False))
+            await asyncio.sleep(0)
+
+        for policy in (DROP_OLDEST, COALESCE, DISCONNECT):
+            sent, closed = self.run_outbox(policy, scenario)
+            self.assertEqual(sent, [f"c{i}" for i in range(5)])
+            self.assertEqual(closed, [])
+
+    def test_hard_limit_applies_to_every_frame(self):
+        async def scenario(outbox):
+            for i in range(6):
+                outbox.put(Frame(f"c{i}", droppable=False))
+            await asyncio.sleep(0)
+
+        for policy in (DROP_OLDEST, COALESCE, DISCONNECT):
+            sent, closed = self.run_outbox(policy, scenario, hard_limit=4)
+            self.assertEqual(closed, [CLOSE_TOO_SLOW])
+
+    def test_wait_for_room_times_out(self):
+        async def scenario(outbox):
+            for i in range(4):
+                outbox.put(Frame(f"c{i}", droppable=False))
+            self.assertFalse(await outbox.wait_for_room(0.01))
+            await asyncio.sleep(0)
+
+        sent, closed = self.run_outbox(COALESCE, scenario)
+        self.assertEqual(closed, [CLOSE_TOO_SLOW])
+
+
+class HashRingTests(SimpleTestCase):
+    names = [f"group_{i}" for i in range(2000)]
+
+    def test_adding_a_host_moves_its_share(self):
+        hosts = ["redis-0:6379/0", "redis-1:6379/0", "redis-2:6379/0"]
+        grown = hosts + ["redis-3:6379/0"]
+        before, after = HashRing(hosts), HashRing(grown)
+        moved = [name for name in self.names if hosts[before.index(name)] != grown[after.index(name)]]
+        # about a quarter of the names, all of them onto the new host
+        self.assertLess(len(moved), len(self.names) * 0.35)
+        self.assertTrue(all(after.index(name) == 3 for name in moved))
+
+    def test_host_order_does_not_matter(self):
+        hosts = ["redis-0:6379/0", "redis-1:6379/0", "redis-2:6379/0"]
+        ring, reversed_ring = HashRing(hosts), HashRing(hosts[::-1])
+        for name in self.names:
+            self.assertEqual(hosts[ring.index(name)], hosts[::-1][reversed_ring.index(name)])
+
+
+class ShardedRedisChannelLayerTests(SimpleTestCase):
+    hosts = [("redis-0", 6379), ("redis-1", 6379), ("redis-2", 6379)]
+
+    def test_process_local_channels_share_a_shard(self):
+        # building the layer doesn't connect to any of the hosts
+        layer = ShardedRedisChannelLayer(hosts=self.hosts)
+        shards = {layer.consistent_hash(f"specific.{layer.client_prefix}!{i}") for i in range(50)}
+        self.assertEqual(shards, {layer.consistent_hash(f"specific.{layer.client_prefix}!")})
+
+    def test_duplicate_hosts(self):
+        with self.assertRaises(ValueError):
+            ShardedRedisChannelLayer(hosts=[("redis-0", 6379), ("redis-1", 6379), ("redis-0", 6379)])
+
+
+class MessageRouterTests(SimpleTestCase):
+    router = MessageRouter()
+
+    def message_from(self, alias):
+        message = PersonalChat()
+        message._state.db = alias
+        return message
+
+    def test_disabled(self):
+        with mock.patch.object(MessageRouter, "enabled", return_value=False):
+            for model in (PersonalChat, CustomUser):
+                self.assertIsNone(self.router.db_for_read(model))
+                self.assertIsNone(self.router.db_for_write(model))
+            self.assertIsNone(self.router.allow_relation(PersonalChat(), CustomUser()))
+            self.assertIsNone(self.router.allow_migrate("default", "chat", "personalchat"))
+
+    def test_message_models(self):
+        with mock.patch.object(MessageRouter, "enabled", return_value=True):
+            for model in (PersonalChat, GroupMessage, ConversationSummary):
+                self.assertEqual(self.router.db_for_read(model), MESSAGE_DATABASE)
+                self.assertEqual(self.router.db_for_write(model), MESSAGE_DATABASE)
+            self.assertIsNone(self.router.db_for_read(Chat_Group))
+            self.assertIsNone(self.router.db_for_write(CustomUser))
+
+    def test_relations_from_messages(self):
+        with mock.patch.object(MessageRouter, "enabled", return_value=True):
+            # message.sender is looked up in default, where the users are
+            message = self.message_from(MESSAGE_DATABASE)
+            self.assertEqual(self.router.db_for_read(CustomUser, instance=message), "default")
+            self.assertEqual(self.router.db_for_write(CustomUser, instance=message), "default")
+            self.assertIsNone(self.router.db_for_read(CustomUser, instance=self.message_from(None)))
+            self.assertTrue(self.router.allow_relation(message, CustomUser()))
+            self.assertIsNone(self.router.allow_relation(CustomUser(), Chat_Group()))
+
+    def test_allow_migrate(self):
+        with mock.patch.object(MessageRouter, "enabled", return_value=True):
+            self.assertTrue(self.router.allow_migrate(MESSAGE_DATABASE, "chat", "personalchat"))
+            self.assertFalse(self.router.allow_migrate(MESSAGE_DATABASE, "chat", "chat_group"))
+            self.assertFalse(self.router.allow_migrate(MESSAGE_DATABASE, "accounts", "customuser"))
+            self.assertFalse(self.router.allow_migrate("default", "chat", "personalchat"))
+            self.assertIsNone(self.router.allow_migrate("default", "chat", "chat_group"))
+
+    def test_copy_messages_needs_the_chat_database(self):
+        with mock.patch.object(MessageRouter, "enabled", return_value=False):
+            with self.assertRaisesMessage(CommandError, "CHAT_DATABASE_NAME"):
+                call_command("copy_messages")
+
+
+class FastJSONTests(SimpleTestCase):
+    backends = [fastjson.StdlibJSON(), fastjson.OrJSON()]
+
+    def test_same_output(self):
+        value = {"message": "héllo \u2028", "at": datetime(2024, 1, 2, 3, 4, 5, tzinfo=dt_timezone.utc), "seq": 3}
+        stdlib, orjson = (backend.dumps(value) for backend in self.backends)
+        self.assertEqual(stdlib, orjson)
+        for backend in self.backends:
+            self.assertEqual(backend.loads(backend.dumpb(value))["seq"], 3)
+
+    def test_malformed_input(self):
+        for backend in self.backends:
+            for data in ('{"message": NaN}', '{"message": -Infinity}', "{", b'{"message": "\xff"}'):
+                with self.subTest(backend=backend.name, data=data), self.assertRaises(fastjson.JSONDecodeError):
+                    backend.loads(data)
+
+    def test_frames_decode_with_either_backend(self):
+        for backend in self.backends:
+            with self.subTest(backend=backend.name), mock.patch.object(fastjson, "_json", backend):
+                self.assertEqual(JSON.decode(text_data='{"message": "hi"}'), {"message": "hi"})
+                for data in ('{"message": NaN}', "[1]", "nope"):
+                    with self.assertRaises(InvalidFrame):
+                        JSON.decode(text_data=data)
+                with self.assertRaises(InvalidFrame):
+                    JSON.decode(bytes_data=b'{"message": "\xff"}')
+
+
+class ProtocolTests(SimpleTestCase):
+    frame = {"action": "send", "channel": "guild:1", "message": "hé", "timestamp": "", "resume_from": 2}
+
+    def event(self):
+        sender = CustomUser(email="alice@example.com", name="alice")
+        return chat_message_event("group_1", sender, "hé", "12:00", 7)
+
+    def test_round_trip(self):
+        self.assertEqual(JSON.decode(text_data=JSON.encode(self.frame)), self.frame)
+        self.assertEqual(MESSAGEPACK.decode(bytes_data=MESSAGEPACK.encode(self.frame)), self.frame)
+        # text frames are still JSON on MessagePack sockets
+        self.assertEqual(MESSAGEPACK.decode(text_data=JSON.encode(self.frame)), self.frame)
+
+    def test_message_frames(self):
+        event = self.event()
+        expected = {"type": "message", "channel": "guild:1", **message_frame(event)}
+        # the stream frame is spliced into the broadcast's serialized frame
+        self.assertEqual(json.loads(JSON.encode_message(event, "guild:1")), expected)
+        self.assertEqual(json.loads(JSON.encode_message(event)), message_frame(event))
+        self.assertEqual(msgpack.unpackb(MESSAGEPACK.encode_message(event, "guild:1")), expected)
+        # events from workers that didn't serialize the frame
+        del event["frame"]
+        self.assertEqual(json.loads(JSON.encode_message(event, 'a "quoted" channel'))["channel"], 'a "quoted" channel')
+
+    def test_refused_frames(self):
+        refused = [
+            msgpack.packb([1, 2]),
+            msgpack.packb("message"),
+            msgpack.packb({"message": msgpack.ExtType(1, b"x")}),
+            msgpack.packb({"message": math.nan}),
+            msgpack.packb({"message": [1.5, {"at": -math.inf}]}),
+            msgpack.packb({1: "not a string key"}),
+            b"\xc1",
+        ]
+        for data in refused:
+            with self.subTest(data=data), self.assertRaises(InvalidFrame):
+                MESSAGEPACK.decode(bytes_data=data)
+        self.assertEqual(MESSAGEPACK.decode(bytes_data=msgpack.packb({"message": 1.5})), {"message": 1.5})
+
+
+class StreamProtocolTests(TransactionTestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        get_recent_messages().clear()
+        self.alice = create_user("alice@example.com")
+        self.bob = create_user("bob@example.com")
+
+    def exchange(self, subprotocol, encode, decode, frames):
+        """Send ``frames`` on a stream socket, then a message; the frames received"""
+        async def run():
+            socket = communicator(self.alice, "/ws/stream/", subprotocols=[subprotocol])
+            connected, accepted = await socket.connect()
+            self.assertEqual((connected, accepted), (True, subprotocol))
+            await socket.send_to(**encode({"action": "subscribe", "channel": "personal:bob@example.com"}))
+            received = [decode(await socket.receive_output(timeout=3))]
+            for frame in frames:
+                await socket.send_to(**frame)
+                received.append(decode(await socket.receive_output(timeout=3)))
+            await socket.send_to(**encode({"action": "send", "channel": "personal:bob@example.com", "message": "hi"}))
+            received.append(decode(await socket.receive_output(timeout=3)))
+            await socket.disconnect()
+            return received
+
+        return async_to_sync(run)()
+
+    def test_json(self):
+        received = self.exchange(
+            "chat.json",
+            lambda frame: {"text_data": json.dumps(frame)},
+            lambda output: json.loads(output["text"]),
+            [{"text_data": '{"action": "send", "channel": "personal:bob@example.com", "message": NaN}'}],
+        )
+        self.assertEqual(received[1], {"type": "error", "channel": None, "error": "Invalid JSON"})
+        # the socket is still usable, and the message frame spliced into the broadcast's text
+        self.assertEqual(received[2]["type"], "message")
+        self.assertEqual((received[2]["channel"], received[2]["message"], received[2]["seq"]), ("personal:bob@example.com", "hi", 1))
+
+    def test_msgpack(self):
+        received = self.exchange(
+            "chat.msgpack",
+            lambda frame: {"bytes_data": msgpack.packb(frame)},
+            lambda output: msgpack.unpackb(output["bytes"]),
+            [
+                {"bytes_data": msgpack.packb({"action": "send", "channel": "personal:bob@example.com", "message": math.nan})},
+                {"bytes_data": msgpack.packb({"action": "send", "message": msgpack.ExtType(1, b"x")})},
+                {"bytes_data": msgpack.packb(["not", "a", "map"])},
+            ],
+        )
+        self.assertEqual(received[0], {"type": "subscribed", "channel": "personal:bob@example.com"})
+        self.assertEqual(received[1:4], [{"type": "error", "channel": None, "error": "Invalid MessagePack"}] * 3)
+        self.assertEqual((received[4]["type"], received[4]["message"], received[4]["seq"]), ("message", "hi", 1))
+
+
+class MessageWriterTests(TransactionTestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        self.alice = create_user("alice@example.com")
+        self.bob = create_user("bob@example.com")
+
+    def message(self, text):
+        return PersonalChat(sender=self.alice, receiver=self.bob, message=text)
+
+    def test_ack_after_persist(self):
+        writer = MessageWriter(batch_size=100, flush_interval=0.01, durability=ACK_AFTER_PERSIST)
+
+        async def run():
+            row = self.message("hi")
+            write = asyncio.ensure_future(writer.write(row))
+            await asyncio.sleep(0)
+            # buffered, not written yet
+            self.assertFalse(write.done())
+            self.assertIsNone(row.seq)
+            await write
+            return row
+
+        row = async_to_sync(run)()
+        self.assertEqual(row.seq, 1)
+        self.assertTrue(PersonalChat.objects.filter(id=row.id, seq=1).exists())
+
+    def test_persist_failure(self):
+        writer = MessageWriter(batch_size=100, flush_interval=0.01, durability=ACK_AFTER_PERSIST)
+
+        async def run():
+            with self.assertRaises(DatabaseError):
+                await writer.write(self.message("hi"))
+
+        with mock.patch.object(writer, "_persist", side_effect=DatabaseError("disk full")):
+            async_to_sync(run)()
+        self.assertFalse(PersonalChat.objects.exists())
+
+    def test_ack_after_enqueue_batches(self):
+        writer = MessageWriter(batch_size=3, flush_interval=60, durability=ACK_AFTER_ENQUEUE)
+
+        async def run():
+            rows = [await writer.write(self.message(f"m{i}")) for i in range(2)]
+            self.assertEqual(len(writer._pending), 2)
+            self.assertFalse(await database_sync_to_async(PersonalChat.objects.exists)())
+            # the third message fills the batch
+            rows.append(await writer.write(self.message("m2")))
+            await asyncio.gather(*writer._tasks)
+            return rows
+
+        with mock.patch.object(writer, "_persist", wraps=writer._persist) as persist:
+            rows = async_to_sync(run)()
+        persist.assert_called_once_with(rows)
+        self.assertEqual(list(PersonalChat.objects.order_by("seq").values_list("message", "seq")), [
+            ("m0", 1), ("m1", 2), ("m2", 3),
+        ])
+
+    def test_flush_sync(self):
+        writer = MessageWriter(batch_size=100, flush_interval=60, durability=ACK_AFTER_ENQUEUE)
+
+        async def run():
+            await writer.write(self.message("hi"))
+
+        async_to_sync(run)()
+        self.assertFalse(PersonalChat.objects.exists())
+        # as at interpreter shutdown, with no event loop running
+        writer.flush_sync()
+        self.assertEqual(PersonalChat.objects.get().message, "hi")
+
+
+class PersistFailureTests(TransactionTestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        get_recent_messages().clear()
+        self.alice = create_user("alice@example.com")
+        self.bob = create_user("bob@example.com")
+
+    def test_no_broadcast_and_an_error_frame(self):
+        async def run():
+            bob = communicator(self.bob, "/ws/personal/alice@example.com/")
+            alice = communicator(self.alice, "/ws/personal/bob@example.com/")
+            await bob.connect()
+            await alice.connect()
+            with mock.patch.object(MessageWriter, "_persist", side_effect=DatabaseError("disk full")), \
+                    self.assertLogs("chat.consumers", "ERROR"):
+                await alice.send_json_to({"message": "hi"})
+                error = await alice.receive_json_from(timeout=3)
+            self.assertTrue(await bob.receive_nothing(timeout=0.2))
+            self.assertTrue(await alice.receive_nothing(timeout=0.1))
+            await alice.disconnect()
+            await bob.disconnect()
+            return error
+
+        self.assertEqual(async_to_sync(run)(), {"type": "error", "error": "Message could not be saved"})
+        self.assertFalse(PersonalChat.objects.exists())
+
+
+class ArchiveTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.storage = FileSystemStorage(location=directory.name)
+        self.archive = MessageArchive(self.storage, segment_size=5)
+        patcher = mock.patch.object(archive_module, "_archive", self.archive)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.key = conversation_key(self.alice.id, self.bob.id)
+        self.now = timezone.now()
+
+    def seed(self, count):
+        """``count`` messages a day apart, pairs sharing a timestamp, the newest today"""
+        rows = [
+            PersonalChat(
+                sender=self.alice if i % 2 else self.bob, receiver=self.bob if i % 2 else self.alice,
+                conversation_key=self.key, message=f"m{i}",
+            )
+            for i in range(count)
+        ]
+        MessageSequence.objects.assign(rows)
+        PersonalChat.objects.bulk_create(rows)
+        for i, row in enumerate(rows):
+            # timestamp is auto_now_add, which bulk_create applies too
+            PersonalChat.objects.filter(id=row.id).update(timestamp=self.now - timedelta(days=(count - i) // 2))
+        return rows
+
+    def archive_older_than(self, days):
+        return self.archive.archive_conversation(f"personal:{self.key}", self.now - timedelta(days=days))
+
+    def history(self, limit):
+        seen, cursor = [], None
+        while True:
+            url = f"/chat/messages/bob@example.com/?limit={limit}" + (f"&before={cursor}" if cursor else "")
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            seen = response.data["results"] + seen
+            cursor = response.data["next_cursor"]
+            if cursor is None:
+                return seen
+
+    def test_archive_conversation(self):
+        self.seed(25)
+        # messages 0-11 are 7 days old or more
+        self.assertEqual(self.archive_older_than(6.5), 12)
+
+        segments = list(ArchiveSegment.objects.order_by("first_seq"))
+        self.assertEqual([(segment.first_seq, segment.last_seq, segment.count) for segment in segments], [
+            (1, 5, 5), (6, 10, 5), (11, 12, 2),
+        ])
+        self.assertTrue(all(self.storage.exists(segment.name) for segment in segments))
+        self.assertEqual(PersonalChat.objects.count(), 13)
+        self.assertEqual(self.archive.archived_through(f"personal:{self.key}"), 12)
+        # nothing older is left to archive
+        self.assertEqual(self.archive_older_than(6.5), 0)
+
+    def test_history_reads_through_the_archive(self):
+        self.seed(25)
+        self.archive_older_than(6.5)
+        for limit in (1, 7, 10, 50):
+            with self.subTest(limit=limit):
+                get_recent_messages().clear()
+                self.assertEqual([row["message"] for row in self.history(limit)], [f"m{i}" for i in range(25)])
+
+    def test_history_of_an_archived_conversation(self):
+        self.seed(6)
+        self.archive_older_than(-1)
+        self.assertFalse(PersonalChat.objects.exists())
+        self.assertEqual([row["seq"] for row in self.history(4)], [1, 2, 3, 4, 5, 6])
+
+        # a handcrafted cursor without a time zone, past the live messages
+        naive = encode_cursor(datetime(2030, 1, 1), 1)
+        response = self.client.get(f"/chat/messages/bob@example.com/?before={naive}")
+        self.assertEqual(response.status_code, 400)
+
+    def test_discard(self):
+        self.seed(5)
+        self.archive_older_than(-1)
+        guild = self.create_guild("Guild", self.alice)
+        rows = [GroupMessage(group=guild, sender=self.alice, message=f"g{i}") for i in range(3)]
+        MessageSequence.objects.assign(rows)
+        GroupMessage.objects.bulk_create(rows)
+        self.archive.archive_conversation(f"guild:{guild.id}", self.now + timedelta(days=1))
+        names = dict(ArchiveSegment.objects.values_list("key", "name"))
+        self.assertEqual(len(names), 2)
+
+        carol = create_user("carol@example.com")
+        with self.captureOnCommitCallbacks(using=message_database(), execute=True):
+            self.archive.discard_user(carol.id)
+        self.assertEqual(ArchiveSegment.objects.count(), 2)
+
+        with self.captureOnCommitCallbacks(using=message_database(), execute=True):
+            self.archive.discard_user(self.bob.id)
+        self.assertFalse(ArchiveSegment.objects.filter(key__startswith="personal:").exists())
+        self.assertFalse(self.storage.exists(names[f"personal:{self.key}"]))
+
+        with self.captureOnCommitCallbacks(using=message_database(), execute=True):
+            self.archive.discard_guild(guild.id)
+        self.assertFalse(ArchiveSegment.objects.exists())
+        self.assertFalse(self.storage.exists(names[f"guild:{guild.id}"]))
+
+
+class GuildMembershipTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.carol = create_user("carol@example.com")
+        self.guild = Chat_Group.objects.create(name="Guild", created_by=self.alice, max_members=2)
+
+    def assertMembers(self, guild, *members):
+        guild.refresh_from_db()
+        self.assertEqual(guild.member_count, len(members))
+        self.assertEqual(set(guild.group_members.all()), set(members))
+
+    def test_full_guild(self):
+        self.guild.add_member(self.alice)
+        self.guild.add_member(self.bob)
+        with self.assertRaisesMessage(ValidationError, "Guild is full"):
+            self.guild.add_member(self.carol)
+        self.assertMembers(self.guild, self.alice, self.bob)
+        self.carol.refresh_from_db()
+        self.assertIsNone(self.carol.guild)
+
+    def test_double_join(self):
+        self.guild.add_member(self.alice)
+        with self.assertRaisesMessage(ValidationError, "already in guild: Guild"):
+            self.guild.add_member(self.alice)
+        self.assertMembers(self.guild, self.alice)
+
+        # nor a second guild; its seat is given back
+        other = Chat_Group.objects.create(name="Other", created_by=self.bob)
+        with self.assertRaises(ValidationError):
+            other.add_member(self.alice)
+        self.assertMembers(other)
+        self.assertMembers(self.guild, self.alice)
+
+    def test_double_leave(self):
+        self.guild.add_member(self.alice)
+        self.guild.add_member(self.bob)
+        self.assertFalse(self.guild.remove_member(self.bob))
+        with self.assertRaisesMessage(ValidationError, "not a member"):
+            self.guild.remove_member(self.bob)
+        with self.assertRaises(ValidationError):
+            self.guild.remove_member(self.carol)
+        self.assertMembers(self.guild, self.alice)
+
+        # the last member leaving deletes the guild
+        self.assertTrue(self.guild.remove_member(self.alice))
+        self.assertFalse(Chat_Group.objects.filter(id=self.guild.id).exists())
+
+    def test_member_count_stays_in_bounds(self):
+        for member_count in (-1, 3):
+            with self.subTest(member_count=member_count), self.assertRaises(IntegrityError), transaction.atomic():
+                Chat_Group.objects.filter(id=self.guild.id).update(member_count=member_count)
+        self.assertMembers(self.guild)
+
+
+class MetricsTests(SimpleTestCase):
+    def test_text_format(self):
+        registry = Registry()
+        messages = registry.register(Counter("messages_total", "Messages", ["room"]))
+        connections = registry.register(Gauge("connections", "Open sockets"))
+        latency = registry.register(Histogram("latency_seconds", "Latency", buckets=(0.1, 1)))
+        registry.register_collector(lambda: [("cached", "gauge", "Cached entries", [({"map": "user"}, 3)])])
+        messages.labels('a "quoted"\\room').inc(2)
+        connections.inc()
+        connections.dec(0.5)
+        latency.observe(0.05)
+        latency.observe(2)
+
+        self.assertEqual(registry.render(), "\n".join([
+            "# HELP messages_total Messages",
+            "# TYPE messages_total counter",
+            'messages_total{room="a \\"quoted\\"\\\\room"} 2',
+            "# HELP connections Open sockets",
+            "# TYPE connections gauge",
+            "connections 0.5",
+            "# HELP latency_seconds Latency",
+            "# TYPE latency_seconds histogram",
+            'latency_seconds_bucket{le="0.1"} 1',
+            'latency_seconds_bucket{le="1"} 1',
+            'latency_seconds_bucket{le="+Inf"} 2',
+            "latency_seconds_sum 2.05",
+            "latency_seconds_count 2",
+            "# HELP cached Cached entries",
+            "# TYPE cached gauge",
+            'cached{map="user"} 3',
+        ]) + "\n")
+        # registering a name again returns the existing metric
+        self.assertIs(registry.register(Counter("messages_total", "Messages", ["room"])), messages)
+        with self.assertRaises(ValueError):
+            messages.labels("a", "b")
+
+    @override_settings(METRICS_TOKEN="", DEBUG=False)
+    def test_unknown_methods_share_a_label(self):
+        other = HTTP_RESPONSES.labels("metrics", "other", "4xx")
+        before = other.value
+        self.client.generic("BREW", "/metrics")
+        self.client.generic("PROPFIND", "/metrics")
+        self.assertEqual(other.value, before + 2)
+        self.assertNotIn(("metrics", "BREW", "4xx"), HTTP_RESPONSES._children)
+
+    def test_access(self):
+        with override_settings(METRICS_TOKEN="", DEBUG=False):
+            self.assertEqual(self.client.get("/metrics").status_code, 403)
+        with override_settings(METRICS_TOKEN="", DEBUG=True):
+            self.assertEqual(self.client.get("/metrics").status_code, 200)
+        with override_settings(METRICS_TOKEN="secret", DEBUG=True):
+            self.assertEqual(self.client.get("/metrics").status_code, 403)
+            self.assertEqual(self.client.get("/metrics", headers={"Authorization": "Bearer wrong"}).status_code, 403)
+            response = self.client.get("/metrics", headers={"Authorization": "Bearer secret"})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response["Content-Type"], "text/plain; version=0.0.4; charset=utf-8")
+            self.assertIn(b"# TYPE http_responses_total counter", response.content)
+
+
+class FloodControlTests(SimpleTestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch("chat.throttle.time.monotonic", side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_burst_and_refill(self):
+        bucket = TokenBucket(rate=2, burst=3, now=self.now)
+        for _ in range(3):
+            self.assertEqual(bucket.wait(self.now), 0)
+            bucket.take()
+        self.assertEqual(bucket.wait(self.now), 0.5)
+        self.now += 0.5
+        self.assertEqual(bucket.wait(self.now), 0)
+        # never more than the burst, however long it was idle
+        self.now += 3600
+        self.assertEqual(bucket.wait(self.now), 0)
+        self.assertEqual(bucket.tokens, 3)
+
+    def test_levels(self):
+        flood = FloodControl(connection=(1, 2), user=(1, 3), guild=(1, 4))
+        first, second = flood.connection_bucket(), flood.connection_bucket()
+        self.assertIsNone(flood.check(first, user_id=1, guild_id=7))
+        self.assertIsNone(flood.check(first, user_id=1, guild_id=7))
+        self.assertEqual(flood.check(first, user_id=1, guild_id=7), ("connection", 1.0))
+        # the user's other socket shares the user's bucket
+        self.assertIsNone(flood.check(second, user_id=1, guild_id=7))
+        self.assertEqual(flood.check(second, user_id=1, guild_id=7), ("user", 1.0))
+        # another member shares the guild's bucket, which has one token left
+        self.assertIsNone(flood.check(flood.connection_bucket(), user_id=2, guild_id=7))
+        self.assertEqual(flood.check(flood.connection_bucket(), user_id=2, guild_id=7), ("guild", 1.0))
+        # refused messages aren't charged: user 2's personal messages still pass
+        self.assertIsNone(flood.check(flood.connection_bucket(), user_id=2))
+
+    @override_settings(CHAT_FLOOD_CONTROL={})
+    def test_unlimited_by_default(self):
+        flood = FloodControl.from_settings()
+        self.assertEqual(flood.limits, {"connection": None, "user": None, "guild": None})
+        self.assertIsNone(flood.connection_bucket())
+        for _ in range(100):
+            self.assertIsNone(flood.check(None, user_id=1, guild_id=7))
+
+    def test_prune(self):
+        flood = FloodControl(user=(1, 2), guild=(1, 2))
+        flood.check(None, user_id=1, guild_id=7)
+        flood.check(None, user_id=2)
+        self.now += 1  # user 2's bucket has refilled, user 1's and the guild's have not
+        flood.check(None, user_id=1, guild_id=7)
+        self.now += PRUNE_INTERVAL - 1
+        flood.check(None, user_id=3)
+        # refilled buckets were dropped before user 3's was added
+        self.assertEqual(set(flood._buckets["user"]), {3})
+        self.assertEqual(flood._buckets["guild"], {})
+
+
+class ThrottledFrameTests(TransactionTestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        get_recent_messages().clear()
+        self.alice = create_user("alice@example.com")
+        create_user("bob@example.com")
+        set_flood_control(FloodControl(connection=(0.001, 1)))
+        self.addCleanup(set_flood_control, None)
+
+    def test_throttled(self):
+        channel = "personal:bob@example.com"
+
+        async def run():
+            socket = communicator(self.alice, "/ws/stream/")
+            await socket.connect()
+            await socket.send_json_to({"action": "subscribe", "channel": channel})
+            frames = [await socket.receive_json_from(timeout=3)]
+            for message in ("one", "two", "three"):
+                await socket.send_json_to({"action": "send", "channel": channel, "message": message})
+            frames += [await socket.receive_json_from(timeout=3) for _ in range(2)]
+            # one throttled frame until retry_after has passed
+            self.assertTrue(await socket.receive_nothing(timeout=0.2))
+            await socket.disconnect()
+            return frames
+
+        # the broadcast and the throttled frame may arrive in either order
+        frames = {frame["type"]: frame for frame in async_to_sync(run)()}
+        sent, throttled = frames["message"], frames["throttled"]
+        self.assertEqual(sent["message"], "one")
+        self.assertEqual(
+            (throttled["type"], throttled["channel"], throttled["limit"]), ("throttled", channel, "connection"),
+        )
+        self.assertEqual(PersonalChat.objects.count(), 1)
+
+
+class RecentMessagesTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.recent = LocalRecentMessages(size=5, max_rooms=2, max_bytes=10 ** 6)
+        self.key = f"personal:{conversation_key(self.alice.id, self.bob.id)}"
+
+    def send(self, count, sender=None, receiver=None):
+        sender, receiver = sender or self.alice, receiver or self.bob
+        return [PersonalChat.objects.create(sender=sender, receiver=receiver, message=f"m{i}") for i in range(count)]
+
+    def test_fill(self):
+        rows = [message_row(message) for message in self.send(3)]
+        self.recent.fill(self.key, rows, None)
+        self.assertEqual(self.recent.first_page(self.key, 10), (rows, None))
+        page, cursor = self.recent.first_page(self.key, 2)
+        self.assertEqual((page, decode_cursor(cursor)), (rows[1:], (rows[1]["timestamp"], rows[1]["id"])))
+
+        # more rows than it keeps: only pages it holds entirely are served
+        rows = [message_row(message) for message in self.send(5)]
+        self.recent.fill(self.key, rows, "cursor")
+        self.assertIsNotNone(self.recent.first_page(self.key, 5))
+        self.assertIsNone(self.recent.first_page(self.key, 6))
+
+    def test_versioned_by_seq(self):
+        self.recent.fill(self.key, [message_row(message) for message in self.send(2)], None)
+        # written elsewhere: this instance never recorded it
+        self.send(1)
+        self.assertIsNone(self.recent.first_page(self.key, 10))
+        self.assertIsNone(self.recent.get(self.key))
+
+    def test_record(self):
+        self.recent.fill(self.key, [message_row(message) for message in self.send(2)], None)
+        self.recent.record(self.send(1))
+        self.assertEqual([row["seq"] for row in self.recent.first_page(self.key, 10)[0]], [1, 2, 3])
+
+        # a batch that doesn't continue the entry drops it
+        self.send(1)
+        self.recent.record(self.send(1))
+        self.assertIsNone(self.recent.get(self.key))
+
+    def test_bounded(self):
+        carol = create_user("carol@example.com")
+        keys = [self.key, f"personal:{conversation_key(self.alice.id, carol.id)}", "guild:1"]
+        for key in keys:
+            self.recent.fill(key, [], None)
+        self.assertEqual(self.recent.stats()["rooms"], 2)
+        self.assertIsNone(self.recent.get(keys[0]))
+
+    def test_shared_backend(self):
+        cache.delete(SharedRecentMessages.GENERATION_KEY)
+        # before anything was stored there is no generation to move past
+        SharedRecentMessages(5, "default", 60).clear()
+
+        first, second = SharedRecentMessages(5, "default", 60), SharedRecentMessages(5, "default", 60)
+        rows = [message_row(message) for message in self.send(2)]
+        first.fill(self.key, rows, None)
+        self.assertEqual(second.first_page(self.key, 10), (rows, None))
+        # a new generation orphans every entry, for every process
+        second.clear()
+        self.assertIsNone(first.get(self.key))
+        self.assertEqual(cache.get(SharedRecentMessages.GENERATION_KEY), 2)
+
+    def test_deleted_user_leaves_no_cached_messages(self):
+        guild = self.create_guild("Guild", self.alice, self.bob)
+        carol = create_user("carol@example.com")
+        GroupMessage.objects.create(group=guild, sender=self.bob, message="from bob")
+        GroupMessage.objects.create(group=guild, sender=self.alice, message="from alice")
+        self.send(1, self.bob, self.alice)
+        self.send(1, self.alice, carol)
+        urls = ["/chat/group/Guild/messages/", "/chat/messages/bob@example.com/", "/chat/messages/carol@example.com/"]
+        for url in urls:
+            self.client.get(url)
+        recent = get_recent_messages()
+        self.assertEqual(recent.stats()["rooms"], 3)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.bob.delete()
+        # the conversation with carol is still cached
+        self.assertEqual(recent.stats()["rooms"], 1)
+        response = self.client.get(urls[0])
+        self.assertEqual([row["message"] for row in response.data["results"]], ["from alice"])
+
+
+class MessageDeletionTests(ChatTestCase):
+    def test_deleting_a_user_deletes_their_messages(self):
+        guild = self.create_guild("Guild", self.alice, self.bob)
+        carol = create_user("carol@example.com")
+        GroupMessage.objects.create(group=guild, sender=self.bob, message="from bob")
+        GroupMessage.objects.create(group=guild, sender=self.alice, message="from alice")
+        PersonalChat.objects.create(sender=self.bob, receiver=self.alice, message="from bob")
+        PersonalChat.objects.create(sender=self.alice, receiver=carol, message="to carol")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.bob.delete()
+        self.assertEqual(list(GroupMessage.objects.values_list("message", flat=True)), ["from alice"])
+        self.assertEqual(list(PersonalChat.objects.values_list("message", flat=True)), ["to carol"])
+        self.assertEqual(ConversationSummary.objects.count(), 1)
+
+    def test_deleting_a_guild_deletes_its_messages(self):
+        guild = self.create_guild("Guild", self.alice)
+        other = self.create_guild("Other", self.bob)
+        GroupMessage.objects.create(group=guild, sender=self.alice, message="gone")
+        GroupMessage.objects.create(group=other, sender=self.bob, message="kept")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertTrue(guild.remove_member(self.alice))
+        self.assertEqual(list(GroupMessage.objects.values_list("message", flat=True)), ["kept"])
+
+
+class FanoutTests(SimpleTestCase):
+    @override_settings(CHAT_GUILD_FANOUT={"SHARD_SIZE": 100, "MAX_SHARDS": 4})
+    def test_shard_assignment(self):
+        self.assertEqual([shard_count(members) for members in (1, 100, 101, 300, 5000)], [1, 1, 2, 3, 4])
+        self.assertEqual(shard_groups("group_1", 100), ["group_1"])
+        self.assertEqual(shard_groups("group_1", 300), ["group_1.0", "group_1.1", "group_1.2"])
+        self.assertEqual([member_group("group_1", 300, user_id) for user_id in (3, 4, 5)], shard_groups("group_1", 300))
+        self.assertEqual(member_group("group_1", 100, 7), "group_1")
+
+    @override_settings(CHAT_GUILD_FANOUT={"SHARD_SIZE": 0})
+    def test_invalid_options(self):
+        with self.assertRaises(ValueError):
+            shard_count(100)
+
+    def send_all(self, groups):
+        sent, in_flight = [], [0, 0]  # current, most
+
+        class Layer:
+            async def group_send(self, group, event):
+                in_flight[0] += 1
+                in_flight[1] = max(in_flight)
+                await asyncio.sleep(0.01)
+                in_flight[0] -= 1
+                sent.append((group, event))
+
+        async_to_sync(group_send_all)(Layer(), groups, {"type": "chat.message"})
+        return sent, in_flight[1]
+
+    @override_settings(CHAT_GUILD_FANOUT={"CONCURRENCY": 3})
+    def test_concurrency_bounded(self):
+        groups = [f"group_1.{shard}" for shard in range(10)]
+        sent, most = self.send_all(groups)
+        self.assertEqual(sorted(group for group, _ in sent), sorted(groups))
+        self.assertEqual(most, 3)
+
+    def test_single_group(self):
+        sent, most = self.send_all(["group_1"])
+        self.assertEqual((sent, most), ([("group_1", {"type": "chat.message"})], 1))
+
+
+@override_settings(CHAT_GUILD_FANOUT={"SHARD_SIZE": 100, "MAX_SHARDS": 64})
+class ShardedGuildTests(TransactionTestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        get_recent_messages().clear()
+        # consecutive ids: one member on each of the guild's three shards
+        self.members = [create_user(f"user{i}@example.com") for i in range(3)]
+        self.guild = Chat_Group.objects.create(name="Guild", created_by=self.members[0], max_members=300)
+        for member in self.members:
+            self.guild.add_member(member)
+
+    def test_member_receives_through_one_shard(self):
+        groups = guild_groups(self.guild)
+        self.assertEqual(len(groups), 3)
+
+        async def run():
+            layer = get_channel_layer()
+            sockets, joined = [], []
+            for member in self.members:
+                before = {group: set(layer.groups.get(group, {})) for group in groups}
+                socket = communicator(member, "/ws/group/Guild/")
+                connected, _ = await socket.connect()
+                self.assertTrue(connected)
+                sockets.append(socket)
+                # the guild's groups the new socket joined
+                joined.append([group for group in groups if set(layer.groups.get(group, {})) - before[group]])
+            await sockets[0].send_json_to({"message": "hello"})
+            frames = []
+            for socket in sockets:
+                frames.append(await socket.receive_json_from(timeout=3))
+                self.assertTrue(await socket.receive_nothing(timeout=0.2))
+            for socket in sockets:
+                await socket.disconnect()
+            return joined, frames
+
+        joined, frames = async_to_sync(run)()
+        self.assertEqual(joined, [[guild_member_group(self.guild, member.id)] for member in self.members])
+        self.assertEqual(sorted(group for [group] in joined), groups)
+        self.assertEqual([frame["message"] for frame in frames], ["hello"] * 3)
@@ -0,0 +1,146 @@
+"""
+Token-bucket flood control of the messages clients send.
+
+Every chat message costs a database write and a fan-out, so a socket sending
+as fast as it can would crowd everyone else out of the writer and the thread
+pool. Each message must take one token from up to three buckets:
+
+* the connection's own bucket,
+* the sender's bucket, shared by all of that user's sockets in this process,
+* the guild's bucket (guild messages only), shared by all of its members.
+
+Buckets hold ``BURST`` tokens and refill at ``RATE`` tokens/second, as set
+per level in ``settings.CHAT_FLOOD_CONTROL``; a level set to None (the
+default for every level) is not limited. A message is only charged if every
+bucket has a token, so a message refused by the guild doesn't also use up
+the sender's allowance. Clients must handle the ``throttled`` frames sent
+for refused messages before limits are turned on.
+
+Like the token cache, user and guild buckets live in this process: with
+several ASGI workers each enforces its own limits. Buckets that have
+refilled completely are indistinguishable from new ones and are pruned.
+
+FloodControl is used from the event loop only and takes no locks.
+"""
+
+import threading
+import time
+
+from django.conf import settings
+
+CONNECTION = "connection"
+USER = "user"
+GUILD = "guild"
+
+DEFAULTS = {
+    CONNECTION.upper(): None,
+    USER.upper(): None,
+    GUILD.upper(): None,
+}
+
+# seconds between sweeps of refilled user and guild buckets
+PRUNE_INTERVAL = 60
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate  # tokens per second
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def wait(self, now):
+        """Seconds until a token is available; 0 if one is available now"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def full(self, now):
+        return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+
+class FloodControl:
+    def __init__(self, connection=None, user=None, guild=None):
+        # each level is a (rate, burst) pair, or None for no limit
+        self.limits = {CONNECTION: connection, USER: user, GUILD: guild}
+        self._buckets = {USER: {}, GUILD: {}}
+        self._pruned = time.monotonic()
+
+    @classmethod
+    def from_settings(cls):
+        options = {**DEFAULTS, **getattr(settings, "CHAT_FLOOD_CONTROL", {})}
+        levels = {}
+        for level in (CONNECTION, USER, GUILD):
+            limit = options[level.upper()]
+            levels[level] = (limit["RATE"], limit["BURST"]) if limit else None
+        return cls(**levels)
+
+    def connection_bucket(self):
+        """A new bucket for one connection, or None if connections aren't limited"""
+        limit = self.limits[CONNECTION]
+        return TokenBucket(*limit, time.monotonic()) if limit else None
+
+    def check(self, connection_bucket, user_id, guild_id=None):
+        """
+        Charge one message to every bucket it passes through. Returns None if
+        it may be sent, else ``(level, retry_after)`` for the bucket that will
+        take longest to allow it; nothing is charged then.
+        """
+        now = time.monotonic()
+        if now - self._pruned >= PRUNE_INTERVAL:
+            self._prune(now)
+
+        buckets = []
+        if connection_bucket is not None:
+            buckets.append((CONNECTION, connection_bucket))
+        for level, key in ((USER, user_id), (GUILD, guild_id)):
+            if key is not None and self.limits[level]:
+                bucket = self._buckets[level].get(key)
+                if bucket is None:
+                    bucket = self._buckets[level][key] = TokenBucket(*self.limits[level], now)
+                buckets.append((level, bucket))
+
+        refused = None
+        for level, bucket in buckets:
+            wait = bucket.wait(now)
+            if wait and (refused is None or wait > refused[1]):
+                refused = (level, wait)
+        if refused is not None:
+            return refused
+        for _, bucket in buckets:
+            bucket.take()
+        return None
+
+    def _prune(self, now):
+        self._pruned = now
+        for buckets in self._buckets.values():
+            for key in [key for key, bucket in buckets.items() if bucket.full(now)]:
+                del buckets[key]
+
+
+_flood_control = None
+_flood_control_lock = threading.Lock()
+
+
+def get_flood_control():
+    """Return the process-wide FloodControl, creating it from settings on first use."""
+    global _flood_control
+    if _flood_control is None:
+        with _flood_control_lock:
+            if _flood_control is None:
+                _flood_control = FloodControl.from_settings()
+    return _flood_control
+
+
+def set_flood_control(flood_control):
+    """Replace the process-wide FloodControl (None: rebuild from settings on next use)"""
+    global _flood_control
+    with _flood_control_lock:
+        _flood_control = flood_control
@@ -2,12 +2,14 @@ from django.urls import path
 from .views import (
     PersonalChatHistoryView, 
     GroupChatHistoryView, 
+    MessageSearchView,
     UserListView,
     GuildListView,
     GuildDetailView,
     GuildJoinView,
     GuildLeaveView,
     MyGuildView,
+    ConnectionTraceView,
 )
 
 urlpatterns = [
@@ -17,6 +19,9 @@ urlpatterns = [
     # Group/Guild chat
     path('group/<str:group_name>/messages/', GroupChatHistoryView.as_view(), name='group-chat-history'),
     
+    # Full-text search over the user's conversations and guild
+    path('search/', MessageSearchView.as_view(), name='message-search'),
+
     # Users list
     path('users/', UserListView.as_view(), name='user-list'),
     
@@ -26,4 +31,7 @@ urlpatterns = [
     path('guilds/<int:guild_id>/join/', GuildJoinView.as_view(), name='guild-join'),  # POST: join guild
     path('guilds/<int:guild_id>/leave/', GuildLeaveView.as_view(), name='guild-leave'),  # POST: leave guild
     path('guilds/my-guild/', MyGuildView.as_view(), name='my-guild'),  # GET: current user's guild
+
+    # Staff: runtime debug tracing of a user's WebSocket connections
+    path('debug/trace/', ConnectionTraceView.as_view(), name='connection-trace'),
 ]
\ No newline at end of file
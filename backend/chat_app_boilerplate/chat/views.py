@@ -1,46 +1,96 @@
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework import status
 from django.contrib.auth import get_user_model
-from .models import PersonalChat, Chat_Group, GroupMessage
-from django.db.models import Q, Max
+from .models import PersonalChat, Chat_Group, GroupMessage, ConversationSummary, conversation_key, is_active_member
+from django.conf import settings
+from django.db.models import Q
 from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from chat_app_boilerplate.logs import set_traced
+from .consumers import user_group_name
+from .archive import get_archive
+from .directory import guild_directory_page, invalidate_guild_directory
+from .fanout import fanout_options
+from .recent import get_recent_messages
+from .pagination import (
+    InvalidCursor,
+    decode_cursor,
+    encode_cursor,
+    paginate_messages,
+    parse_limit,
+    serialize_message,
+)
+from .search import InvalidQuery, SearchUnavailable, get_search_backend
 
 User = get_user_model()
 
 
+def history_page(request, queryset, sequence_key=None):
+    """
+    One keyset-paginated window of ``queryset`` as an API response. The
+    newest page of conversation ``sequence_key`` may come from the recent
+    messages cache, and pages past its live messages come from the archive.
+    """
+    before = request.query_params.get('before')
+    try:
+        limit = parse_limit(request.query_params.get('limit'))
+        page = None
+        if sequence_key and not before:
+            page = get_recent_messages().first_page(sequence_key, limit)
+        if page is None:
+            page = paginate_messages(queryset, before=before, limit=limit)
+            if sequence_key:
+                page = get_archive().extend_page(sequence_key, page, before, limit)
+            if sequence_key and not before:
+                get_recent_messages().fill(sequence_key, *page)
+    except InvalidCursor as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    rows, next_cursor = page
+    return Response({
+        "results": [serialize_message(row) for row in rows],
+        "next_cursor": next_cursor,
+        "has_more": next_cursor is not None,
+    })
+
+
 class PersonalChatHistoryView(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request, user_email):
-        """Get chat history between current user and another user"""
+        """
+        Get chat history between current user and another user,
+        newest page first (?before=<cursor>&limit=N)
+        """
+        # request.user may come from the token cache, which other processes don't invalidate
+        if not is_active_member(request.user.id):
+            return Response({"error": "User is inactive"}, status=403)
+
         try:
             other_user = User.objects.get(email=user_email)
         except User.DoesNotExist:
             return Response({"error": "User not found"}, status=404)
 
-        # Get all messages between the two users
-        messages = PersonalChat.objects.filter(
-            Q(sender=request.user, receiver=other_user) |
-            Q(sender=other_user, receiver=request.user)
-        ).order_by('timestamp')
+        # All messages between the two users
+        key = conversation_key(request.user.id, other_user.id)
+        messages = PersonalChat.objects.filter(conversation_key=key)
 
-        data = [{
-            "message": msg.message,
-            "sender": msg.sender.email,
-            "sender_name": msg.sender.name,
-            "timestamp": msg.timestamp.isoformat(),
-        } for msg in messages]
+        # Opening the conversation (its newest page) marks it as read
+        if not request.query_params.get('before'):
+            ConversationSummary.objects.mark_read(key, request.user.id)
 
-        return Response(data)
+        return history_page(request, messages, f"personal:{key}")
 
 
 class GroupChatHistoryView(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request, group_name):
-        """Get chat history for a group"""
+        """Get chat history for a group, newest page first (?before=<cursor>&limit=N)"""
         from urllib.parse import unquote
         
         # Decode URL-encoded group name (e.g., "Kau%20ka%20guild" -> "Kau ka guild")
@@ -51,20 +101,44 @@ class GroupChatHistoryView(APIView):
         except Chat_Group.DoesNotExist:
             return Response({"error": "Group not found"}, status=404)
 
-        # Check if user is a member
-        if not group.members.filter(id=request.user.id).exists():
+        # Check if user is a member, in the database rather than the token cache
+        if not is_active_member(request.user.id, group.id):
             return Response({"error": "You are not a member of this group"}, status=403)
 
-        messages = GroupMessage.objects.filter(group=group).order_by('timestamp')
+        return history_page(request, GroupMessage.objects.filter(group=group), f"guild:{group.id}")
 
-        data = [{
-            "message": msg.message,
-            "sender": msg.sender.email,
-            "sender_name": msg.sender.name,
-            "timestamp": msg.timestamp.isoformat(),
-        } for msg in messages]
 
-        return Response(data)
+class MessageSearchView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        """
+        Search the current user's personal conversations and guild
+        (?q=<words>&after=<cursor>&limit=N), best and newest matches first
+        """
+        # Scoped by the user row in the database: request.user may come from
+        # the token cache, with a guild the user has since left
+        user = User.objects.filter(id=request.user.id, is_active=True).only('id', 'guild_id').first()
+        if user is None:
+            return Response({"error": "User is inactive"}, status=403)
+
+        try:
+            results, next_cursor = get_search_backend().search(
+                user,
+                request.query_params.get('q', ''),
+                after=request.query_params.get('after'),
+                limit=parse_limit(request.query_params.get('limit')),
+            )
+        except (InvalidQuery, InvalidCursor) as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except SearchUnavailable as e:
+            return Response({"error": str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        return Response({
+            "results": results,
+            "next_cursor": next_cursor,
+            "has_more": next_cursor is not None,
+        })
 
 
 class UserListView(APIView):
@@ -72,114 +146,153 @@ class UserListView(APIView):
 
     def get(self, request):
         """
-        Get list of users with whom current user has had conversations,
-        plus all active users (for starting new chats)
+        Get the current user's most recent conversations (first page only,
+        up to CHAT_MAX_CONVERSATIONS) plus a page of the other active users
+        for starting new chats (?search=<name or email prefix>&after=<cursor>&limit=N)
         """
         current_user = request.user
-        
-        # Get all users who have exchanged messages with current user
-        conversations = PersonalChat.objects.filter(
-            Q(sender=current_user) | Q(receiver=current_user)
-        ).values(
-            'sender', 'receiver'
-        ).distinct()
-        
-        # Extract unique user IDs from conversations
-        contact_ids = set()
-        for conv in conversations:
-            if conv['sender'] != current_user.id:
-                contact_ids.add(conv['sender'])
-            if conv['receiver'] != current_user.id:
-                contact_ids.add(conv['receiver'])
-        
-        # Get all active users
-        all_users = User.objects.filter(is_active=True).exclude(id=current_user.id)
-        
-        contacts_data = []
-        for user in all_users:
-            # Get last message with this user
-            last_message = PersonalChat.objects.filter(
-                Q(sender=current_user, receiver=user) |
-                Q(sender=user, receiver=current_user)
-            ).order_by('-timestamp').first()
-            
-            contact_info = {
-                "id": user.id,
-                "email": user.email,
-                "name": user.name,
+        try:
+            limit = parse_limit(request.query_params.get('limit'))
+            after = request.query_params.get('after')
+            if after:
+                name, user_id = decode_cursor(after, types=(str, int))
+        except InvalidCursor as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        # One indexed query over the newest conversation summaries, one for their
+        # peers (summaries may live in another database than users)
+        max_conversations = getattr(settings, "CHAT_MAX_CONVERSATIONS", 100)
+        summaries = list(ConversationSummary.objects.for_user(current_user)[:max_conversations])
+        contact_ids = {summary.peer_id_of(current_user) for summary in summaries}
+
+        conversations = []
+        if not after:
+            peers = User.objects.in_bulk(contact_ids)
+            for summary in summaries:
+                peer = peers.get(summary.peer_id_of(current_user))
+                if peer is None or not peer.is_active:
+                    continue
+                conversations.append({
+                    "id": peer.id,
+                    "email": peer.email,
+                    "name": peer.name,
+                    "lastMessage": summary.last_message,
+                    "lastMessageTime": summary.last_timestamp.strftime("%I:%M %p"),
+                    "unreadCount": summary.unread_for(current_user),
+                    "hasConversation": True,
+                })
+
+        # Directory of everyone else, paged by (name, id)
+        users = User.objects.filter(is_active=True).exclude(
+            id__in=contact_ids | {current_user.id}
+        )
+        search = request.query_params.get('search', '').strip()
+        if search:
+            users = users.filter(Q(name__istartswith=search) | Q(email__istartswith=search))
+        if after:
+            users = users.filter(Q(name__gt=name) | Q(name=name, id__gt=user_id))
+
+        page = list(users.order_by('name', 'id').values('id', 'email', 'name')[:limit + 1])
+        next_cursor = None
+        if len(page) > limit:
+            page = page[:limit]
+            next_cursor = encode_cursor(page[-1]['name'], page[-1]['id'])
+
+        # Conversations older than the newest max_conversations stay in the
+        # directory; only then is the page checked against the summaries
+        older_contacts = set()
+        if page and len(summaries) == max_conversations:
+            page_ids = [user['id'] for user in page]
+            older_contacts = {
+                summary.peer_id_of(current_user)
+                for summary in ConversationSummary.objects.filter(
+                    Q(user_low=current_user, user_high__in=page_ids) | Q(user_high=current_user, user_low__in=page_ids)
+                ).only('user_low', 'user_high')
             }
-            
-            if last_message:
-                contact_info["lastMessage"] = last_message.message[:50]  # Truncate
-                contact_info["lastMessageTime"] = last_message.timestamp.strftime("%I:%M %p")
-                contact_info["hasConversation"] = True
-            else:
-                contact_info["hasConversation"] = False
-            
-            contacts_data.append(contact_info)
-        
-        # Sort: users with conversations first, then alphabetically
-        contacts_data.sort(key=lambda x: (not x.get('hasConversation', False), x['name'].lower()))
-        
-        return Response(contacts_data)
+
+        return Response({
+            "conversations": conversations,
+            "users": [{**user, "hasConversation": user['id'] in older_contacts} for user in page],
+            "next_cursor": next_cursor,
+            "has_more": next_cursor is not None,
+        })
 
 
 class GuildListView(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
-        """Get list of all available guilds"""
-        guilds = Chat_Group.objects.all()
-        
-        data = []
-        for guild in guilds:
-            # accessing foreign key
-            member_count = guild.group_members.count()
-            is_member = guild.group_members.filter(id=request.user.id).exists()
-            
-            guild_info = {
-                "id": guild.id,
-                "name": guild.name,
-                "description": guild.description or "No description",
-                "memberCount": member_count,
-                "maxMembers": guild.max_members,
-                "isFull": member_count >= guild.max_members,
-                "isMember": is_member,
-                "createdBy": guild.created_by.name if guild.created_by else "Unknown",
-                "createdAt": guild.created_at.isoformat(),
-            }
-            data.append(guild_info)
-        
-        return Response(data)
+        """
+        Get a page of guilds ordered by name
+        (?prefix=<name prefix>&after=<cursor>&limit=N)
+        """
+        try:
+            guilds, next_cursor = guild_directory_page(
+                prefix=request.query_params.get('prefix', '').strip(),
+                after=request.query_params.get('after'),
+                limit=parse_limit(request.query_params.get('limit')),
+            )
+        except InvalidCursor as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        # The cached page is shared by everyone; membership is per caller
+        data = [
+            {**guild, "isMember": guild["id"] == request.user.guild_id}
+            for guild in guilds
+        ]
+
+        return Response({
+            "results": data,
+            "next_cursor": next_cursor,
+            "has_more": next_cursor is not None,
+        })
 
     def post(self, request):
-        """Create a new guild"""
+        """Create a new guild (optional maxMembers, up to CHAT_GUILD_FANOUT["MAX_MEMBERS"])"""
         name = request.data.get('name')
         description = request.data.get('description', '')
         
         if not name:
             return Response({"error": "Guild name is required"}, status=status.HTTP_400_BAD_REQUEST)
+
+        max_members = request.data.get('maxMembers', Chat_Group._meta.get_field('max_members').default)
+        limit = fanout_options()["MAX_MEMBERS"]
+        try:
+            max_members = int(max_members)
+        except (TypeError, ValueError):
+            max_members = None
+        if max_members is None or not 1 <= max_members <= limit:
+            return Response(
+                {"error": f"maxMembers must be between 1 and {limit}"}, status=status.HTTP_400_BAD_REQUEST
+            )
         
         # Check if user is already in a guild
-        existing_guilds = Chat_Group.objects.filter(group_members=request.user)
-        if existing_guilds.exists():
+        if request.user.guild_id is not None:
+            current = Chat_Group.objects.filter(id=request.user.guild_id).values_list('name', flat=True).first()
             return Response({
-                "error": f"You are already in guild: {existing_guilds.first().name}. Leave it first to create a new one."
+                "error": f"You are already in guild: {current}. Leave it first to create a new one."
             }, status=status.HTTP_400_BAD_REQUEST)
         
         # Check if guild name already exists
         if Chat_Group.objects.filter(name=name).exists():
             return Response({"error": "Guild name already exists"}, status=status.HTTP_400_BAD_REQUEST)
         
-        # Create guild
-        guild = Chat_Group.objects.create(
-            name=name,
-            description=description,
-            created_by=request.user
-        )
-        
-        # Add creator as first member
-        guild.group_members.add(request.user)
+        # Create guild and add creator as first member; a failed join
+        # (e.g. a concurrent join elsewhere) rolls the creation back
+        try:
+            with transaction.atomic():
+                guild = Chat_Group.objects.create(
+                    name=name,
+                    description=description,
+                    created_by=request.user,
+                    max_members=max_members,
+                )
+                guild.add_member(request.user)
+        except IntegrityError:
+            return Response({"error": "Guild name already exists"}, status=status.HTTP_400_BAD_REQUEST)
+        except ValidationError as e:
+            return Response({"error": e.messages[0]}, status=status.HTTP_400_BAD_REQUEST)
+        invalidate_guild_directory()
         
         return Response({
             "message": "Guild created successfully",
@@ -187,7 +300,7 @@ class GuildListView(APIView):
                 "id": guild.id,
                 "name": guild.name,
                 "description": guild.description,
-                "memberCount": 1,
+                "memberCount": guild.member_count,
                 "maxMembers": guild.max_members,
             }
         }, status=status.HTTP_201_CREATED)
@@ -199,7 +312,7 @@ class GuildDetailView(APIView):
     def get(self, request, guild_id):
         """Get guild details including members"""
         try:
-            guild = Chat_Group.objects.get(id=guild_id)
+            guild = Chat_Group.objects.select_related('created_by').get(id=guild_id)
         except Chat_Group.DoesNotExist:
             return Response({"error": "Guild not found"}, status=404)
         
@@ -207,15 +320,15 @@ class GuildDetailView(APIView):
             "id": member.id,
             "email": member.email,
             "name": member.name,
-        } for member in guild.group_member.all()]
+        } for member in guild.group_members.all()]
         
         return Response({
             "id": guild.id,
             "name": guild.name,
             "description": guild.description,
-            "memberCount": guild.group_members.count(),
+            "memberCount": guild.member_count,
             "maxMembers": guild.max_members,
-            "isMember": guild.group_members.filter(id=request.user.id).exists(),
+            "isMember": request.user.guild_id == guild.id,
             "createdBy": guild.created_by.name if guild.created_by else "Unknown",
             "members": members,
         })
@@ -232,21 +345,23 @@ class GuildJoinView(APIView):
             return Response({"error": "Guild not found"}, status=404)
         
         # Check if already a member
-        if guild.group_members.filter(id=request.user.id).exists():
+        if request.user.guild_id == guild.id:
             return Response({"error": "You are already a member of this guild"}, status=status.HTTP_400_BAD_REQUEST)
         
         try:
             guild.add_member(request.user)
-            return Response({
-                "message": f"Successfully joined {guild.name}",
-                "guild": {
-                    "id": guild.id,
-                    "name": guild.name,
-                    "memberCount": guild.group_members.count(),
-                }
-            })
         except ValidationError as e:
-            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            return Response({"error": e.messages[0]}, status=status.HTTP_400_BAD_REQUEST)
+        invalidate_guild_directory()
+
+        return Response({
+            "message": f"Successfully joined {guild.name}",
+            "guild": {
+                "id": guild.id,
+                "name": guild.name,
+                "memberCount": guild.member_count,
+            }
+        })
 
 
 class GuildLeaveView(APIView):
@@ -260,23 +375,25 @@ class GuildLeaveView(APIView):
             return Response({"error": "Guild not found"}, status=404)
         
         # Check if user is a member
-        if not guild.group_members.filter(id=request.user.id).exists():
+        if request.user.guild_id != guild.id:
             return Response({"error": "You are not a member of this guild"}, status=status.HTTP_400_BAD_REQUEST)
         
-        guild.remove_member(request.user)
+        try:
+            # Deletes the guild when the last member leaves
+            deleted = guild.remove_member(request.user)
+        except ValidationError as e:
+            return Response({"error": e.messages[0]}, status=status.HTTP_400_BAD_REQUEST)
+        invalidate_guild_directory()
         
-        # If no members left, delete the guild
-        if guild.group_members.count() == 0:
-            guild_name = guild.name
-            guild.delete()
-            return Response({"message": f"You left {guild_name}. Guild was deleted as it had no members."})
+        if deleted:
+            return Response({"message": f"You left {guild.name}. Guild was deleted as it had no members."})
         
         return Response({
             "message": f"Successfully left {guild.name}",
             "guild": {
                 "id": guild.id,
                 "name": guild.name,
-                "memberCount": guild.group_members.count(),
+                "memberCount": guild.member_count,
             }
         })
 
@@ -286,12 +403,13 @@ class MyGuildView(APIView):
 
     def get(self, request):
         """Get the guild current user is in"""
-        guilds = Chat_Group.objects.filter(group_members=request.user)
+        guild = None
+        if request.user.guild_id is not None:
+            guild = Chat_Group.objects.select_related('created_by').filter(id=request.user.guild_id).first()
         
-        if not guilds.exists():
+        if guild is None:
             return Response({"guild": None, "message": "You are not in any guild"})
         
-        guild = guilds.first()
         members = [{
             "id": member.id,
             "email": member.email,
@@ -303,9 +421,30 @@ class MyGuildView(APIView):
                 "id": guild.id,
                 "name": guild.name,
                 "description": guild.description,
-                "memberCount": guild.group_members.count(),
+                "memberCount": guild.member_count,
                 "maxMembers": guild.max_members,
                 "createdBy": guild.created_by.name if guild.created_by else "Unknown",
                 "members": members,
             }
-        })
\ No newline at end of file
+        })
+
+
+class ConnectionTraceView(APIView):
+    permission_classes = [IsAdminUser]
+
+    def post(self, request):
+        """
+        Switch debug tracing of a user's WebSocket connections on or off
+        ({"user_id": 1, "enabled": true}); applies to open and new sockets
+        """
+        try:
+            user_id = int(request.data.get('user_id'))
+        except (TypeError, ValueError):
+            return Response({"error": "user_id is required"}, status=status.HTTP_400_BAD_REQUEST)
+        enabled = bool(request.data.get('enabled', True))
+
+        set_traced(user_id, enabled)
+        async_to_sync(get_channel_layer().group_send)(
+            user_group_name(user_id), {"type": "trace.set", "enabled": enabled}
+        )
+        return Response({"user_id": user_id, "enabled": enabled})
@@ -0,0 +1,71 @@
+"""
+Redis channel layer sharded over several Redis servers by consistent hashing.
+
+RedisChannelLayer already spreads groups and process-local channels over its
+``hosts``, but picks a host from ``crc32(name) % len(hosts)``: adding or
+removing a host moves almost every group to another server, so sockets
+connected before the change stop receiving that group's messages until
+they reconnect. This layer places every host on a hash ring at
+``VNODES`` points and routes a name to the next point clockwise, so a new
+host only takes over about ``1/len(hosts)`` of the names.
+
+Hosts are placed on the ring by their address, not their position in the
+list, so every process sharing the layer must list the same hosts but not
+necessarily in the same order.
+
+Process-local channel names (``specific.<client>!<id>``) are routed by
+their ``specific.<client>!`` prefix. All of a process's channels then share
+one shard, the one its receive loop reads from. RedisChannelLayer.send()
+hashes the full name instead, which can pick a different host than the
+receive loop once there is more than one.
+"""
+
+import bisect
+import zlib
+
+from channels_redis.core import RedisChannelLayer
+
+# ring points per host; enough for an even spread over a handful of servers
+VNODES = 160
+
+
+def host_id(host):
+    """A stable name for a decoded ``hosts`` entry"""
+    if "address" in host:
+        return str(host["address"])
+    if "master_name" in host:
+        return f"sentinel:{host['master_name']}"
+    return f"{host.get('host', 'localhost')}:{host.get('port', 6379)}/{host.get('db', 0)}"
+
+
+class HashRing:
+    def __init__(self, nodes, vnodes=VNODES):
+        points = sorted(
+            (zlib.crc32(f"{node}#{replica}".encode()), index)
+            for index, node in enumerate(nodes)
+            for replica in range(vnodes)
+        )
+        self._hashes = [point for point, _ in points]
+        self._indexes = [index for _, index in points]
+
+    def index(self, value):
+        if isinstance(value, str):
+            value = value.encode("utf8")
+        position = bisect.bisect(self._hashes, zlib.crc32(value))
+        return self._indexes[position % len(self._indexes)]
+
+
+class ShardedRedisChannelLayer(RedisChannelLayer):
+    def __init__(self, hosts=None, vnodes=VNODES, **kwargs):
+        super().__init__(hosts=hosts, **kwargs)
+        names = [host_id(host) for host in self.hosts]
+        if len(set(names)) != len(names):
+            raise ValueError(f"Channel layer hosts must be distinct: {names}")
+        self.ring = HashRing(names, vnodes)
+
+    def consistent_hash(self, value):
+        if self.ring_size == 1:
+            return 0
+        if "!" in value:
+            value = self.non_local_name(value)
+        return self.ring.index(value)
@@ -0,0 +1,163 @@
+"""
+SQLite production profile: connection pragmas and a pool of read connections.
+
+SQLite allows one writer at a time. With the default rollback journal every
+read also blocks on the writer, and a transaction that starts reading and
+then writes fails with "database is locked" instead of waiting. The profile
+(``settings.SQLITE_PROFILE``, filled in when the ``SQLITE_PRODUCTION_PROFILE``
+environment variable is set) addresses both:
+
+* ``PRAGMAS`` are applied to every new SQLite connection: WAL journaling, so
+  readers never wait for the writer; ``synchronous=NORMAL``, which is safe
+  in WAL mode and skips an fsync per commit; a ``busy_timeout`` during
+  which writers queue for the lock instead of failing; and memory-mapped
+  reads. ``DATABASES["default"]["OPTIONS"]["transaction_mode"] =
+  "IMMEDIATE"`` makes ``atomic()`` take the write lock up front, where the
+  busy timeout applies.
+* Chat writes go through the single writer thread of chat/persistence.py.
+* Socket-side reads run on a pool of ``READ_POOL_SIZE`` threads (see
+  ``database_read_async``). Each thread keeps its own connections to the
+  read aliases of ``READ_DATABASES`` (e.g. ``read`` for ``default``): the
+  same database files, opened ``query_only`` and kept open (``CONN_MAX_AGE
+  = None``), so reads neither wait for nor take the write lock. Routers
+  send reads made on those threads to the read alias of the database they
+  would use (``read_database``); everything else is unchanged.
+
+Without the profile the pool threads read through the ordinary aliases
+and connections behave as Django's defaults.
+
+Read aliases are test mirrors of their databases, so tests that use the
+pool must allow them too (``databases = "__all__"``).
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from asgiref.sync import SyncToAsync
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, close_old_connections, connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+DEFAULTS = {
+    "PRAGMAS": {},
+    # database alias -> alias of its read-only connections
+    "READ_DATABASES": {},
+    "READ_POOL_SIZE": 4,
+}
+
+_reading = threading.local()
+
+
+def _options():
+    return {**DEFAULTS, **getattr(settings, "SQLITE_PROFILE", {})}
+
+
+@receiver(connection_created)
+def configure_sqlite(sender, connection, **kwargs):
+    if connection.vendor != "sqlite":
+        return
+    with connection.cursor() as cursor:
+        for name, value in _options()["PRAGMAS"].items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+        if connection.alias in _options()["READ_DATABASES"].values():
+            cursor.execute("PRAGMA query_only = ON")
+
+
+def read_database(alias):
+    """The alias reads of ``alias`` use on the current thread"""
+    if getattr(_reading, "active", False):
+        read_alias = _options()["READ_DATABASES"].get(alias)
+        if read_alias in connections.databases:
+            return read_alias
+    return alias
+
+
+def primary_database(alias):
+    """The database a read alias mirrors (``alias`` itself for any other)"""
+    for primary, read_alias in _options()["READ_DATABASES"].items():
+        if read_alias == alias:
+            return primary
+    return alias
+
+
+@contextmanager
+def read_only():
+    """Route the current thread's reads to the read alias while active"""
+    previous = getattr(_reading, "active", False)
+    _reading.active = True
+    try:
+        yield
+    finally:
+        _reading.active = previous
+
+
+class ReadPoolRouter:
+    """
+    Sends reads made under ``read_only()`` to the read alias of ``default``;
+    list it after routers that place models elsewhere
+    """
+
+    def db_for_read(self, model, **hints):
+        alias = read_database(DEFAULT_DB_ALIAS)
+        return alias if alias != DEFAULT_DB_ALIAS else None
+
+    def db_for_write(self, model, **hints):
+        # objects loaded through a read alias are saved to the database it mirrors
+        instance = hints.get("instance")
+        if instance is not None and instance._state.db:
+            alias = primary_database(instance._state.db)
+            if alias != instance._state.db:
+                return alias
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if primary_database(obj1._state.db) == primary_database(obj2._state.db):
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, **hints):
+        if db in _options()["READ_DATABASES"].values():
+            return False
+        return None
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_read_pool():
+    """Return the process-wide read thread pool, creating it from settings on first use."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadPoolExecutor(max_workers=_options()["READ_POOL_SIZE"], thread_name_prefix="db-read")
+    return _pool
+
+
+class DatabaseReadAsync(SyncToAsync):
+    """
+    ``database_sync_to_async`` for read-only functions: runs them on the read
+    pool, through the pool thread's persistent read connection.
+    """
+
+    def __init__(self, func):
+        super().__init__(func, thread_sensitive=False)
+
+    async def __call__(self, *args, **kwargs):
+        # the pool is created on first use, not when the decorated module is imported
+        self._executor = get_read_pool()
+        return await super().__call__(*args, **kwargs)
+
+    def thread_handler(self, loop, *args, **kwargs):
+        with read_only():
+            try:
+                return super().thread_handler(loop, *args, **kwargs)
+            finally:
+                # read connections never expire, so this only drops broken ones
+                close_old_connections()
+
+
+database_read_async = DatabaseReadAsync
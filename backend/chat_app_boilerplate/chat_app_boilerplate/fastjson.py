@@ -0,0 +1,155 @@
+"""
+JSON encoding for REST responses and WebSocket frames.
+
+Serialization is a visible share of CPU at chat fan-out rates, so the hot
+paths encode through one backend chosen by ``settings.FAST_JSON["BACKEND"]``:
+
+* ``orjson`` encodes several times faster than the standard library
+  (pinned in requirements.txt);
+* ``json`` is the standard library;
+* ``auto`` (default) uses orjson when it is installed, ``json`` otherwise,
+  e.g. in an environment set up without requirements.txt.
+
+Both produce the output of DRF's ``JSONRenderer`` with its default
+settings: compact, UTF-8, and values JSON can't hold (dates, Decimals,
+UUIDs, lazy strings, ...) converted by DRF's ``JSONEncoder``. Use
+``dumps`` for text (WebSocket frames) and ``dumpb`` for bytes (HTTP
+bodies); ``loads`` takes either. Malformed input, invalid UTF-8 and the
+``NaN`` / ``Infinity`` constants raise ``JSONDecodeError`` with either
+backend.
+
+``FastJSONRenderer`` and ``FastJSONParser`` are drop-in replacements for
+DRF's JSON renderer and parser (see ``REST_FRAMEWORK`` in settings.py).
+"""
+
+import json
+import threading
+
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+from rest_framework.settings import api_settings
+from rest_framework.utils.encoders import JSONEncoder
+
+DEFAULTS = {
+    "BACKEND": "auto",  # "auto", "orjson" or "json"
+}
+
+# orjson.JSONDecodeError subclasses it
+JSONDecodeError = json.JSONDecodeError
+
+
+def _reject_constant(name):
+    # NaN / Infinity aren't JSON, as for DRF's strict parser; orjson refuses them too
+    raise JSONDecodeError(f"Out of range float values are not JSON compliant: {name}", name, 0)
+
+
+class StdlibJSON:
+    name = "json"
+
+    def __init__(self):
+        self._encoder = JSONEncoder(ensure_ascii=False, separators=(",", ":"), allow_nan=False)
+
+    def dumps(self, obj):
+        return self._encoder.encode(obj)
+
+    def dumpb(self, obj):
+        return self._encoder.encode(obj).encode()
+
+    def loads(self, data):
+        if isinstance(data, (bytes, bytearray)):
+            try:
+                data = data.decode()
+            except UnicodeDecodeError as e:
+                raise JSONDecodeError(f"Invalid UTF-8: {e.reason}", "", e.start) from e
+        return json.loads(data, parse_constant=_reject_constant)
+
+
+class OrJSON:
+    name = "orjson"
+
+    def __init__(self):
+        import orjson
+
+        self._dumps = orjson.dumps
+        self._loads = orjson.loads
+        # datetimes go through DRF's encoder too, for the same format
+        self._option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        self._default = JSONEncoder().default
+
+    def dumps(self, obj):
+        return self._dumps(obj, default=self._default, option=self._option).decode()
+
+    def dumpb(self, obj):
+        return self._dumps(obj, default=self._default, option=self._option)
+
+    def loads(self, data):
+        return self._loads(data)
+
+
+def _build():
+    backend = {**DEFAULTS, **getattr(settings, "FAST_JSON", {})}["BACKEND"]
+    if backend == "auto":
+        try:
+            return OrJSON()
+        except ImportError:
+            return StdlibJSON()
+    if backend == "orjson":
+        return OrJSON()
+    if backend == "json":
+        return StdlibJSON()
+    raise ValueError(f"Unknown JSON backend: {backend}")
+
+
+_json = None
+_json_lock = threading.Lock()
+
+
+def get_json():
+    """Return the configured JSON backend, creating it from settings on first use."""
+    global _json
+    if _json is None:
+        with _json_lock:
+            if _json is None:
+                _json = _build()
+    return _json
+
+
+def dumps(obj):
+    return get_json().dumps(obj)
+
+
+def dumpb(obj):
+    return get_json().dumpb(obj)
+
+
+def loads(data):
+    return get_json().loads(data)
+
+
+class FastJSONRenderer(JSONRenderer):
+    """``JSONRenderer`` through the fast backend; indented output keeps DRF's encoder"""
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        indent = self.get_indent(accepted_media_type, renderer_context or {})
+        if indent or not (api_settings.UNICODE_JSON and api_settings.COMPACT_JSON):
+            return super().render(data, accepted_media_type, renderer_context)
+        # escaped like JSONRenderer does, so the output is safe inside <script>
+        return dumpb(data).replace(b"\xe2\x80\xa8", b"\\u2028").replace(b"\xe2\x80\xa9", b"\\u2029")
+
+
+class FastJSONParser(JSONParser):
+    """``JSONParser`` through the fast backend"""
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        encoding = (parser_context or {}).get("encoding", settings.DEFAULT_CHARSET)
+        try:
+            data = stream.read()
+            if encoding.lower().replace("-", "") != "utf8":
+                data = data.decode(encoding)
+            return loads(data)
+        except ValueError as exc:
+            raise ParseError(f"JSON parse error - {exc}")
@@ -0,0 +1,186 @@
+"""
+Structured, levelled and sampled logging for the chat and auth hot paths.
+
+Code logs named events with key=value fields instead of printing:
+
+    log = get_event_logger(__name__)
+    log.event("ws.message.received", sampled=True, user=user.id, size=len(text_data))
+
+* Every event has a level (EVENT_LEVELS, overridable per event through
+  ``settings.CHAT_LOGGING["EVENTS"]``); disabled events cost one level check.
+* Per-message events pass ``sampled=True`` and are only emitted for a
+  ``SAMPLE_RATE`` fraction of calls.
+* Fields are rendered lazily, on the logging thread, only if a record is
+  actually written.
+* ``NonBlockingQueueHandler`` hands records to a background thread through
+  a bounded queue, so the event loop never waits on log I/O; when the queue
+  is full records are dropped and counted instead of blocking.
+
+Per-connection tracing can be switched on at runtime for a user (see
+``set_traced``): traced connections emit all their events at INFO, unsampled.
+"""
+
+import logging
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .metrics import REGISTRY
+
+DEFAULTS = {
+    "SAMPLE_RATE": 0.01,
+    "EVENTS": {},
+    "QUEUE_SIZE": 10000,
+    "TRACE_TIMEOUT": 3600,  # seconds a runtime trace switch stays on
+}
+
+EVENT_LEVELS = {
+    # WebSocket connection lifecycle
+    "ws.connect": logging.DEBUG,
+    "ws.connect.accepted": logging.INFO,
+    "ws.connect.rejected": logging.INFO,
+    "ws.disconnect": logging.INFO,
+    # per-message events, sampled
+    "ws.message.received": logging.DEBUG,
+    "ws.message.broadcast": logging.DEBUG,
+    "ws.message.sent": logging.DEBUG,
+    # per-message problems
+    "ws.message.invalid": logging.WARNING,
+    "ws.message.persist_failed": logging.ERROR,
+    "ws.message.broadcast_failed": logging.ERROR,
+    "ws.message.throttled": logging.WARNING,
+    "ws.peer.invalidated": logging.INFO,
+    "ws.trace": logging.INFO,
+    # WebSocket authentication
+    "auth.ws.token_missing": logging.DEBUG,
+    "auth.ws.authenticated": logging.DEBUG,
+    "auth.ws.failed": logging.INFO,
+}
+
+
+def _options():
+    return {**DEFAULTS, **getattr(settings, "CHAT_LOGGING", {})}
+
+
+class _Fields:
+    """key=value rendering of an event's fields, deferred until formatting"""
+
+    __slots__ = ("fields",)
+
+    def __init__(self, fields):
+        self.fields = fields
+
+    def __str__(self):
+        return " ".join(f"{key}={_quote(value)}" for key, value in self.fields.items())
+
+
+def _quote(value):
+    text = str(value)
+    if not text or any(ch in text for ch in ' ="'):
+        return '"' + text.replace('"', '\\"') + '"'
+    return text
+
+
+class EventLogger:
+    def __init__(self, name):
+        self.logger = logging.getLogger(name)
+        options = _options()
+        self.sample_rate = options["SAMPLE_RATE"]
+        self.levels = {**EVENT_LEVELS}
+        for event, level in options["EVENTS"].items():
+            self.levels[event] = logging.getLevelName(level) if isinstance(level, str) else level
+
+    def event(self, event, sampled=False, trace=False, **fields):
+        """
+        Log ``event`` with ``fields`` at its configured level. ``sampled``
+        events are dropped except for a SAMPLE_RATE fraction; ``trace``
+        (a traced connection) logs at INFO or above and skips sampling.
+        """
+        level = self.levels.get(event, logging.INFO)
+        if trace:
+            level = max(level, logging.INFO)
+        elif sampled and random.random() >= self.sample_rate:
+            return
+        if not self.logger.isEnabledFor(level):
+            return
+        exc_info = fields.pop("exc_info", None)
+        self.logger.log(level, "%s %s", event, _Fields(fields), exc_info=exc_info)
+
+
+def get_event_logger(name):
+    return EventLogger(name)
+
+
+class _Listener(QueueListener):
+    def enqueue_sentinel(self):
+        # wait for room: at shutdown the queue may be full of pending records
+        self.queue.put(self._sentinel)
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    Queue records for a background thread that writes them to stderr.
+    Records are never formatted on the calling thread.
+    """
+
+    dropped = 0
+
+    def __init__(self, maxsize=None):
+        super().__init__(queue.Queue(maxsize or _options()["QUEUE_SIZE"]))
+        self.target = logging.StreamHandler()
+        self.listener = _Listener(self.queue, self.target)
+        self.listener.start()
+        self._running = True
+
+    def setFormatter(self, fmt):
+        super().setFormatter(fmt)
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record):
+        # same-process queue: keep msg/args as they are so formatting stays lazy
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            NonBlockingQueueHandler.dropped += 1
+
+    def close(self):
+        # logging.shutdown() closes handlers at exit; drain what is queued
+        if self._running:
+            self._running = False
+            self.listener.stop()
+        super().close()
+
+
+def _trace_key(user_id):
+    return f"chat:trace:{user_id}"
+
+
+def is_traced(user_id):
+    """Whether debug tracing was switched on for ``user_id``'s connections"""
+    return bool(cache.get(_trace_key(user_id)))
+
+
+async def ais_traced(user_id):
+    return bool(await cache.aget(_trace_key(user_id)))
+
+
+def set_traced(user_id, enabled):
+    """Switch tracing for ``user_id``'s future connections on or off"""
+    if enabled:
+        cache.set(_trace_key(user_id), True, timeout=_options()["TRACE_TIMEOUT"])
+    else:
+        cache.delete(_trace_key(user_id))
+
+
+def _log_samples():
+    return [("log_records_dropped_total", "counter", "Log records dropped because the log queue was full",
+             [({}, NonBlockingQueueHandler.dropped)])]
+
+
+REGISTRY.register_collector(_log_samples)
@@ -0,0 +1,272 @@
+"""
+In-process metrics, exposed in the Prometheus text format at ``/metrics``.
+
+Metrics are plain counters, gauges and histograms held in this process,
+with a child per label combination created on first use:
+
+    WS_MESSAGES = counter("chat_ws_messages_received_total", "...", ["consumer"])
+    WS_MESSAGES.labels("guild").inc()
+
+Updating one costs a dict lookup (cached child) and a lock. Rates
+(connects/sec, messages/sec) are left to the scraper: ``rate()`` over the
+``_total`` counters.
+
+Values that already live elsewhere (token cache counters, dropped log
+records) are read at scrape time through ``register_collector``.
+
+Each ASGI worker process has its own registry; scrape each worker, or run
+one process per target behind the load balancer.
+"""
+
+import bisect
+import hmac
+import threading
+import time
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+
+# seconds; Prometheus' default latency buckets
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _CounterChild:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class _GaugeChild(_CounterChild):
+    __slots__ = ()
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value):
+        with self._lock:
+            self.value = value
+
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "count", "_lock")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def observe_since(self, started):
+        """Observe the seconds elapsed since the ``time.perf_counter()`` value ``started``"""
+        self.observe(time.perf_counter() - started)
+
+
+class Metric:
+    type = None
+    child_class = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._unlabelled = self.labels()
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}, got {values}")
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _new_child(self):
+        return self.child_class()
+
+    def samples(self):
+        for values, child in list(self._children.items()):
+            yield "", dict(zip(self.labelnames, values)), child.value
+
+
+class Counter(Metric):
+    type = "counter"
+    child_class = _CounterChild
+
+    def inc(self, amount=1):
+        self._unlabelled.inc(amount)
+
+
+class Gauge(Metric):
+    type = "gauge"
+    child_class = _GaugeChild
+
+    def inc(self, amount=1):
+        self._unlabelled.inc(amount)
+
+    def dec(self, amount=1):
+        self._unlabelled.dec(amount)
+
+    def set(self, value):
+        self._unlabelled.set(value)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._unlabelled.observe(value)
+
+    def observe_since(self, started):
+        self._unlabelled.observe_since(started)
+
+    def samples(self):
+        for values, child in list(self._children.items()):
+            labels = dict(zip(self.labelnames, values))
+            with child._lock:
+                counts, total, count = list(child.counts), child.sum, child.count
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += bucket_count
+                yield "_bucket", {**labels, "le": _format_value(bound)}, cumulative
+            yield "_sum", labels, total
+            yield "_count", labels, count
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                # modules may be imported twice (e.g. by the autoreloader)
+                return existing
+            self._metrics[metric.name] = metric
+        return metric
+
+    def register_collector(self, collector):
+        """
+        ``collector()`` is called on every scrape and returns
+        ``(name, type, help, [(labels, value), ...])`` tuples
+        """
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self):
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for suffix, labels, value in metric.samples():
+                lines.append(f"{metric.name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        for collector in list(self._collectors):
+            for name, kind, documentation, samples in collector():
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, int) or value.is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name, documentation, labelnames=()):
+    return REGISTRY.register(Gauge(name, documentation, labelnames))
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
+
+
+HTTP_REQUEST_SECONDS = histogram(
+    "http_request_duration_seconds", "REST request latency by view", ["view", "method"]
+)
+HTTP_RESPONSES = counter(
+    "http_responses_total", "REST responses by view and status class", ["view", "method", "status"]
+)
+
+# any other method (clients can send arbitrary ones) is labelled "other"
+HTTP_METHODS = frozenset({"GET", "POST", "PUT", "PATCH", "DELETE", "HEAD", "OPTIONS"})
+
+
+class RequestMetricsMiddleware:
+    """Records the latency and status of every request, labelled by URL name"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        response = self.get_response(request)
+        match = getattr(request, "resolver_match", None)
+        # URL names keep the label set bounded; unmatched paths share one label
+        view = (match.view_name or match.route) if match else "unmatched"
+        method = request.method if request.method in HTTP_METHODS else "other"
+        HTTP_REQUEST_SECONDS.labels(view, method).observe_since(started)
+        HTTP_RESPONSES.labels(view, method, f"{response.status_code // 100}xx").inc()
+        return response
+
+
+def metrics_view(request):
+    """
+    Prometheus scrape endpoint; requires ``Bearer <METRICS_TOKEN>``. Without
+    a token it is only served with DEBUG on.
+    """
+    token = getattr(settings, "METRICS_TOKEN", "")
+    if not token:
+        if not settings.DEBUG:
+            return HttpResponseForbidden()
+    elif not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+        return HttpResponseForbidden()
+    return HttpResponse(REGISTRY.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
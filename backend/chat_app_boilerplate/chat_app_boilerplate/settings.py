@@ -12,7 +12,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 
 from pathlib import Path
 from datetime import timedelta
-from decouple import config
+from decouple import Csv, config
 import os
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -51,6 +51,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "chat_app_boilerplate.metrics.RequestMetricsMiddleware",
     "corsheaders.middleware.CorsMiddleware",
     "django.middleware.common.CommonMiddleware",
     'django.middleware.security.SecurityMiddleware',
@@ -108,9 +109,55 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+    },
+}
+
+# Chat messages can live in their own database (see chat/routers.py), e.g.
+# CHAT_DATABASE_NAME=chat.sqlite3. Off by default; to move an existing install
+# over, with the app stopped: set it, `migrate --database chat`, `copy_messages`
+CHAT_DATABASE_NAME = config('CHAT_DATABASE_NAME', default='')
+if CHAT_DATABASE_NAME:
+    DATABASES['chat'] = {
+        **DATABASES['default'],
+        'NAME': CHAT_DATABASE_NAME,
     }
+
+DATABASE_ROUTERS = [
+    'chat.routers.MessageRouter',
+    'chat_app_boilerplate.database.ReadPoolRouter',
+]
+
+# SQLite production profile (see chat_app_boilerplate/database.py), off by
+# default: SQLITE_PRODUCTION_PROFILE=True switches the databases to WAL and
+# BEGIN IMMEDIATE, and gives the socket read pool read-only aliases
+SQLITE_PRODUCTION_PROFILE = config('SQLITE_PRODUCTION_PROFILE', default=False, cast=bool)
+SQLITE_PROFILE = {
+    "READ_POOL_SIZE": config("SQLITE_READ_POOL_SIZE", default=4, cast=int),
 }
 
+if SQLITE_PRODUCTION_PROFILE:
+    SQLITE_PROFILE["PRAGMAS"] = {
+        "journal_mode": "WAL",  # readers don't block the writer, nor it them
+        "synchronous": "NORMAL",  # durable in WAL mode, without an fsync per commit
+        "busy_timeout": 5000,  # ms a writer waits for the lock before failing
+        "mmap_size": 256 * 1024 * 1024,
+        "temp_store": "MEMORY",
+    }
+    SQLITE_PROFILE["READ_DATABASES"] = {}
+    for alias in list(DATABASES):
+        # BEGIN IMMEDIATE: transactions queue for the write lock (busy_timeout)
+        # instead of failing with "database is locked" when they first write
+        DATABASES[alias]['OPTIONS'] = {'transaction_mode': 'IMMEDIATE'}
+        # Read-only connections to the same file, kept open by the read pool
+        read_alias = 'read' if alias == 'default' else f'{alias}_read'
+        DATABASES[read_alias] = {
+            **DATABASES[alias],
+            'OPTIONS': {},
+            'CONN_MAX_AGE': None,
+            'TEST': {'MIRROR': alias},
+        }
+        SQLITE_PROFILE["READ_DATABASES"][alias] = read_alias
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -158,7 +205,23 @@ REST_FRAMEWORK = {
         # 'rest_framework_simplejwt.authentication.JWTAuthentication',
         # 'rest_framework.authentication.TokenAuthentication',
         'accounts.authentication.CustomJWTAuthentication',
-    ]
+    ],
+    # DRF's JSON renderer and parser, through orjson when it is installed
+    'DEFAULT_RENDERER_CLASSES': [
+        'chat_app_boilerplate.fastjson.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'chat_app_boilerplate.fastjson.FastJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
+}
+
+# JSON backend of REST responses and WebSocket frames: "auto" (orjson if
+# installed), "orjson" or "json" (see chat_app_boilerplate/fastjson.py)
+FAST_JSON = {
+    "BACKEND": config("FAST_JSON_BACKEND", default="auto"),
 }
 
 SIMPLE_JWT = {
@@ -202,23 +265,175 @@ GOOGLE_CLIENT_SECRET=config("GOOGLE_CLIENT_SECRET")
 
 GOOGLE_REDIRECT_URI=config("GOOGLE_REDIRECT_URI")
 
-# CHANNEL_LAYERS = {
-#     "default": {
-#         "BACKEND": "channels_redis.core.RedisChannelLayer",
-#         "CONFIG": {
-#             "hosts": [
-#                 {
-#                     "address": config("REDIS"),
-#                     "ssl": True,
-#                 }
-#             ],
-#         },
-#     },
-# }
-
-CHANNEL_LAYERS = {
-    "default": {
-        "BACKEND": "channels.layers.InMemoryChannelLayer"
+# Channel layer. The in-memory layer only reaches sockets of the same process,
+# so it is limited to a single ASGI worker. To run several, list one or more
+# Redis servers in CHAT_REDIS_URLS (e.g. "rediss://a:6379/0,rediss://b:6379/0");
+# groups are then sharded over them by consistent hashing of the group name
+# (see chat_app_boilerplate/channel_layers.py). Every worker must list the
+# same servers.
+CHAT_REDIS_URLS = config("CHAT_REDIS_URLS", default="", cast=Csv())
+
+if CHAT_REDIS_URLS:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "chat_app_boilerplate.channel_layers.ShardedRedisChannelLayer",
+            "CONFIG": {
+                "hosts": [{"address": url} for url in CHAT_REDIS_URLS],
+                "prefix": "chat",
+                # messages a slow socket may have waiting before group sends skip it
+                "capacity": 500,
+                "expiry": 30,
+            },
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels.layers.InMemoryChannelLayer"
+        }
     }
+
+
+# Write-behind batching of chat messages (see chat/persistence.py)
+# DURABILITY: "ack_after_persist" waits for the INSERT before broadcasting,
+# "ack_after_enqueue" broadcasts as soon as the message is buffered, without
+# its seq - clients can't resume from live messages then (chat/persistence.py)
+CHAT_PERSISTENCE = {
+    "DURABILITY": config("CHAT_DURABILITY", default="ack_after_persist"),
+    "BATCH_SIZE": 100,
+    "FLUSH_INTERVAL": 0.02,  # seconds
+}
+
+# Seconds a cached guild directory page may be served (see chat/directory.py);
+# guild create/join/leave/delete invalidate it immediately
+CHAT_GUILD_DIRECTORY_TTL = 30
+
+# Most recent conversations the contact list (chat/users/) returns
+CHAT_MAX_CONVERSATIONS = 100
+
+# Maximum conversations one ws/stream/ socket may subscribe to
+CHAT_STREAM_MAX_SUBSCRIPTIONS = 100
+
+# Most messages replayed to a client resuming with resume_from=<seq>; beyond
+# that it is told to reload history instead
+CHAT_RESUME_MAX_REPLAY = 500
+
+# Newest messages of recently active conversations, used to serve the first
+# page of history (see chat/recent.py). BACKEND "local" keeps them in each
+# process (LRU of MAX_ROOMS conversations / ~MAX_BYTES); "shared" keeps them
+# in the CACHE cache alias, which must then be shared by the workers
+CHAT_RECENT_MESSAGES = {
+    "BACKEND": config("CHAT_RECENT_MESSAGES_BACKEND", default="local"),
+    "SIZE": 50,
+    "MAX_ROOMS": 1000,
+    "MAX_BYTES": 32 * 1024 * 1024,
+    "CACHE": "default",
+    "TIMEOUT": 3600,  # seconds
+}
+
+# Full-text message search (see chat/search.py). The SQLite FTS5 backend
+# needs SQLite; other databases need another backend.
+CHAT_SEARCH = {
+    "BACKEND": "chat.search.SQLiteFTS5Backend",
+    "RECENCY_DAYS": 30,
+}
+
+# Archival of old messages into compressed segment files (see chat/archive.py),
+# run by "manage.py archive_messages". Segments are stored in the STORAGES
+# alias STORAGE (shared storage for several servers), or in ROOT if None
+CHAT_ARCHIVE = {
+    "AGE_DAYS": config("CHAT_ARCHIVE_AGE_DAYS", default=90, cast=int),
+    "SEGMENT_SIZE": 1000,
+    "STORAGE": None,
+    "ROOT": BASE_DIR / "archive",
+}
+
+# Bounded outbound queue of every chat socket (see chat/outbox.py). When a slow
+# client lets MAX_FRAMES pile up, POLICY decides: "coalesce" (replace the backlog
+# with resync_required markers), "drop_oldest", or "disconnect" (close code 4008).
+# HARD_LIMIT frames of any kind close the socket under every policy. Resume
+# replays wait for room instead, up to REPLAY_TIMEOUT seconds
+CHAT_OUTBOX = {
+    "MAX_FRAMES": 256,
+    "HARD_LIMIT": 1024,
+    "REPLAY_TIMEOUT": 10,
+    "POLICY": config("CHAT_OUTBOX_POLICY", default="coalesce"),
+}
+
+# Fan-out of large guilds (see chat/fanout.py): guilds with max_members above
+# SHARD_SIZE spread their sockets over ceil(max_members / SHARD_SIZE) channel
+# layer groups (at most MAX_SHARDS), and a message is sent to CONCURRENCY of
+# them at a time. New guilds may ask for up to MAX_MEMBERS members
+CHAT_GUILD_FANOUT = {
+    "MAX_MEMBERS": config("CHAT_GUILD_MAX_MEMBERS", default=5000, cast=int),
+    "SHARD_SIZE": 100,
+    "MAX_SHARDS": 64,
+    "CONCURRENCY": 8,
+}
+
+# Token-bucket flood control of the messages clients send (see chat/throttle.py):
+# RATE messages/sec with bursts of up to BURST, per socket, per user (all of
+# their sockets in one worker) and per guild. None disables a level. Refused
+# messages get a {"type": "throttled", "limit", "retry_after"} frame, which
+# the frontend doesn't handle yet, so the limits are off unless
+# CHAT_FLOOD_CONTROL=True
+CHAT_FLOOD_CONTROL = {
+    "CONNECTION": None,
+    "USER": None,
+    "GUILD": None,
+}
+if config('CHAT_FLOOD_CONTROL', default=False, cast=bool):
+    CHAT_FLOOD_CONTROL = {
+        "CONNECTION": {"RATE": 5, "BURST": 10},
+        "USER": {"RATE": 10, "BURST": 20},
+        "GUILD": {"RATE": 50, "BURST": 100},
+    }
+
+# Per-process cache of verified access tokens and user records used by
+# CustomJWTAuthentication and the WebSocket JWTAuthMiddleware
+TOKEN_CACHE = {
+    "MAX_TOKENS": 4096,
+    "MAX_USERS": 4096,
+    "USER_TTL": 300,  # seconds
+}
+
+# Structured logging for the chat and auth hot paths (see chat_app_boilerplate/logs.py).
+# Records go through a bounded in-memory queue to a background writer thread.
+# SAMPLE_RATE: fraction of per-message events (received/broadcast/sent) logged
+# EVENTS: per-event level overrides, e.g. {"ws.connect.accepted": "DEBUG"}
+CHAT_LOGGING = {
+    "SAMPLE_RATE": config("CHAT_LOG_SAMPLE_RATE", default=0.01, cast=float),
+    "EVENTS": {},
+    "QUEUE_SIZE": 10000,
+    "TRACE_TIMEOUT": 3600,  # seconds
+}
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "formatters": {
+        "kv": {"format": "%(asctime)s %(levelname)s %(name)s %(message)s"},
+    },
+    "handlers": {
+        "queue": {
+            "class": "chat_app_boilerplate.logs.NonBlockingQueueHandler",
+            "formatter": "kv",
+        },
+    },
+    "loggers": {
+        "chat": {
+            "handlers": ["queue"],
+            "level": config("CHAT_LOG_LEVEL", default="INFO"),
+            "propagate": False,
+        },
+        "accounts": {
+            "handlers": ["queue"],
+            "level": config("CHAT_LOG_LEVEL", default="INFO"),
+            "propagate": False,
+        },
+    },
 }
 
+# Bearer token required to scrape /metrics (see chat_app_boilerplate/metrics.py);
+# while empty, /metrics is only served with DEBUG on
+METRICS_TOKEN = config("METRICS_TOKEN", default="")
@@ -17,9 +17,12 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, re_path, include
 
+from .metrics import metrics_view
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     re_path(r'^accounts/', include('djoser.urls')),
     path('accounts/', include('accounts.urls')),
     path('chat/', include('chat.urls')),  # Add this line
+    path('metrics', metrics_view, name='metrics'),  # Prometheus scrape endpoint
 ]
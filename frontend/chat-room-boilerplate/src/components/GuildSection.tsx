@@ -47,7 +47,7 @@ const GuildSection = ({ onGuildSelect, selectedGuild }: GuildSectionProps) => {
   const fetchGuilds = async () => {
     try {
       const response = await api.get("/chat/guilds/");
-      setGuilds(response.data);
+      setGuilds(response.data.results);
     } catch (error) {
       console.error("Failed to fetch guilds:", error);
     }
@@ -64,7 +64,7 @@ const Chat = () => {
     try {
       const response = await api.get("/chat/users/");
       console.log("📋 Fetched contacts:", response.data);
-      setContacts(response.data);
+      setContacts([...response.data.conversations, ...response.data.users]);
     } catch (error) {
       console.error("❌ Failed to fetch contacts:", error);
     }
@@ -184,7 +184,7 @@ const Chat = () => {
       const response = await api.get(`/chat/messages/${contactEmail}/`);
       console.log("📜 Message history response:", response.data);
       
-      const history = response.data.map((msg: any) => ({
+      const history = response.data.results.map((msg: any) => ({
         text: msg.message,
         who: msg.sender === user?.email ? "me" : "you",
         time: new Date(msg.timestamp).toLocaleTimeString([], { 
@@ -208,7 +208,7 @@ const Chat = () => {
       const response = await api.get(`/chat/group/${guildName}/messages/`);
       console.log("📜 Guild history response:", response.data);
       
-      const history = response.data.map((msg: any) => ({
+      const history = response.data.results.map((msg: any) => ({
         text: msg.message,
         who: msg.sender === user?.email ? "me" : "you",
         time: new Date(msg.timestamp).toLocaleTimeString([], { 